@@ -1 +1,12 @@
-from fit import fit_model_omega, firstpass_decoder_independent_pixels, calculate_bold_loglikelihood, maximize_loglikelihood
+import importlib
+
+# the decoding functions, loaded lazily from dec.utils
+_exports = ['fit_model_omega', 'firstpass_decoder_independent_channels', 'calculate_bold_loglikelihood', 'maximize_loglikelihood']
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module('.utils', __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -24,6 +24,8 @@ import itertools
 from utils.utils import roi_data_from_hdf, create_visual_designmatrix_all, get_figshare_data, createCircularMask
 from utils.css import CompressiveSpatialSummationModelFiltered
 from fit import fit_model_omega, calculate_bold_loglikelihood, maximize_loglikelihood
+from utils.metrics import decoding_metrics
+from utils.export import export_frames
 
 # indices into prf output array:
 #	0:	X
@@ -362,35 +364,20 @@ for t in range(test_data_decode.shape[1]):
 decoded_image = np.load('data/decoded_image.npy')
 dm_pixel_logl_ratio = np.load('data/dm_pixel_logl_ratio.npy')
 
-# set up figure
-fig = pl.figure(figsize=(6, 6))
-ims = []
-
-for t in range(test_data_decode.shape[1]):
-   
-    #the video animation is currently not working for me. not sure how to fix it
-    # fig.gca().add_patch(pl.Circle((int(n_pix/2), int(n_pix/2)), radius=8, facecolor='w',
-    #                             edgecolor='k', fill=False, linewidth=3.0))
-    extentz=[int(n_pix/2)-stim_radius,int(n_pix/2)+stim_radius,int(n_pix/2)-stim_radius,int(n_pix/2)+stim_radius,]
-    # im = pl.imshow(dm_pixel_logl_ratio[:,:,t], animated=True, clim=[dm_pixel_logl_ratio.min(
-    # ), dm_pixel_logl_ratio.max()], cmap='viridis', alpha=0.95)#, extent=extentz)    
-    im = pl.imshow(decoded_image[:,:,t], animated=True, clim=[decoded_image.min(
-    ), decoded_image.max()], cmap='viridis', alpha=0.95)#, extent=extentz)
-    pl.axis('off')
-    ims.append([im])
-
-ani = animation.ArtistAnimation(
-    fig, ims, interval=5, blit=True, repeat_delay=150)
-# writer=writer, , codec='hevc'
-ani.save('data/out.mp4', dpi=150, bitrate=1800, codec='hevc')
+# stream the frames to the video, with the colour range of all frames
+# (for dm_pixel_logl_ratio, pass dm_pixel_logl_ratio.transpose(2,0,1))
+export_frames(decoded_image.transpose(2,0,1), 'data/out.mp4', cmap='viridis', fps=10, codec='libx265')
 
 #try to calculate correlation between decoded and actual image. If bold not deconvolved, need to account for hemodynamic delay
-delay=-4            
-dm_roll=np.roll(np.flip(dm_pixel_logl_ratio,axis=1),delay,axis=2)            
-for i in np.arange(result_corrcoef.shape[0]):     
-    result_corrcoef[i] = np.corrcoef(np.ravel(dm_roll[:,:,i]),np.ravel(dm_crossv[:,:,start+i]))[0,1]
+#decoded frame t+delay is compared with presented frame t, delay is scanned and the best one reported
+metrics = decoding_metrics(np.flip(dm_pixel_logl_ratio,axis=1).transpose(2,0,1),
+                           dm_crossv[:,:,start:end].transpose(2,0,1),
+                           lags=np.arange(0,9))
+delay = metrics['lag']
+result_corrcoef = metrics['correlation']
 pl.plot(result_corrcoef)
 np.nanmean(result_corrcoef)    
+np.nanmean(metrics['identification'])
 #next: "smart" function to optimize the posterior. (hierarchical prior? flip-and-keep with continuous values? flip-and-keep +proximity-biased search?)
 #Perhaps choose a different approach i.e. define receptive fields that cover the screen  
 #is it possible to improve the CSS model itself?
@@ -1,2 +1,118 @@
-from .utils import create_visual_designmatrix_all, roi_data_from_hdf, get_figshare_data, create_circular_mask
-from .css import CompressiveSpatialSummationModelFiltered
\ No newline at end of file
+"""Public functions of the decoding package.
+
+They are loaded lazily on first attribute access, so that ``import dec.utils``
+doesn't pull in scipy, popeye, tables or matplotlib before they are needed.
+"""
+import importlib
+
+# public name: submodule it lives in
+_exports = {
+    'create_visual_designmatrix_all': 'utils',
+    'roi_data_from_hdf': 'utils',
+    'roi_data_from_cache': 'utils',
+    'roi_data_cache_file': 'utils',
+    'cache_roi_data': 'utils',
+    'get_figshare_data': 'utils',
+    'create_circular_mask': 'utils',
+    'CompressiveSpatialSummationModelFiltered': 'css',
+    'firstpass_decoder_independent_channels': 'fit',
+    'mapping': 'fit',
+    'calculate_bold_loglikelihood': 'fit',
+    'maximize_loglikelihood': 'fit',
+    'firstpass_decoder_independent_channels_batch': 'fit',
+    'calculate_bold_loglikelihood_batch': 'fit',
+    'mapping_derivative': 'fit',
+    'mapped_predictor': 'fit',
+    'posterior_standard_deviation': 'fit',
+    'stimulus_basis': 'fit',
+    'uses_power_law': 'fit',
+    'maximize_loglikelihood_basis': 'fit',
+    'maximize_loglikelihood_batch': 'fit',
+    'maximize_loglikelihood_anytime': 'fit',
+    'fit_model_omega': 'omega',
+    'fit_model_omega_likelihood': 'omega',
+    'likelihood_omega_factors': 'omega',
+    'fit_model_omega_multi_roi': 'omega',
+    'multi_roi_omega_factors': 'omega',
+    'woodbury_inverse': 'omega',
+    'woodbury_solve': 'omega',
+    'map_omega_parameters': 'omega',
+    'voxel_distance_matrix': 'omega',
+    'isPSD': 'omega',
+    'setup_data_from_h5': 'prf',
+    'setup_multi_roi_data_from_h5': 'prf',
+    'decode_cv_prfs': 'prf',
+    'plot_best_and_worst_voxels': 'prf',
+    'crossvalidated_rsq': 'prf',
+    'prf_mapping': 'prf',
+    'decode_fold': 'prf',
+    'setup_css_model': 'prf',
+    'DecodingSweep': 'sweep',
+    'STAGE_PARAMETERS': 'sweep',
+    'prefetched': 'pipeline',
+    'load_manifest': 'batch',
+    'run_batch': 'batch',
+    'frame_correlation': 'metrics',
+    'masked_rmse': 'metrics',
+    'decoding_metrics': 'metrics',
+    'permutation_p_value': 'significance',
+    'pairing_null': 'significance',
+    'voxel_shift_null': 'significance',
+    'fold_bootstrap': 'significance',
+    'select_informative_voxels': 'voxel_selection',
+    'posterior_information': 'voxel_selection',
+    'voxel_subset': 'voxel_selection',
+    'colour_lut': 'export',
+    'frame_limits': 'export',
+    'colour_frame': 'export',
+    'VideoWriter': 'export',
+    'ArrayWriter': 'export',
+    'export_frames': 'export',
+    'quadratic_forms': 'kernels',
+    'quadratic_form_and_gradient': 'kernels',
+    'HAVE_NUMBA': 'kernels',
+    'bar_design_stimuli': 'robustness',
+    'simulate_bold': 'robustness',
+    'pixel_sensitivity': 'robustness',
+    'robustness_report': 'robustness',
+    'PRF_PARAMETERS': 'prf_fitting',
+    'css_lookup_table': 'prf_fitting',
+    'grid_fit': 'prf_fitting',
+    'refine_fit': 'prf_fitting',
+    'fit_css_prfs': 'prf_fitting',
+    'run_views': 'loo',
+    'loo_medians': 'loo',
+    'loo_css_residuals': 'loo',
+    'write_loo_data': 'loo',
+    'hrf_filter_operator': 'deconvolution',
+    'css_hrf_filter_operator': 'deconvolution',
+    'deconvolution_operator': 'deconvolution',
+    'gcv_regularisation': 'deconvolution',
+    'deconvolve': 'deconvolution',
+    'save_decoder': 'bundle',
+    'load_decoder': 'bundle',
+    'DecoderBundle': 'bundle',
+    'BUNDLE_FORMAT_VERSION': 'bundle',
+    'DecoderService': 'service',
+    'DecoderClient': 'service',
+    'start_background_service': 'service',
+    'BAR_THETAS': 'realign',
+    'rotation_index_map': 'realign',
+    'bar_block_windows': 'realign',
+    'realign_reconstructions': 'realign',
+    'plot_realigned_reconstruction': 'realign',
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
@@ -0,0 +1,298 @@
+"""Batch decoding of many data files, ROIs and settings from a job manifest.
+
+The manifest is a JSON file with a list of jobs, or a dict with 'defaults'
+(applied to every job) and 'jobs'. A job holds the arguments of
+decode_cv_prfs, of which at least data_file and mask_name, and optionally a
+'name' for its output file and 'save_omega' to also store the (large)
+per-fold omegas::
+
+    {"defaults": {"n_pix": 21, "rsq_threshold": 0.5},
+     "jobs": [{"data_file": "data/sub-01.h5", "mask_name": "V1"},
+              {"data_file": "data/sub-01.h5", "mask_name": ["V1", "V2", "V3"], "name": "sub-01_early"}]}
+
+Run it with::
+
+    python -m dec.utils.batch manifest.json --output-dir results --workers 4
+
+The ROI caches of the jobs (see cache_roi_data) are built in a background
+thread of the main process, with prefetched, while the workers decode jobs
+whose caches are ready. Within a job, decode_cv_prfs overlaps setting up a
+fold with decoding the previous one in the same way.
+
+numpy is only imported inside functions: worker processes are spawned, and
+their BLAS thread count has to be set before numpy is first imported.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+# decode_cv_prfs arguments of a job that are not in the manifest
+JOB_DEFAULTS = dict(n_pix=21,
+                    rsq_threshold=0.5,
+                    use_median=False,
+                    n_folds=6,
+                    extent=[-5, 5],
+                    screen_distance=225,
+                    screen_width=69.0,
+                    TR=0.945,
+                    mapping='css')
+
+# environment variables read by the BLAS and OpenMP libraries numpy may be linked against
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+RESULT_NAMES = ['cv_rotated_recon', 'cv_reshrot_recon', 'cv_reshrot_recon_m', 'cv_omega',
+                'cv_estimated_tau_matrix', 'cv_estimated_rho', 'cv_estimated_sigma', 'cv_estimated_alpha']
+
+
+def load_manifest(manifest_file):
+    """load_manifest reads a job manifest, see the module docstring.
+
+    Returns
+    -------
+    jobs : list
+        one dict per job, with the defaults of the manifest and JOB_DEFAULTS
+        filled in, and a unique 'name'.
+    """
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = dict(jobs=manifest)
+
+    jobs = []
+    for job in manifest['jobs']:
+        job = dict(JOB_DEFAULTS, **dict(manifest.get('defaults', {}), **job))
+        if 'name' not in job:
+            mask_name = job['mask_name']
+            rois = '-'.join(mask_name) if isinstance(mask_name, (list, tuple)) else mask_name
+            job['name'] = '%s_%s_%i_%g_%s' % (os.path.splitext(os.path.basename(job['data_file']))[0],
+                                              rois, job['n_pix'], job['rsq_threshold'], job['mapping'])
+        jobs.append(job)
+
+    names = [job['name'] for job in jobs]
+    if len(set(names)) != len(names):
+        print('job names in ' + manifest_file + ' are not unique')
+        return None
+    return jobs
+
+
+def job_cost(job):
+    """job_cost is the relative run time of a job, used to start the largest jobs first.
+
+    The omega fit scales with the square of the number of selected voxels, and
+    decoding with the number of voxels times the number of pixels, for every fold.
+    Voxels are counted in the memory-mapped ROI caches (see roi_data_from_cache),
+    all of which this builds for the workers as a side effect.
+    """
+    import numpy as np
+    from .utils import roi_data_from_cache, cache_roi_data, get_figshare_data
+    from .prf import crossvalidated_rsq
+
+    hdf5_file = get_figshare_data(job['data_file'])
+    mask_names = job['mask_name'] if isinstance(job['mask_name'], (list, tuple)) else [job['mask_name']]
+    cache_roi_data(hdf5_file, mask_names)
+    n_voxels = 0
+    for mask_name in mask_names:
+        all_prf_data = roi_data_from_cache(['*all'], mask_name, hdf5_file, 'all_prf')
+        prf_data = roi_data_from_cache(['*all'], mask_name, hdf5_file, 'prf').reshape((all_prf_data.shape[0], -1, all_prf_data.shape[-1]))
+        n_voxels += np.sum(crossvalidated_rsq(prf_data) > job['rsq_threshold'])
+    return float(job['n_folds']) * n_voxels * (n_voxels + job['n_pix']**2)
+
+
+def _limit_blas_threads(n_threads):
+    """worker initializer, in case the worker has already imported numpy."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(n_threads)
+
+
+def _output_file(output_dir, job):
+    return os.path.join(output_dir, job['name'] + '.npz')
+
+
+def run_job(job, output_dir):
+    """run_job decodes a single job with decode_cv_prfs, and writes its results
+    to output_dir/<name>.npz. The file is only renamed into place when complete.
+
+    Returns
+    -------
+    name : str
+        name of the job
+    elapsed : float
+        run time in seconds
+    """
+    import numpy as np
+    from .prf import decode_cv_prfs
+
+    start = time.time()
+    arguments = dict((k, v) for k, v in job.items() if k not in ('name', 'save_omega'))
+    # n_jobs=1: a job decodes in its worker process alone, the pool already runs a job
+    # per worker and nested pools would oversubscribe the cores. decode_cv_prfs still
+    # sets up the next fold in a background thread while a fold is decoded.
+    results = decode_cv_prfs(n_jobs=1, plot=False, **arguments)
+
+    results = dict(zip(RESULT_NAMES, results))
+    if not job.get('save_omega', False):
+        del results['cv_omega']
+
+    output_file = _output_file(output_dir, job)
+    temporary_file = output_file + '.%i.tmp.npz' % os.getpid()
+    np.savez(temporary_file, **results)
+    os.replace(temporary_file, output_file)
+
+    return job['name'], time.time() - start
+
+
+def _prepare_job(job):
+    """builds the ROI caches of job in the main process, returns its cost, the job and
+    None, or None, the job and the error if it could not be prepared, e.g. for a
+    missing data file or ROI, so that it fails alone."""
+    try:
+        return job_cost(job), job, None
+    except Exception as error:
+        return None, job, error
+
+
+def run_batch(jobs, output_dir, n_workers=None, blas_threads=None, overwrite=False, lookahead=None):
+    """run_batch runs jobs over a pool of spawned worker processes, largest first.
+
+    Jobs are prepared (their ROI caches built and their cost estimated, see job_cost)
+    in manifest order in a background thread, while the workers decode the jobs
+    prepared earlier. Whenever a worker is free, it is given the largest prepared job.
+
+    Parameters
+    ----------
+    jobs : list
+        job dicts, as returned by load_manifest
+    output_dir : str
+        directory of the per-job .npz result files
+    n_workers : int
+        number of worker processes, defaults to one per 2 cores
+    blas_threads : int
+        BLAS threads per worker, defaults to dividing the cores over the workers
+    overwrite : bool
+        rerun jobs whose result file already exists, which are skipped otherwise,
+        so that an interrupted batch can be resumed
+    lookahead : int
+        number of prepared jobs kept waiting beyond those running, from which the
+        largest is started next, defaults to n_workers
+
+    Returns
+    -------
+    report : dict
+        per-job run times (in seconds) of the jobs that finished, names of the
+        jobs that failed with their error, the wall time, and the throughput in jobs per hour.
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    import multiprocessing
+    import heapq
+    from .pipeline import prefetched
+
+    n_cores = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = max(1, n_cores // 2)
+    if blas_threads is None:
+        blas_threads = max(1, n_cores // n_workers)
+    if lookahead is None:
+        lookahead = n_workers
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if not overwrite:
+        skipped = [job['name'] for job in jobs if os.path.isfile(_output_file(output_dir, job))]
+        if len(skipped) > 0:
+            print('skipping %i jobs with existing results' % len(skipped))
+        jobs = [job for job in jobs if job['name'] not in skipped]
+
+    print('running %i jobs on %i workers with %i BLAS threads each' % (len(jobs), n_workers, blas_threads))
+
+    # spawned workers inherit the environment, so that the limit is set before anything in them imports numpy
+    saved_environment = dict((variable, os.environ.get(variable)) for variable in BLAS_THREAD_VARIABLES)
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(blas_threads)
+
+    run_times, failures = {}, {}
+    start = time.time()
+    try:
+        executor = ProcessPoolExecutor(max_workers=n_workers,
+                                       mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_limit_blas_threads,
+                                       initargs=(blas_threads,))
+        with executor:
+            # the prepared jobs, largest first, and the jobs running on the pool
+            prepared = prefetched(_prepare_job, [(job,) for job in jobs], depth=lookahead)
+            ready, running = [], {}
+            n_prepared = 0
+            while True:
+                # take prepared jobs until lookahead of them wait beyond the running ones.
+                # This only blocks while the background thread prepares a job.
+                while n_prepared < len(jobs) and len(ready) + len(running) < n_workers + lookahead:
+                    cost, job, error = next(prepared)
+                    n_prepared += 1
+                    if error is not None:
+                        failures[job['name']] = repr(error)
+                        print('job %s failed: %s' % (job['name'], failures[job['name']]))
+                        continue
+                    heapq.heappush(ready, (-cost, n_prepared, job))
+                while len(ready) > 0 and len(running) < n_workers:
+                    job = heapq.heappop(ready)[2]
+                    running[executor.submit(run_job, job, output_dir)] = job['name']
+                if len(running) == 0:
+                    break
+
+                done = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        run_times[name] = future.result()[1]
+                    except Exception as error:
+                        failures[name] = repr(error)
+                        print('job %s failed: %s' % (name, failures[name]))
+                        continue
+                    elapsed = time.time() - start
+                    print('%i/%i done, %s in %.1f s, %.2f jobs/hour' % (len(run_times), len(jobs), name, run_times[name],
+                                                                       3600.0 * len(run_times) / elapsed))
+    finally:
+        for variable, value in saved_environment.items():
+            if value is None:
+                del os.environ[variable]
+            else:
+                os.environ[variable] = value
+
+    wall_time = time.time() - start
+    report = dict(run_times=run_times,
+                  failures=failures,
+                  wall_time=wall_time,
+                  jobs_per_hour=3600.0 * len(run_times) / wall_time if wall_time > 0 else 0.0,
+                  # fraction of the pool's time spent in jobs
+                  utilisation=sum(run_times.values()) / (wall_time * n_workers) if wall_time > 0 else 0.0)
+    print('%i jobs in %.1f s, %.2f jobs/hour, %i failed, pool utilisation %.0f%%' % (
+        len(run_times), wall_time, report['jobs_per_hour'], len(failures), 100 * report['utilisation']))
+
+    with open(os.path.join(output_dir, 'batch_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='decode the jobs of a manifest with decode_cv_prfs')
+    parser.add_argument('manifest', help='JSON job manifest')
+    parser.add_argument('--output-dir', default='results', help='directory of the per-job result files')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--blas-threads', type=int, default=None, help='BLAS threads per worker')
+    parser.add_argument('--overwrite', action='store_true', help='rerun jobs with existing results')
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    if jobs is None:
+        return 1
+    report = run_batch(jobs, args.output_dir, n_workers=args.workers, blas_threads=args.blas_threads, overwrite=args.overwrite)
+    return 1 if len(report['failures']) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
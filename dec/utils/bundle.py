@@ -0,0 +1,191 @@
+"""Decoder bundles: everything a worker needs to decode, saved once and memory-mapped on load.
+
+A bundle is a directory with a manifest.json and one .npy file per array::
+
+    V1.decoder/
+        manifest.json                version, mapping, metadata and the arrays below
+        W.npy                        (n_voxels, n_pixels)
+        omega_inv.npy                (n_voxels, n_voxels)
+        logdet.npy                   (2,) sign and log of the determinant of omega
+        mask.npy                     (n_pix, n_pix) pixel mask of the columns of W
+        mapping_parameters_<i>.npy   parameters of the i-th mapping
+        omega_diagonal.npy, omega_U.npy       optional woodbury factors of omega
+        predictors.npy               (n_voxels, n_pixels+1) mapped firstpass predictors, empty screen first
+        omega_inv_predictors.npy     omega_inv.dot(predictors)
+        predictor_forms.npy          (n_pixels+1,) quadratic forms of the predictors
+
+The arrays are C-contiguous, so load maps them read-only without copying, and
+processes that load the same bundle share their pages.
+"""
+import os
+import json
+import time
+import shutil
+
+import numpy as np
+
+from .fit import _apply_mapping, calculate_bold_loglikelihood_batch, maximize_loglikelihood_anytime
+
+BUNDLE_FORMAT_VERSION = 1
+
+
+def save_decoder(path, W, omega_inv, logdet, mapping_relation=None, mapping_parameters=[], mask=None,
+                 omega_factors=None, metadata={}):
+    """save_decoder writes a decoder bundle to the directory path, replacing an existing one.
+
+    The bundle is written to a temporary directory first and then moved into place,
+    so that workers never load a partially written bundle.
+
+    Parameters
+    ----------
+    path : str
+        bundle directory, e.g. 'V1.decoder'
+    W, omega_inv, logdet, mapping_relation, mapping_parameters :
+        as in decode_fold
+    mask : numpy.ndarray
+        (n_pix, n_pix) pixel mask of the columns of W, from setup_data_from_h5
+    omega_factors : tuple
+        (diagonal, U) woodbury factors of omega, e.g. from likelihood_omega_factors
+    metadata : dict
+        JSON-serialisable information on the decoder, e.g. data file, ROI and settings
+
+    Returns
+    -------
+    path : str
+    """
+    if mapping_relation is not None and type(mapping_relation) != list:
+        mapping_relation, mapping_parameters = [mapping_relation], [mapping_parameters]
+    elif mapping_relation is None:
+        mapping_parameters = []
+
+    arrays = dict(W=W, omega_inv=omega_inv, logdet=np.array([logdet[0], logdet[1]], dtype=np.float64))
+    if mask is not None:
+        arrays['mask'] = mask
+    for i, parameters in enumerate(mapping_parameters):
+        arrays['mapping_parameters_%i' % i] = parameters
+    if omega_factors is not None:
+        arrays['omega_diagonal'], arrays['omega_U'] = omega_factors
+
+    # precomputed firstpass operators, see DecoderBundle.firstpass
+    predictors = np.zeros((W.shape[0], W.shape[1] + 1))
+    predictors[:, 1:] = W
+    predictors = _apply_mapping(predictors, mapping_relation, mapping_parameters)
+    arrays['predictors'] = predictors
+    arrays['omega_inv_predictors'] = omega_inv.dot(predictors)
+    arrays['predictor_forms'] = (predictors * arrays['omega_inv_predictors']).sum(0)
+
+    path = os.path.normpath(path)
+    temporary_path = path + '.%i.tmp' % os.getpid()
+    if os.path.isdir(temporary_path):
+        shutil.rmtree(temporary_path)
+    os.makedirs(temporary_path)
+
+    manifest = dict(format_version=BUNDLE_FORMAT_VERSION,
+                    created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    mapping_relation=mapping_relation,
+                    n_mapping_parameters=len(mapping_parameters),
+                    metadata=metadata,
+                    arrays={})
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        np.save(os.path.join(temporary_path, name + '.npy'), array)
+        manifest['arrays'][name] = dict(dtype=array.dtype.str, shape=list(array.shape))
+    with open(os.path.join(temporary_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.isdir(path):
+        old_path = path + '.%i.old' % os.getpid()
+        os.rename(path, old_path)
+        os.rename(temporary_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(temporary_path, path)
+    return path
+
+
+class DecoderBundle(object):
+    """DecoderBundle is a loaded decoder bundle, see load. Its arrays are attributes
+    (W, omega_inv, logdet, mask, predictors, ...), memory-mapped read-only, and
+    mapping_relation and mapping_parameters are in the form decode_fold takes them.
+    """
+
+    def __init__(self, path, manifest, arrays):
+        super(DecoderBundle, self).__init__()
+        self.path = path
+        self.manifest = manifest
+        self.metadata = manifest['metadata']
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.logdet = (float(self.logdet[0]), float(self.logdet[1]))
+        if not hasattr(self, 'mask'):
+            self.mask = None
+
+        self.mapping_relation = manifest['mapping_relation']
+        self.mapping_parameters = [arrays['mapping_parameters_%i' % i] for i in range(manifest['n_mapping_parameters'])]
+
+    def firstpass(self, bolds):
+        """firstpass_decoder_independent_channels_batch of bolds (n_voxels, n_timepoints),
+        with the precomputed predictors. returns (n_pixels, n_timepoints) firstpass images."""
+        bolds = bolds.reshape((bolds.shape[0], -1))
+        const = -0.5 * (self.logdet[1] + self.omega_inv.shape[0] * np.log(2 * np.pi))
+        forms = ((bolds * self.omega_inv.dot(bolds)).sum(0)[np.newaxis, :]
+                 - 2 * self.omega_inv_predictors.T.dot(bolds)
+                 + self.predictor_forms[:, np.newaxis])
+        log_likelihood = const - 0.5 * forms
+        firstpass_images = log_likelihood[0] / log_likelihood[1:]
+        firstpass_min, firstpass_max = firstpass_images.min(0), firstpass_images.max(0)
+        return (firstpass_images - firstpass_min) / (firstpass_max - firstpass_min)
+
+    def loglikelihood(self, stimuli, bolds):
+        """log-likelihood of (n_pixels, n_stimuli) stimuli given bolds, see calculate_bold_loglikelihood_batch."""
+        return -calculate_bold_loglikelihood_batch(stimuli, self.W, bolds, self.logdet, self.omega_inv,
+                                                   self.mapping_relation, self.mapping_parameters)
+
+    def decode(self, bolds, **kwargs):
+        """decode_fold of bolds (n_voxels, n_timepoints), returns the firstpass and decoded images.
+        kwargs are passed to decode_fold, e.g. basis."""
+        from .prf import decode_fold
+        return decode_fold(self.W, bolds.reshape((bolds.shape[0], -1)), self.logdet, self.omega_inv,
+                           self.mapping_relation, self.mapping_parameters, **kwargs)
+
+    def decode_anytime(self, bold, time_budget=None, max_iterations=None, analytic_gradient=True, **kwargs):
+        """MAP decoding of a single bold pattern (n_voxels,) from its firstpass image, stopped after
+        time_budget seconds, see maximize_loglikelihood_anytime. returns logl, decoded image and converged."""
+        return maximize_loglikelihood_anytime(self.firstpass(bold)[:, 0], self.W, bold, self.logdet, self.omega_inv,
+                                              self.mapping_relation, self.mapping_parameters,
+                                              time_budget=time_budget, max_iterations=max_iterations,
+                                              analytic_gradient=analytic_gradient, **kwargs)
+
+    def images(self, pixels):
+        """(n_pixels, ...) pixel values in the mask as (..., n_pix, n_pix) images."""
+        images = np.zeros(pixels.shape[1:] + self.mask.shape)
+        images[..., self.mask] = np.moveaxis(pixels, 0, -1)
+        return images
+
+
+def load(path, mmap_mode='r'):
+    """load reads a decoder bundle written by save_decoder, memory-mapping its arrays.
+
+    Parameters
+    ----------
+    path : str
+        bundle directory
+    mmap_mode : str
+        as in numpy.load, None loads the arrays into memory
+
+    Returns
+    -------
+    decoder : DecoderBundle
+    """
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] > BUNDLE_FORMAT_VERSION:
+        print('Error: bundle format version %i is newer than the supported version %i' % (manifest['format_version'], BUNDLE_FORMAT_VERSION))
+        return None
+
+    arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                  for name in manifest['arrays'])
+    return DecoderBundle(path, manifest, arrays)
+
+
+load_decoder = load
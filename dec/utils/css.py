@@ -8,12 +8,11 @@ warnings.simplefilter("ignore")
 
 import numpy as np
 from scipy.signal import fftconvolve, savgol_filter
-import nibabel
 
 from popeye.onetime import auto_attr
 import popeye.utilities as utils
 from popeye.base import PopulationModel, PopulationFit
-from popeye.spinach import generate_og_receptive_field, generate_rf_timeseries_nomask
+from popeye.spinach import generate_og_receptive_field, generate_og_receptive_fields, generate_rf_timeseries_nomask
 from popeye.css import CompressiveSpatialSummationModel
 
 
@@ -126,3 +125,53 @@ class CompressiveSpatialSummationModelFiltered(CompressiveSpatialSummationModel)
         model += baseline
 
         return model
+
+    # predictions of many voxels at once, shared by the two methods below
+    def _generate_predictions(self, deg_x, deg_y, stim_arr, x, y, sigma, n, beta, baseline):
+
+        x, y, sigma, n, beta, baseline = np.broadcast_arrays(*[np.atleast_1d(np.asarray(p, dtype=np.float64))
+                                                              for p in (x, y, sigma, n, beta, baseline)])
+
+        # generate the RFs, (n_x, n_y, n_voxels)
+        rfs = generate_og_receptive_fields(
+            x, y, sigma, np.ones(x.shape[0]), deg_x, deg_y)
+
+        # normalize by the integral
+        rfs /= ((2 * np.pi * sigma**2) * 1 /
+                np.diff(deg_x[0, 0:2])**2)
+
+        # extract the stimulus time-series of all RFs with one product, (n_voxels, n_timepoints)
+        response = np.tensordot(rfs, stim_arr, axes=([0, 1], [0, 1]))
+
+        # compression
+        response **= n[:, np.newaxis]
+
+        # convolve with the HRF
+        hrf = self.hrf_model(self.hrf_delay, self.stimulus.tr_length)
+        model = fftconvolve(response, hrf[np.newaxis, :], axes=1)[:, 0:response.shape[1]]
+
+        # filtering with a savitzky-golay filter, along time
+        model = model - savgol_filter(model, window_length=self.sg_filter_window_length, polyorder=self.sg_filter_order,
+                                      deriv=0, mode='nearest', axis=-1)
+
+        # scale by beta and offset
+        model *= beta[:, np.newaxis]
+        model += baseline[:, np.newaxis]
+
+        return model
+
+    def generate_ballpark_predictions(self, x, y, sigma, n, beta=1.0, baseline=0.0):
+        r"""
+        generate_ballpark_prediction for arrays of parameters, on the coarse stimulus.
+        Returns (n_voxels, n_timepoints) predictions, computed together.
+        """
+        return self._generate_predictions(self.stimulus.deg_x0, self.stimulus.deg_y0, self.stimulus.stim_arr0,
+                                          x, y, sigma, n, beta, baseline)
+
+    def generate_predictions(self, x, y, sigma, n, beta=1.0, baseline=0.0):
+        r"""
+        generate_prediction for arrays of parameters.
+        Returns (n_voxels, n_timepoints) predictions, computed together.
+        """
+        return self._generate_predictions(self.stimulus.deg_x, self.stimulus.deg_y, self.stimulus.stim_arr,
+                                          x, y, sigma, n, beta, baseline)
@@ -0,0 +1,89 @@
+import numpy as np
+from scipy.signal import savgol_filter
+
+
+def hrf_filter_operator(nr_timepoints, hrf, sg_filter_window_length=127, sg_filter_order=3):
+    """hrf_filter_operator is the (nr_timepoints, nr_timepoints) matrix A of the temporal
+    part of CompressiveSpatialSummationModelFiltered: convolution with the hrf, truncated
+    to the length of the timecourse, followed by subtraction of the savitzky-golay
+    filtered signal. A.dot(response) equals the model timecourse of response
+    before scaling by beta and adding the baseline.
+    """
+    hrf = np.asarray(hrf, dtype=np.float64)
+    lags = np.arange(nr_timepoints)[:, np.newaxis] - np.arange(nr_timepoints)[np.newaxis, :]
+    convolution = np.where((lags >= 0) & (lags < hrf.shape[0]), hrf[np.clip(lags, 0, hrf.shape[0] - 1)], 0.0)
+
+    # the filter is linear, so its matrix is the filter applied to the columns of the identity
+    window_length = min(sg_filter_window_length, nr_timepoints - (1 - nr_timepoints % 2))
+    smoothing = savgol_filter(np.eye(nr_timepoints), window_length=window_length, polyorder=sg_filter_order,
+                              deriv=0, mode='nearest', axis=0)
+    return (np.eye(nr_timepoints) - smoothing).dot(convolution)
+
+
+def css_hrf_filter_operator(css_model, nr_timepoints):
+    """hrf_filter_operator with the hrf and filter settings of css_model."""
+    return hrf_filter_operator(nr_timepoints,
+                               css_model.hrf_model(css_model.hrf_delay, css_model.stimulus.tr_length),
+                               css_model.sg_filter_window_length,
+                               css_model.sg_filter_order)
+
+
+def deconvolution_operator(A, regularisation):
+    """deconvolution_operator is the Tikhonov-regularised inverse of A,
+    (A.T A + regularisation I)^-1 A.T, computed once through the SVD of A.
+
+    regularisation is relative to the largest squared singular value of A, so that
+    it does not depend on the scale of the hrf. The slow components removed by the
+    filter are not recoverable and are shrunk to zero.
+
+    Returns
+    -------
+    M : numpy.ndarray, (nr_timepoints, nr_timepoints)
+        deconvolved timecourses are data.dot(M.T), see deconvolve
+    """
+    U, s, Vt = np.linalg.svd(A)
+    filter_factors = s / (s**2 + regularisation * s[0]**2)
+    return (Vt.T * filter_factors).dot(U.T)
+
+
+def gcv_regularisation(A, data, regularisations=np.logspace(-6, 0, 25)):
+    """gcv_regularisation chooses the regularisation of deconvolution_operator
+    by generalised cross-validation, pooled over all voxels of data (n_voxels, nr_timepoints).
+
+    All candidates are evaluated from one SVD of A and one projection of the data.
+
+    Returns
+    -------
+    regularisation : float
+        the candidate with the lowest GCV score
+    scores : numpy.ndarray
+        GCV score of every candidate
+    """
+    U, s, Vt = np.linalg.svd(A)
+    projected = U.T.dot(data.T)**2
+    projected_power = projected.sum(axis=1)
+    outside_power = np.sum(data**2) - projected_power.sum()
+
+    scores = np.zeros(len(regularisations))
+    for i, regularisation in enumerate(regularisations):
+        filter_factors = s**2 / (s**2 + regularisation * s[0]**2)
+        residual_power = np.sum((1 - filter_factors)**2 * projected_power) + outside_power
+        scores[i] = A.shape[0] * residual_power / (A.shape[0] - filter_factors.sum())**2
+    return regularisations[np.argmin(scores)], scores
+
+
+def deconvolve(data, M, demean=True):
+    """deconvolve applies the deconvolution operator M to all timecourses of data
+    (n_voxels, nr_timepoints) with one matrix product.
+
+    With demean, the mean of every voxel, which the filter removes from the model,
+    is subtracted before and added back after deconvolution, so that baselines are kept.
+
+    Returns
+    -------
+    deconvolved : numpy.ndarray, (n_voxels, nr_timepoints)
+    """
+    if not demean:
+        return data.dot(M.T)
+    means = data.mean(axis=1)[:, np.newaxis]
+    return (data - means).dot(M.T) + means
@@ -0,0 +1,227 @@
+import os
+import subprocess
+
+import numpy as np
+
+# matplotlib, only used for the colour maps, and tables are imported where they are used.
+
+
+def colour_lut(cmap='viridis', n_colours=256):
+    """colour_lut samples a matplotlib colour map once, into a lookup table
+    from which frames are coloured by indexing.
+
+    Returns
+    -------
+    lut : numpy.ndarray, uint8, (n_colours, 3)
+        RGB values. 'gray' does not need matplotlib.
+    """
+    if cmap in ('gray', 'grey'):
+        return np.repeat(np.linspace(0, 255, n_colours).round().astype(np.uint8)[:, np.newaxis], 3, axis=1)
+    import matplotlib
+    colours = matplotlib.colormaps[cmap](np.linspace(0, 1, n_colours))[:, :3]
+    return (colours * 255).round().astype(np.uint8)
+
+
+def frame_limits(frames, percentile=None, chunk_size=64, n_samples=65536, seed=0):
+    """frame_limits is the colour range of all frames, computed once, in chunks of
+    chunk_size frames so that memory-mapped arrays are not loaded at once.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray
+        (n_frames, ...) frames
+    percentile : float
+        if given, the range between the percentile and 100-percentile of the
+        pixel values, which is robust to outliers, as the median over chunks of
+        the percentiles of a random subsample of n_samples values of every chunk.
+        Otherwise, the minimum and maximum of all values.
+    n_samples : int
+        pixel values per chunk the percentiles are computed from, None uses all
+    seed : int
+        seed of the subsampling
+
+    Returns
+    -------
+    clim : tuple
+        (lower, upper)
+    """
+    rng = np.random.RandomState(seed)
+    lower, upper = [], []
+    for start in range(0, frames.shape[0], chunk_size):
+        chunk = np.asarray(frames[start:start + chunk_size], dtype=np.float64)
+        if percentile is None:
+            lower.append(np.nanmin(chunk))
+            upper.append(np.nanmax(chunk))
+        else:
+            if n_samples is not None and chunk.size > n_samples:
+                chunk = chunk.ravel()[rng.choice(chunk.size, n_samples, replace=False)]
+            lower.append(np.nanpercentile(chunk, percentile))
+            upper.append(np.nanpercentile(chunk, 100 - percentile))
+    if percentile is None:
+        return np.min(lower), np.max(upper)
+    return np.median(lower), np.median(upper)
+
+
+def colour_frame(frame, clim, lut, scale=1):
+    """colour_frame maps a 2D frame to RGB through lut, with the colour range clim,
+    and enlarges it scale times by pixel repetition. NaNs get the lowest colour, and
+    so do all values up to clim[0] when the range is empty, with those above the highest.
+
+    Returns
+    -------
+    rgb : numpy.ndarray, uint8, (frame.shape[0]*scale, frame.shape[1]*scale, 3)
+    """
+    n_colours = lut.shape[0]
+    frame = np.asarray(frame, dtype=np.float64)
+    if clim[1] > clim[0]:
+        index = (frame - clim[0]) * ((n_colours - 1) / float(clim[1] - clim[0]))
+    else:
+        # e.g. the range of constant frames
+        index = np.where(frame > clim[0], n_colours - 1, 0.0)
+    index = np.clip(np.nan_to_num(index, nan=0.0), 0, n_colours - 1).astype(np.intp)
+    rgb = lut[index]
+    if scale > 1:
+        rgb = np.repeat(np.repeat(rgb, scale, axis=0), scale, axis=1)
+    return rgb
+
+
+class VideoWriter(object):
+    """VideoWriter streams RGB frames to ffmpeg through a pipe, one at a time,
+    so that memory use does not depend on the length of the video.
+
+    frame_shape is the (height, width) of the frames that will be written, which
+    are padded to even sizes as required by most codecs.
+    """
+
+    def __init__(self, filename, frame_shape, fps=10, codec='libx264', bitrate='1800k', ffmpeg='ffmpeg'):
+        super(VideoWriter, self).__init__()
+        self.frame_shape = tuple(frame_shape)
+        self.padded_shape = tuple(s + s % 2 for s in self.frame_shape)
+        command = [ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '%ix%i' % (self.padded_shape[1], self.padded_shape[0]),
+                   '-r', str(fps), '-i', '-',
+                   '-an', '-vcodec', codec, '-b:v', bitrate, '-pix_fmt', 'yuv420p',
+                   filename]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, rgb):
+        if rgb.shape[:2] != self.padded_shape:
+            rgb = np.pad(rgb, ((0, self.padded_shape[0] - rgb.shape[0]), (0, self.padded_shape[1] - rgb.shape[1]), (0, 0)), mode='edge')
+        self.process.stdin.write(np.ascontiguousarray(rgb, dtype=np.uint8).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError('ffmpeg exited with code %i' % self.process.returncode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ArrayWriter(object):
+    """ArrayWriter appends frames to an extendable, chunked array in an hdf5 file,
+    at their original values. Frames are buffered into chunks of chunk_size.
+    """
+
+    def __init__(self, filename, frame_shape, node_name='frames', chunk_size=64, complevel=1):
+        super(ArrayWriter, self).__init__()
+        import tables
+
+        self.h5file = tables.open_file(filename, mode='w')
+        self.array = self.h5file.create_earray('/', node_name,
+                                               atom=tables.Float32Atom(),
+                                               shape=(0,) + tuple(frame_shape),
+                                               chunkshape=(chunk_size,) + tuple(frame_shape),
+                                               filters=tables.Filters(complevel=complevel, complib='blosc') if complevel > 0 else None)
+        self.buffer = np.zeros((chunk_size,) + tuple(frame_shape), dtype=np.float32)
+        self.n_buffered = 0
+
+    def write(self, frame):
+        self.buffer[self.n_buffered] = frame
+        self.n_buffered += 1
+        if self.n_buffered == self.buffer.shape[0]:
+            self.flush()
+
+    def flush(self):
+        if self.n_buffered > 0:
+            self.array.append(self.buffer[:self.n_buffered])
+            self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.h5file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def export_frames(frames, filename, clim=None, cmap='viridis', scale=8, fps=10, codec='libx264', n_frames=None, **kwargs):
+    """export_frames writes decoded frames, such as decoded_image or dm_pixel_logl_ratio,
+    one at a time to a video (.mp4, .mkv, .avi, .mov) or a chunked array file (.h5).
+
+    The colour range and lookup table are computed before the first frame, and
+    frames are coloured by indexing, without matplotlib figures. Memory use does not
+    depend on the number of frames, so frames can be a memory-mapped array or a
+    generator of frames from real-time decoding.
+
+    Parameters
+    ----------
+    frames : numpy.ndarray or iterable
+        (n_frames, n_pix, n_pix) frames, or an iterable of (n_pix, n_pix) frames.
+        for (n_pix, n_pix, n_frames) arrays as in dec/test.py, pass frames.transpose(2, 0, 1).
+    filename : str
+        output file, its extension selects the writer
+    clim : tuple
+        (lower, upper) colour range of the video, required if frames is not an array.
+        Defaults to the range of all frames, see frame_limits.
+    cmap : str
+        matplotlib colour map of the video
+    scale : int
+        enlargement of the video frames by pixel repetition
+    fps : int
+        frame rate of the video
+    codec : str
+        ffmpeg video codec, e.g. 'libx264' or 'libx265' for hevc
+    n_frames : int
+        stop after this many frames
+    kwargs
+        passed to VideoWriter or ArrayWriter
+
+    Returns
+    -------
+    n_written : int
+        number of frames written
+    """
+    is_video = os.path.splitext(filename)[1].lower() in ('.mp4', '.mkv', '.avi', '.mov')
+    if is_video:
+        if clim is None:
+            if not hasattr(frames, 'shape'):
+                print('export_frames needs clim to stream frames from an iterable')
+                return None
+            clim = frame_limits(frames)
+        lut = colour_lut(cmap)
+
+    writer = None
+    n_written = 0
+    try:
+        for frame in frames:
+            if n_frames is not None and n_written >= n_frames:
+                break
+            if writer is None:
+                if is_video:
+                    writer = VideoWriter(filename, (frame.shape[0] * scale, frame.shape[1] * scale), fps=fps, codec=codec, **kwargs)
+                else:
+                    writer = ArrayWriter(filename, frame.shape, **kwargs)
+            writer.write(colour_frame(frame, clim, lut, scale) if is_video else frame)
+            n_written += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_written
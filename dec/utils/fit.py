@@ -1,6 +1,10 @@
+import time
+
 import numpy as np
 import scipy as sp
 
+from .kernels import quadratic_forms, quadratic_form_and_gradient
+
 
 
 #STEPS/REASONING FOR FAST FIRSTPASS DECODER FUNCTION
@@ -68,11 +72,8 @@ def firstpass_decoder_independent_channels( W,
             non_linear_predictor_independent_channels = mapping(non_linear_predictor_independent_channels, mapping_relation=mapping_relation, parameters=mapping_parameters)
             
         
-    # difference between bold response and linear predictor is residuals
-    resid=np.tile(bold,(non_linear_predictor_independent_channels.shape[1],1)).T-non_linear_predictor_independent_channels
-
-    # actual calculation here
-    log_likelihood_indep_Ws=const - 0.5 * (resid * omega_inv.dot(resid)).sum(0)
+    # actual calculation here, the residuals are the difference between bold response and each predictor
+    log_likelihood_indep_Ws=const - 0.5 * quadratic_forms(omega_inv, bold, non_linear_predictor_independent_channels)
     
     # all ll relative to 0, the empty screen
     baseline=log_likelihood_indep_Ws[0]
@@ -85,21 +86,59 @@ def firstpass_decoder_independent_channels( W,
     return firstpass_image_normalized
 
 
+############################################################################################################################################
+#   firstpass_decoder_independent_channels for many bold patterns at once.
+#   The quadratic form of each (bold, channel) residual is expanded as b'Ob - 2p'Ob + p'Op, with O omega_inv,
+#   so that all of them follow from two matrix products instead of one per timepoint.
+#   Takes as argument
+#   bolds: (n_voxels,n_timepoints) bold patterns to be decoded, e.g. test_data
+#   the other arguments as in firstpass_decoder_independent_channels
+#   returns
+#   firstpass_images_normalized: (n_features,n_timepoints) firstpass decoded results
+############################################################################################################################################
 
-def mapping(data, mapping_relation='linear', parameters=[]):
-    """ mapping converts the linear model W* through a given mapping.
-    mapping_relation indicates which type of transformation, 
-    parameters describe the parameters to be used for each voxel, or W element.
-    The parameters must be specified as a matrix of size (nr_voxels, nr_parameters)
-    Where nr_parameters is 1 for the power_law mapping and 2 for linear and cosine transformation
-    slightly counterintuitive notation thing: parameters0 defaults to 1 and parameters1 defaults to 0.
-    This ensures that if parameters are not specified, the transformation is just an identity. (And a warning is printed)
-    """
-   
-    if parameters == []:
-        print("Warning: the mapping parameters were not specified. Using default values.")
-        parameters = np.r_['1,2,0', np.ones(data.shape[0]), np.zeros(data.shape[0])]
-        
+def firstpass_decoder_independent_channels_batch(W,
+                                                 bolds,
+                                                 logdet,
+                                                 omega_inv,
+                                                 mapping_relation=None,
+                                                 mapping_parameters=[]):
+    if logdet[0]!=1.0:
+        print('Error: model covariance has negative or zero determinant')
+        return
+    const=-0.5*(logdet[1]+omega_inv.shape[0]*np.log(2*np.pi))
+
+    #1 extra column for empty screen baseline
+    predictors = np.zeros((W.shape[0], W.shape[1]+1))
+    predictors[:,1:] = W
+    predictors = _apply_mapping(predictors, mapping_relation, mapping_parameters)
+
+    omega_inv_bolds = omega_inv.dot(bolds)
+    forms = ((bolds * omega_inv_bolds).sum(0)[np.newaxis,:]
+             - 2 * predictors.T.dot(omega_inv_bolds)
+             + (predictors * omega_inv.dot(predictors)).sum(0)[:,np.newaxis])
+    log_likelihood_indep_Ws = const - 0.5 * forms
+
+    # all ll relative to 0, the empty screen
+    firstpass_images = log_likelihood_indep_Ws[0] / log_likelihood_indep_Ws[1:]
+    firstpass_min, firstpass_max = firstpass_images.min(0), firstpass_images.max(0)
+    return (firstpass_images - firstpass_min) / (firstpass_max - firstpass_min)
+
+
+def _apply_mapping(linear_predictor, mapping_relation=None, mapping_parameters=[]):
+    """ apply mapping_relation, one mapping or a list of them, as in the decoders."""
+    if mapping_relation != None:
+        if type(mapping_relation) == list:
+            for mr, mp in zip(mapping_relation, mapping_parameters):
+                linear_predictor = mapping(linear_predictor, mapping_relation=mr, parameters=mp)
+        else:
+            linear_predictor = mapping(linear_predictor, mapping_relation=mapping_relation, parameters=mapping_parameters)
+    return linear_predictor
+
+
+
+def _broadcast_mapping_parameters(data, parameters):
+    """per-voxel mapping parameters, broadcast to the shape of data. parameters1 is zero for 1-parameter mappings."""
     parameters0=np.ones(data.shape)
     parameters1=np.zeros(data.shape)
               
@@ -115,6 +154,61 @@ def mapping(data, mapping_relation='linear', parameters=[]):
             parameters1 = parameters[:,1]
         else:
             parameters0=parameters
+
+    return parameters0, parameters1
+
+
+def mapping_derivative(data, mapping_relation='linear', parameters=[]):
+    """ derivative of mapping with respect to data, with the same arguments as mapping."""
+    if np.size(parameters) == 0:
+        parameters = np.r_['1,2,0', np.ones(data.shape[0]), np.zeros(data.shape[0])]
+
+    parameters0, parameters1 = _broadcast_mapping_parameters(data, parameters)
+
+    if mapping_relation == 'linear':
+        return parameters0 * np.ones(data.shape)
+    elif mapping_relation == 'power_law':
+        # infinite at 0 for exponents below 1, e.g. at a blank stimulus, where the minimizers would stop on a NaN
+        # gradient. Evaluated just above 0 instead, the gradient is large but finite and a line search steps back.
+        return parameters0 * np.maximum(data, 1e-10) ** (parameters0 - 1)
+    elif mapping_relation == 'cosine':
+        return -parameters0*np.sin(data + parameters1)
+    elif mapping_relation == 'exponential':
+        return parameters0 * np.exp(parameters0 * data)
+    elif mapping_relation == 'log':
+        return 1.0 / data
+
+
+def mapped_predictor(linear_predictor, mapping_relation=None, mapping_parameters=[]):
+    """ apply mapping_relation (one mapping or a list of them) to the linear predictor W.dot(stimulus), as in the decoders.
+    returns the non linear predictor and its derivative with respect to the linear predictor (chain rule over the mappings)."""
+    non_linear_predictor = linear_predictor
+    derivative = np.ones(linear_predictor.shape)
+    if mapping_relation != None:
+        if type(mapping_relation) != list:
+            mapping_relation, mapping_parameters = [mapping_relation], [mapping_parameters]
+        for mr, mp in zip(mapping_relation, mapping_parameters):
+            derivative = derivative * mapping_derivative(non_linear_predictor, mapping_relation=mr, parameters=mp)
+            non_linear_predictor = mapping(non_linear_predictor, mapping_relation=mr, parameters=mp)
+
+    return non_linear_predictor, derivative
+
+
+def mapping(data, mapping_relation='linear', parameters=[]):
+    """ mapping converts the linear model W* through a given mapping.
+    mapping_relation indicates which type of transformation, 
+    parameters describe the parameters to be used for each voxel, or W element.
+    The parameters must be specified as a matrix of size (nr_voxels, nr_parameters)
+    Where nr_parameters is 1 for the power_law mapping and 2 for linear and cosine transformation
+    slightly counterintuitive notation thing: parameters0 defaults to 1 and parameters1 defaults to 0.
+    This ensures that if parameters are not specified, the transformation is just an identity. (And a warning is printed)
+    """
+   
+    if np.size(parameters) == 0:
+        print("Warning: the mapping parameters were not specified. Using default values.")
+        parameters = np.r_['1,2,0', np.ones(data.shape[0]), np.zeros(data.shape[0])]
+
+    parameters0, parameters1 = _broadcast_mapping_parameters(data, parameters)
         
     if mapping_relation == 'linear':
         return data * parameters0 + parameters1
@@ -143,6 +237,7 @@ def mapping(data, mapping_relation='linear', parameters=[]):
 #   mapping_relation: 'None', 'linear', 'power_law', 'cosine'. Or a list of these to be applied in sequence to the linear model,
 #   in the same fashion as was done in the model fitting procedure. Parameters must be provided for all these transformation.
 #   'linear' and 'cosine' require two parameters for each voxel. (slope and intercept for linear), (amplitude and phase for cosine)
+#   return_gradient: also return the gradient of -log_likelihood with respect to the stimulus
 #   returns            
 #   -log_likelihood of the hypothesized stimulus being produced by the observed bold signal (or viceversa)        
 ############################################################################################################################################
@@ -153,12 +248,18 @@ def calculate_bold_loglikelihood(   stimulus,
                                     logdet,                                    
                                     omega_inv,
                                     mapping_relation=None,
-                                    mapping_parameters=[]):
+                                    mapping_parameters=[],
+                                    return_gradient=False):
 
     const=-0.5*(logdet[1]+omega_inv.shape[0]*np.log(2*np.pi))
 
     linear_predictor = np.dot(W,stimulus)
 
+    if return_gradient:
+        non_linear_predictor, derivative = mapped_predictor(linear_predictor, mapping_relation, mapping_parameters)
+        form, omega_inv_resid = quadratic_form_and_gradient(omega_inv, bold - non_linear_predictor)
+        return -(const - 0.5 * form), -W.T.dot(derivative * omega_inv_resid)
+
     # possible mappings to implement nonlinear transformation
     if mapping_relation != None:
         if type(mapping_relation) == list:
@@ -172,19 +273,56 @@ def calculate_bold_loglikelihood(   stimulus,
     
     resid = bold - non_linear_predictor
 
-    log_likelihood = const - 0.5 * np.dot(resid, np.dot(omega_inv, resid))
+    log_likelihood = const - 0.5 * quadratic_form_and_gradient(omega_inv, resid)[0]
+
+    return -log_likelihood
+
+
+############################################################################################################################################
+#   calculate_bold_loglikelihood for many (stimulus, bold) pairs at once, with one matrix product for all quadratic forms.
+#   Takes as argument
+#   stimuli: (n_features,n_stimuli) stimuli
+#   bolds: (n_voxels,n_stimuli) bold signal of each stimulus, or (n_voxels,) for the same bold for all
+#   the other arguments as in calculate_bold_loglikelihood
+#   returns
+#   (n_stimuli,) -log_likelihood of every stimulus
+############################################################################################################################################
+
+def calculate_bold_loglikelihood_batch(stimuli,
+                                       W,
+                                       bolds,
+                                       logdet,
+                                       omega_inv,
+                                       mapping_relation=None,
+                                       mapping_parameters=[]):
+
+    const=-0.5*(logdet[1]+omega_inv.shape[0]*np.log(2*np.pi))
+
+    non_linear_predictors = _apply_mapping(np.dot(W,stimuli), mapping_relation, mapping_parameters)
+    if bolds.ndim == 1:
+        bolds = bolds[:,np.newaxis]
+    resid = bolds - non_linear_predictors
+
+    log_likelihood = const - 0.5 * (resid * omega_inv.dot(resid)).sum(0)
 
     return -log_likelihood
 
 #simple function using Python built-in minimizer to get a more accurate reconstruction
 #returns: optimized decoded stimulus and associated loglikelihood.    
+#with return_uncertainty, also the Laplace-approximation posterior standard deviation of each pixel (see posterior_standard_deviation)
+#analytic_gradient uses the gradient of calculate_bold_loglikelihood instead of finite differences, one evaluation
+#per iteration instead of one per pixel. The power law mapping has no finite gradient at zero linear predictor.
+#disp prints the convergence messages of the minimizer.
 def maximize_loglikelihood( starting_value,
                             W,                           
                             bold,
                             logdet,
                             omega_inv,                            
                             mapping_relation=None,
-                            mapping_parameters=[]):
+                            mapping_parameters=[],
+                            return_uncertainty=False,
+                            analytic_gradient=False,
+                            disp=True):
     bnds=[(0,1) for elem in starting_value]
 
     final_result=sp.optimize.minimize(
@@ -195,13 +333,396 @@ def maximize_loglikelihood( starting_value,
                                             logdet,
                                             omega_inv,                            
                                             mapping_relation,
-                                            mapping_parameters), 
+                                            mapping_parameters,
+                                            analytic_gradient), 
+                                    jac=analytic_gradient,
                                     method='L-BFGS-B', 
                                     bounds=bnds,
                                     tol=1e-02,
-                                    options={'disp':True})
+                                    options={'disp':disp})
     decoded_stimulus = final_result.x
     logl = -final_result.fun
+    if return_uncertainty:
+        posterior_sd = posterior_standard_deviation(decoded_stimulus, W, omega_inv, mapping_relation, mapping_parameters)
+        return logl, decoded_stimulus, posterior_sd
+    return logl, decoded_stimulus
+
+
+############################################################################################################################################
+#   Anytime version of maximize_loglikelihood, for decoding under a deadline (e.g. within one TR).
+#   The minimizer starts from starting_value (e.g. the firstpass image) and is stopped when time_budget seconds have
+#   passed or after max_iterations iterations, whichever comes first. Every stimulus the minimizer evaluates is within
+#   the bounds, so the best one evaluated so far is always a valid answer, and is returned when it is stopped.
+#   The time budget is checked at every evaluation of the likelihood: with finite differences there are n_pixels of
+#   those per iteration, so analytic_gradient, the default, keeps the overrun of the budget to a single evaluation.
+#   Takes as argument
+#   time_budget: seconds, None for no time limit
+#   max_iterations: maximum number of iterations, None for no limit
+#   tol: as in maximize_loglikelihood
+#   the other arguments as in maximize_loglikelihood
+#   returns
+#   logl: log-likelihood of the best stimulus found
+#   decoded_stimulus: (n_pixels,) best stimulus found
+#   converged: whether the minimizer converged within the budget
+############################################################################################################################################
+
+class _BudgetExhausted(Exception):
+    pass
+
+
+def maximize_loglikelihood_anytime(starting_value,
+                                   W,
+                                   bold,
+                                   logdet,
+                                   omega_inv,
+                                   mapping_relation=None,
+                                   mapping_parameters=[],
+                                   time_budget=None,
+                                   max_iterations=None,
+                                   analytic_gradient=True,
+                                   tol=1e-02):
+    deadline = None if time_budget is None else time.perf_counter() + time_budget
+    best = dict(fun=np.inf, x=np.clip(starting_value, 0, 1))
+
+    def objective(stimulus):
+        if deadline is not None and best['fun'] < np.inf and time.perf_counter() > deadline:
+            raise _BudgetExhausted()
+        result = calculate_bold_loglikelihood(stimulus, W, bold, logdet, omega_inv,
+                                              mapping_relation, mapping_parameters, analytic_gradient)
+        fun = result[0] if analytic_gradient else result
+        if fun < best['fun']:
+            best['fun'], best['x'] = fun, np.array(stimulus)
+        return result
+
+    options = {'disp':False}
+    if max_iterations is not None:
+        options['maxiter'] = max_iterations
+    try:
+        final_result=sp.optimize.minimize(
+                                        objective,
+                                        best['x'],
+                                        jac=analytic_gradient,
+                                        method='L-BFGS-B',
+                                        bounds=[(0,1) for elem in starting_value],
+                                        tol=tol,
+                                        options=options)
+        # not successful when stopped at max_iterations
+        converged = bool(final_result.success)
+    except _BudgetExhausted:
+        converged = False
+
+    return -best['fun'], best['x'], converged
+
+
+############################################################################################################################################
+#   Stimulus bases for decoding in basis coefficients instead of pixels, see maximize_loglikelihood_basis.
+#   Takes as argument
+#   W: (n_voxels,n_pixels) W matrix
+#   kind: 'pca', the leading right singular vectors of W, which span the pixel patterns the voxels are sensitive to,
+#   or 'gaussian', a dictionary of isotropic gaussians (peak 1) on a grid with spacing pixels between centers, within mask.
+#   n_components: number of pca components. None keeps those explaining variance of the squared singular values.
+#   mask: (n_pix,n_pix) pixel mask of the columns of W, needed for 'gaussian'
+#   returns
+#   basis: (n_pixels,n_components) basis, the stimulus is basis.dot(coefficients)
+############################################################################################################################################
+
+def stimulus_basis(W, kind='pca', n_components=None, variance=0.99, mask=None, spacing=2.0):
+    if kind == 'pca':
+        _, s, Vt = np.linalg.svd(W, full_matrices=False)
+        if n_components is None:
+            n_components = int(np.searchsorted(np.cumsum(s**2) / np.sum(s**2), variance) + 1)
+        return Vt[:n_components].T
+    elif kind == 'gaussian':
+        if mask is None:
+            print('Error: the gaussian basis needs the pixel mask')
+            return
+        pixels = np.array(np.nonzero(mask)).T
+        grid = np.arange(0, mask.shape[0], spacing)
+        centers = np.array(np.meshgrid(grid, grid, indexing='ij')).reshape((2, -1)).T
+        # only centers within reach of the mask
+        centers = centers[mask[np.clip(np.round(centers[:,0]).astype(int), 0, mask.shape[0]-1),
+                               np.clip(np.round(centers[:,1]).astype(int), 0, mask.shape[1]-1)]]
+        squared_distances = ((pixels[:, np.newaxis, :] - centers[np.newaxis, :, :])**2).sum(-1)
+        return np.exp(-squared_distances / (2 * spacing**2))
+    raise ValueError('unknown basis ' + str(kind))
+
+
+def uses_power_law(mapping_relation):
+    """whether mapping_relation, a single relation or a list of them, includes the power law."""
+    if type(mapping_relation) == list:
+        return 'power_law' in mapping_relation
+    return mapping_relation == 'power_law'
+
+
+############################################################################################################################################
+#   maximize_loglikelihood with the stimulus parameterised as basis.dot(coefficients).
+#   The likelihood only depends on the stimulus through W.dot(stimulus) = W.dot(basis).dot(coefficients), so the
+#   optimisation runs over n_components coefficients with W_basis = W.dot(basis), computed once per fold,
+#   instead of over all pixels. The pixel bounds (0,1) don't translate to bounds on the coefficients:
+#   nonnegative bases (e.g. 'gaussian') keep nonnegative coefficients, which keeps the power law mapping defined,
+#   others are unbounded. As their linear predictor can go negative, where the power law is not defined, bases
+#   with negative values (e.g. 'pca') raise a ValueError with a power law mapping. The decoded stimulus is clipped to (0,1).
+#   Takes as argument
+#   starting_value: (n_pixels,) starting stimulus, e.g. the firstpass image, projected onto the basis
+#   basis: (n_pixels,n_components) from stimulus_basis
+#   W_basis: W.dot(basis), computed here if not given
+#   the other arguments as in maximize_loglikelihood
+#   returns
+#   logl, decoded_stimulus (n_pixels,) (, coefficients)
+############################################################################################################################################
+
+def maximize_loglikelihood_basis(starting_value,
+                                 W,
+                                 bold,
+                                 logdet,
+                                 omega_inv,
+                                 basis,
+                                 mapping_relation=None,
+                                 mapping_parameters=[],
+                                 W_basis=None,
+                                 analytic_gradient=False,
+                                 return_coefficients=False,
+                                 disp=True):
+    nonnegative_basis = np.all(basis >= 0)
+    if not nonnegative_basis and uses_power_law(mapping_relation):
+        raise ValueError('a basis with negative values can give negative linear predictors, '
+                         'where the power law mapping is not defined; use a nonnegative basis such as gaussian')
+    if W_basis is None:
+        W_basis = W.dot(basis)
+
+    if nonnegative_basis:
+        starting_coefficients = sp.optimize.nnls(basis, starting_value)[0]
+        bnds = [(0,None) for elem in starting_coefficients]
+    else:
+        starting_coefficients = np.linalg.lstsq(basis, starting_value, rcond=None)[0]
+        bnds = None
+
+    final_result=sp.optimize.minimize(
+                                    calculate_bold_loglikelihood,
+                                    starting_coefficients,
+                                    args=(  W_basis,
+                                            bold,
+                                            logdet,
+                                            omega_inv,
+                                            mapping_relation,
+                                            mapping_parameters,
+                                            analytic_gradient),
+                                    jac=analytic_gradient,
+                                    method='L-BFGS-B',
+                                    bounds=bnds,
+                                    tol=1e-02,
+                                    options={'disp':disp})
+    coefficients = final_result.x
+    decoded_stimulus = np.clip(basis.dot(coefficients), 0, 1)
+    logl = -final_result.fun
+    if return_coefficients:
+        return logl, decoded_stimulus, coefficients
     return logl, decoded_stimulus
 
 
+############################################################################################################################################
+#   maximize_loglikelihood (or maximize_loglikelihood_basis, with basis) of all timepoints of a fold, in parallel.
+#   The solves of the timepoints are independent given omega, so they are split into chunks of chunk_size
+#   timepoints that run on n_jobs workers. Worker processes receive W, omega_inv and the mapping parameters once,
+#   when they start: with the fork start method (the default on linux) they share the arrays of this process
+#   without copying them, with spawn or forkserver they get one copy each. Every worker runs single-threaded BLAS
+#   (if threadpoolctl is installed), so that the workers don't oversubscribe the cores, and without the minimizer's
+#   console output. Forking is unsafe while other threads of this process hold locks (e.g. a prefetched thread
+#   reading hdf5 files), pass start_method 'forkserver' or 'spawn' then.
+#   The results don't depend on n_jobs or chunk_size, and are returned in timepoint order.
+#   Takes as argument
+#   starting_values: (n_pixels,n_timepoints) starting stimuli, e.g. the firstpass images
+#   bolds: (n_voxels,n_timepoints) observed bold patterns
+#   basis, W_basis: as in maximize_loglikelihood_basis, None decodes in pixels
+#   n_jobs: number of workers, 1 (the default) runs in this process, None uses all cores
+#   chunk_size: timepoints per task, by default a quarter of the timepoints per worker
+#   use_processes: run the workers in processes, otherwise in threads of this process, which share the arrays too
+#   but only run in parallel where numpy releases the GIL
+#   start_method: multiprocessing start method of the worker processes, None for the platform default
+#   the other arguments as in maximize_loglikelihood
+#   returns
+#   logls: (n_timepoints,)
+#   decoded_stimuli: (n_pixels,n_timepoints)
+############################################################################################################################################
+
+# the arrays of a maximize_loglikelihood_batch worker process, set once by _init_map_worker
+_map_worker_problem = None
+
+
+def _solve_map_chunk(problem, starting_values, bolds):
+    W, logdet, omega_inv, mapping_relation, mapping_parameters, basis, W_basis, analytic_gradient = problem
+    logls = np.zeros(bolds.shape[1])
+    decoded_stimuli = np.zeros(starting_values.shape)
+    for t in range(bolds.shape[1]):
+        if basis is None:
+            logls[t], decoded_stimuli[:,t] = maximize_loglikelihood(starting_values[:,t], W, bolds[:,t], logdet, omega_inv,
+                                                                    mapping_relation, mapping_parameters,
+                                                                    analytic_gradient=analytic_gradient, disp=False)
+        else:
+            logls[t], decoded_stimuli[:,t] = maximize_loglikelihood_basis(starting_values[:,t], W, bolds[:,t], logdet, omega_inv,
+                                                                          basis, mapping_relation, mapping_parameters, W_basis=W_basis,
+                                                                          analytic_gradient=analytic_gradient, disp=False)
+    return logls, decoded_stimuli
+
+
+def _init_map_worker(problem):
+    global _map_worker_problem
+    _map_worker_problem = problem
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(1)
+
+
+def _solve_map_chunk_in_worker(starting_values, bolds):
+    return _solve_map_chunk(_map_worker_problem, starting_values, bolds)
+
+
+def maximize_loglikelihood_batch(starting_values,
+                                 W,
+                                 bolds,
+                                 logdet,
+                                 omega_inv,
+                                 mapping_relation=None,
+                                 mapping_parameters=[],
+                                 basis=None,
+                                 W_basis=None,
+                                 analytic_gradient=False,
+                                 n_jobs=1,
+                                 chunk_size=None,
+                                 use_processes=True,
+                                 start_method=None):
+    import os
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    if basis is not None and W_basis is None:
+        W_basis = W.dot(basis)
+    problem = (W, logdet, omega_inv, mapping_relation, mapping_parameters, basis, W_basis, analytic_gradient)
+
+    n_timepoints = bolds.shape[1]
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, n_timepoints))
+    if chunk_size is None:
+        chunk_size = max(1, -(-n_timepoints // (4 * n_jobs)))
+    starts = range(0, n_timepoints, chunk_size)
+
+    if n_jobs == 1:
+        chunks = [_solve_map_chunk(problem, starting_values[:,start:start+chunk_size], bolds[:,start:start+chunk_size])
+                  for start in starts]
+    elif use_processes:
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context(start_method),
+                                 initializer=_init_map_worker, initargs=(problem,)) as executor:
+            chunks = list(executor.map(_solve_map_chunk_in_worker,
+                                       [starting_values[:,start:start+chunk_size] for start in starts],
+                                       [bolds[:,start:start+chunk_size] for start in starts]))
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            chunks = list(executor.map(lambda start: _solve_map_chunk(problem, starting_values[:,start:start+chunk_size],
+                                                                      bolds[:,start:start+chunk_size]),
+                                       starts))
+
+    logls = np.concatenate([chunk[0] for chunk in chunks])
+    decoded_stimuli = np.hstack([chunk[1] for chunk in chunks])
+    return logls, decoded_stimuli
+
+
+############################################################################################################################################
+#   Laplace approximation of the posterior around the MAP decoded stimulus.
+#   The (Gauss-Newton) Hessian of the negative log-likelihood with respect to the stimulus is
+#   H = W.T diag(g') omega_inv diag(g') W, with g' the derivative of the mapping at the linear predictor W.dot(stimulus).
+#   The posterior standard deviation of each pixel is the square root of the diagonal of H^-1.
+#   Takes as argument
+#   stimuli: (n_pixels,) MAP decoded stimulus, or (n_pixels,n_timepoints) for all timepoints of a fold at once
+#   W, omega_inv, mapping_relation, mapping_parameters: as in maximize_loglikelihood
+#   method: 'exact' forms H of one timepoint at a time as (g'W).T omega_inv (g'W), and takes the diagonal of H^-1
+#   from triangular solves with its cholesky factor. That holds a few (n_pixels,n_pixels) arrays in memory.
+#   'hutchinson' never forms H, estimating its inverse diagonal from n_probes random probe vectors, solved with
+#   conjugate gradients (i.e. Lanczos) using only products with W and omega_inv. Cheaper at high n_pixels.
+#   'auto' uses 'exact' when its arrays fit in memory_budget bytes, and 'hutchinson' otherwise.
+#   ridge: added to the diagonal of H, relative to its mean, as H is singular when there are more pixels than voxels.
+#   Where the mapping derivative is not finite (e.g. power law at zero input), the voxel is treated as uninformative.
+#   Pixels the voxels carry less information about than the ridge, e.g. those outside all receptive fields,
+#   have no meaningful standard deviation (only that of the ridge), and get NaN.
+#   returns
+#   posterior_sd: same shape as stimuli
+############################################################################################################################################
+
+def posterior_standard_deviation(stimuli,
+                                 W,
+                                 omega_inv,
+                                 mapping_relation=None,
+                                 mapping_parameters=[],
+                                 method='auto',
+                                 ridge=1e-6,
+                                 memory_budget=2**30,
+                                 n_probes=64,
+                                 cg_tol=1e-4,
+                                 cg_maxiter=200,
+                                 seed=0):
+    single_stimulus = stimuli.ndim == 1
+    stimuli = stimuli.reshape((stimuli.shape[0], -1))
+    n_voxels, n_pixels = W.shape
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _, derivatives = mapped_predictor(W.dot(stimuli), mapping_relation, mapping_parameters)
+    derivatives[~np.isfinite(derivatives)] = 0
+
+    # information of every pixel on its own, ignoring noise correlations, (n_timepoints,n_pixels).
+    # its mean per timepoint scales the ridge
+    omega_inv_diagonal = np.diag(omega_inv)
+    pixel_information = (derivatives**2 * omega_inv_diagonal[:, np.newaxis]).T.dot(W**2)
+    ridges = ridge * pixel_information.mean(axis=1) + np.finfo(float).tiny
+
+    if method == 'auto':
+        # H, its cholesky factor and inverse, and g'W and omega_inv.dot(g'W)
+        exact_bytes = 8 * (3 * n_pixels**2 + 2 * n_voxels * n_pixels)
+        method = 'exact' if exact_bytes <= memory_budget else 'hutchinson'
+
+    posterior_variance = np.zeros(stimuli.shape)
+    if method == 'exact':
+        identity = np.eye(n_pixels)
+        for t in range(stimuli.shape[1]):
+            gW = derivatives[:, t, np.newaxis] * W
+            H = gW.T.dot(omega_inv.dot(gW))
+            H[np.arange(n_pixels), np.arange(n_pixels)] += ridges[t]
+            L = sp.linalg.cholesky(H, lower=True, overwrite_a=True)
+            # diag(H^-1) = column sums of squares of L^-1
+            L_inv = sp.linalg.solve_triangular(L, identity, lower=True, overwrite_b=False)
+            posterior_variance[:, t] = (L_inv**2).sum(axis=0)
+
+    elif method == 'hutchinson':
+        rng = np.random.RandomState(seed)
+        for t in range(stimuli.shape[1]):
+            g = derivatives[:, t, np.newaxis]
+
+            def H_dot(V):
+                return W.T.dot(g * omega_inv.dot(g * W.dot(V))) + ridges[t] * V
+
+            # rademacher probes, all solved simultaneously with conjugate gradients
+            Z = rng.choice([-1.0, 1.0], size=(n_pixels, n_probes))
+            X = np.zeros(Z.shape)
+            R = Z.copy()
+            P = R.copy()
+            rs = (R * R).sum(axis=0)
+            for iteration in range(cg_maxiter):
+                HP = H_dot(P)
+                alpha = rs / (P * HP).sum(axis=0)
+                X += alpha * P
+                R -= alpha * HP
+                rs_new = (R * R).sum(axis=0)
+                if np.sqrt(rs_new.max()) < cg_tol * np.sqrt(n_pixels):
+                    break
+                P = R + (rs_new / rs) * P
+                rs = rs_new
+            posterior_variance[:, t] = np.clip((Z * X).mean(axis=1), 0, None)
+    else:
+        raise ValueError('unknown method ' + str(method))
+
+    posterior_variance[(pixel_information <= ridges[:, np.newaxis]).T] = np.nan
+    posterior_sd = np.sqrt(posterior_variance)
+    if single_stimulus:
+        return posterior_sd[:, 0]
+    return posterior_sd
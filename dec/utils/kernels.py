@@ -0,0 +1,132 @@
+import importlib.util
+
+import numpy as np
+
+# numba is optional: without it, or with USE_NUMBA off, the same quantities are computed
+# with numpy, in chunks of columns so that temporaries stay bounded. numba itself is only
+# imported, and the kernels compiled, the first time they are used.
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
+# whether use_numba=None uses the compiled kernels. They avoid temporaries of the size of
+# predictors, but per core the blocked matrix products of numpy's BLAS are faster, so they are off by default.
+USE_NUMBA = False
+
+# predictors per pass over omega_inv in the compiled quadratic_forms
+NUMBA_BLOCK_SIZE = 64
+
+# the compiled kernels, built by _numba_kernels
+_kernels = None
+
+
+def _numba_kernels():
+    """(quadratic_forms, quadratic_form_and_gradient) compiled with numba, built on first use."""
+    global _kernels
+    if _kernels is not None:
+        return _kernels
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_quadratic_forms(omega_inv, bold, predictors, block_size):
+        # blocks of block_size residuals share every pass over omega_inv
+        n_voxels, n_predictors = predictors.shape
+        forms = np.empty(n_predictors)
+        n_blocks = (n_predictors + block_size - 1) // block_size
+        for block in numba.prange(n_blocks):
+            start = block * block_size
+            stop = min(start + block_size, n_predictors)
+            resid = np.empty((n_voxels, stop - start))
+            for i in range(n_voxels):
+                for j in range(stop - start):
+                    resid[i, j] = bold[i] - predictors[i, start + j]
+            form = np.zeros(stop - start)
+            row = np.empty(stop - start)
+            for i in range(n_voxels):
+                row[:] = 0.0
+                for k in range(n_voxels):
+                    omega_inv_ik = omega_inv[i, k]
+                    for j in range(stop - start):
+                        row[j] += omega_inv_ik * resid[k, j]
+                for j in range(stop - start):
+                    form[j] += resid[i, j] * row[j]
+            forms[start:stop] = form
+        return forms
+
+    @numba.njit(parallel=True, cache=True)
+    def numba_quadratic_form_and_gradient(omega_inv, resid):
+        n_voxels = resid.shape[0]
+        omega_inv_resid = np.empty(n_voxels)
+        for i in numba.prange(n_voxels):
+            row = 0.0
+            for k in range(n_voxels):
+                row += omega_inv[i, k] * resid[k]
+            omega_inv_resid[i] = row
+        form = 0.0
+        for i in range(n_voxels):
+            form += resid[i] * omega_inv_resid[i]
+        return form, omega_inv_resid
+
+    _kernels = (numba_quadratic_forms, numba_quadratic_form_and_gradient)
+    return _kernels
+
+
+def _use_numba(use_numba):
+    if use_numba is None:
+        use_numba = USE_NUMBA
+    if use_numba and not HAVE_NUMBA:
+        print('Warning: numba is not installed, using numpy.')
+        return False
+    return use_numba
+
+
+def quadratic_forms(omega_inv, bold, predictors, use_numba=None, chunk_size=256):
+    """quadratic_forms computes (bold - p).T omega_inv (bold - p) for every column p
+    of predictors, the exponent of the likelihood of each independent channel in
+    firstpass_decoder_independent_channels, without tiling bold to the size of predictors.
+
+    Parameters
+    ----------
+    omega_inv : numpy.ndarray
+        (n_voxels, n_voxels) inverse of the model omega
+    bold : numpy.ndarray
+        (n_voxels,) observed bold pattern
+    predictors : numpy.ndarray
+        (n_voxels, n_predictors) predicted bold patterns
+    use_numba : bool
+        use the compiled kernel, which holds NUMBA_BLOCK_SIZE residuals per thread.
+        None follows USE_NUMBA.
+    chunk_size : int
+        columns at a time in the numpy version, which bounds its temporaries
+
+    Returns
+    -------
+    forms : numpy.ndarray, (n_predictors,)
+    """
+    if _use_numba(use_numba):
+        return _numba_kernels()[0](np.ascontiguousarray(omega_inv, dtype=np.float64),
+                                   np.ascontiguousarray(bold, dtype=np.float64),
+                                   np.ascontiguousarray(predictors, dtype=np.float64),
+                                   NUMBA_BLOCK_SIZE)
+
+    forms = np.zeros(predictors.shape[1])
+    for start in range(0, predictors.shape[1], chunk_size):
+        resid = bold[:, np.newaxis] - predictors[:, start:start + chunk_size]
+        forms[start:start + chunk_size] = (resid * omega_inv.dot(resid)).sum(0)
+    return forms
+
+
+def quadratic_form_and_gradient(omega_inv, resid, use_numba=None):
+    """quadratic_form_and_gradient computes resid.T omega_inv resid, as in
+    calculate_bold_loglikelihood, and omega_inv.dot(resid), half its gradient with respect to resid.
+    use_numba is as in quadratic_forms.
+
+    Returns
+    -------
+    form : float
+    omega_inv_resid : numpy.ndarray, (n_voxels,)
+    """
+    if _use_numba(use_numba):
+        return _numba_kernels()[1](np.ascontiguousarray(omega_inv, dtype=np.float64),
+                                   np.ascontiguousarray(resid, dtype=np.float64))
+
+    omega_inv_resid = omega_inv.dot(resid)
+    return resid.dot(omega_inv_resid), omega_inv_resid
@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+
+from .utils import roi_data_from_hdf, roi_data_from_cache, create_visual_designmatrix_all, get_figshare_data
+
+# tables, popeye and hrf_estimation are imported where they are used.
+
+
+def run_views(single_run_data, n_folds):
+    """run_views splits concatenated single-run data (n_voxels, n_folds*nr_TRs),
+    as in the 'psc' group of the hdf5 file, into runs, without copying.
+
+    Returns
+    -------
+    runs : numpy.ndarray, (n_voxels, n_folds, nr_TRs)
+        a view of single_run_data
+    """
+    return single_run_data.reshape((single_run_data.shape[0], n_folds, -1))
+
+
+def loo_medians(runs):
+    """loo_medians computes the median over all runs but one, for every left out run.
+
+    The runs are sorted once; the median of the remaining runs is then read from
+    the sorted runs at positions that depend only on the rank of the left out run.
+
+    Parameters
+    ----------
+    runs : numpy.ndarray
+        (n_voxels, n_folds, nr_TRs), see run_views
+
+    Returns
+    -------
+    medians : numpy.ndarray, (n_voxels, n_folds, nr_TRs)
+        medians[:, k] is the median over the runs other than k
+    """
+    n_folds = runs.shape[1]
+    order = np.argsort(runs, axis=1, kind='stable')
+    sorted_runs = np.take_along_axis(runs, order, axis=1)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(n_folds)[np.newaxis, :, np.newaxis] * np.ones_like(order), axis=1)
+
+    # positions of the median in the n_folds-1 remaining runs, shifted past the left out rank
+    lower, upper = (n_folds - 2) // 2, (n_folds - 1) // 2
+    lower = lower + (ranks <= lower)
+    upper = upper + (ranks <= upper)
+    return 0.5 * (np.take_along_axis(sorted_runs, lower, axis=1) + np.take_along_axis(sorted_runs, upper, axis=1))
+
+
+def loo_css_residuals(css_model, runs, prf_data, out=None):
+    """loo_css_residuals computes, for every fold, the residuals of the concatenated
+    training runs (all runs but the fold's, in order) from the CSS prediction of the
+    fold's pRF parameters.
+
+    The predictions of all voxels and folds are computed together with
+    generate_predictions, and the training runs are read through views of runs,
+    without np.delete copies.
+
+    Parameters
+    ----------
+    css_model : CompressiveSpatialSummationModelFiltered
+        model of the design of n_folds-1 concatenated runs, see setup_css_model
+    runs : numpy.ndarray
+        (n_voxels, n_folds, nr_TRs), see run_views
+    prf_data : numpy.ndarray
+        (n_voxels, n_folds, nr_prf_parameters) per-fold pRF parameters
+    out : numpy.ndarray
+        optional (n_folds, n_voxels, (n_folds-1)*nr_TRs) output array
+
+    Returns
+    -------
+    residuals : numpy.ndarray, (n_folds, n_voxels, (n_folds-1)*nr_TRs)
+        residuals[k] are the training residuals of fold k, as all_residuals_css of setup_data_from_h5
+    """
+    n_voxels, n_folds, nr_TRs = runs.shape
+    parameters = np.asarray(prf_data[:, :, :6], dtype=np.float64).reshape((-1, 6))
+    predictions = css_model.generate_predictions(*parameters.T).reshape((n_voxels, n_folds, -1))
+
+    if out is None:
+        out = np.zeros((n_folds, n_voxels, (n_folds - 1) * nr_TRs))
+    for k in range(n_folds):
+        # runs before and after the left out run
+        out[k, :, :k * nr_TRs] = runs[:, :k].reshape((n_voxels, -1)) - predictions[:, k, :k * nr_TRs]
+        out[k, :, k * nr_TRs:] = runs[:, k + 1:].reshape((n_voxels, -1)) - predictions[:, k, k * nr_TRs:]
+    return out
+
+
+def write_loo_data(output_file, data_file, n_pix, mask_name='V1', n_folds=6, screen_distance=225, screen_width=69.0, TR=0.945,
+                   rsq_threshold=None, chunk_size=256, use_cache=True, complevel=1):
+    """write_loo_data builds the leave-one-out data of an ROI from its single-run psc
+    data and per-fold pRFs, and streams it to chunked arrays in output_file, in one
+    pass over chunks of chunk_size voxels.
+
+    Written to the group /<mask_name>:
+        loo_median : (n_voxels, n_folds, nr_TRs) median over the other runs, see loo_medians
+        loo_residuals_css : (n_folds, n_voxels, (n_folds-1)*nr_TRs) training residuals, see loo_css_residuals
+        voxels : indices of the voxels into the ROI
+
+    Parameters
+    ----------
+    output_file : str
+        hdf5 file to write, which is created if needed. An existing group of the ROI is replaced.
+    data_file, n_pix, mask_name, n_folds, screen_distance, screen_width, TR :
+        as in setup_data_from_h5
+    rsq_threshold : float
+        only voxels with a crossvalidated rsq above it, None for all voxels
+    """
+    import tables
+    from .prf import setup_css_model, crossvalidated_rsq
+
+    hdf5_file = get_figshare_data(data_file)
+    if use_cache:
+        load_roi_data = roi_data_from_cache
+    else:
+        def load_roi_data(*args):
+            return roi_data_from_hdf(*args).astype(np.float64)
+
+    single_run_data = load_roi_data(['*psc'], mask_name, hdf5_file, 'psc')
+    all_prf_data = load_roi_data(['*all'], mask_name, hdf5_file, 'all_prf')
+    prf_data = load_roi_data(['*all'], mask_name, hdf5_file, 'prf').reshape((all_prf_data.shape[0], -1, all_prf_data.shape[-1]))
+
+    voxels = np.arange(single_run_data.shape[0])
+    if rsq_threshold is not None:
+        voxels = voxels[crossvalidated_rsq(prf_data) > rsq_threshold]
+
+    runs = run_views(single_run_data, n_folds)
+    nr_TRs = runs.shape[-1]
+    css_model = setup_css_model(np.tile(create_visual_designmatrix_all(n_pixels=n_pix), (1, 1, n_folds - 1)),
+                                screen_distance, screen_width, TR)
+
+    filters = tables.Filters(complevel=complevel, complib='blosc') if complevel > 0 else None
+    chunk = min(chunk_size, max(len(voxels), 1))
+    with tables.open_file(output_file, mode='a') as h5file:
+        if '/' + mask_name in h5file:
+            h5file.remove_node('/', mask_name, recursive=True)
+        group = h5file.create_group('/', mask_name)
+        h5file.create_array(group, 'voxels', voxels)
+        medians = h5file.create_carray(group, 'loo_median', atom=tables.Float64Atom(),
+                                       shape=(len(voxels), n_folds, nr_TRs),
+                                       chunkshape=(chunk, 1, nr_TRs), filters=filters)
+        residuals = h5file.create_carray(group, 'loo_residuals_css', atom=tables.Float64Atom(),
+                                         shape=(n_folds, len(voxels), (n_folds - 1) * nr_TRs),
+                                         chunkshape=(1, chunk, (n_folds - 1) * nr_TRs), filters=filters)
+
+        for start in range(0, len(voxels), chunk_size):
+            chunk_voxels = voxels[start:start + chunk_size]
+            chunk_runs = runs[chunk_voxels]
+            medians[start:start + len(chunk_voxels)] = loo_medians(chunk_runs)
+            residuals[:, start:start + len(chunk_voxels)] = loo_css_residuals(css_model, chunk_runs, prf_data[chunk_voxels])
+
+    return output_file
@@ -0,0 +1,130 @@
+import numpy as np
+
+# all functions take (n_timepoints, ...) arrays of decoded and presented frames,
+# for instance recon from decode_cv_prfs, or create_visual_designmatrix_all frames
+# with the time axis moved to the front. mask is a boolean array of the shape of
+# a frame, selecting the pixels to compare, e.g. the mask from setup_data_from_h5.
+
+
+def _frames(images, mask=None):
+    """(n_timepoints, n_pixels) view of images, restricted to mask."""
+    images = np.asarray(images, dtype=np.float64)
+    frames = images.reshape((images.shape[0], -1))
+    if mask is not None:
+        frames = frames[:, np.ravel(mask)]
+    return frames
+
+
+def _normalised(frames):
+    """frames centered and scaled to unit norm, so that their dot products are
+    correlations. Constant frames (e.g. blanks) become NaN."""
+    centered = frames - frames.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt(np.sum(centered**2, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return centered / norm[:, np.newaxis]
+
+
+def _lag_pairs(n_timepoints, lag):
+    """indices of the decoded and presented frames compared at lag, where decoded
+    frame t+lag is compared with presented frame t. Unlike np.roll, frames shifted
+    past either end are dropped instead of wrapped around."""
+    presented = np.arange(max(0, -lag), min(n_timepoints, n_timepoints - lag))
+    return presented + lag, presented
+
+
+def frame_correlation(decoded, presented, mask=None, lag=0):
+    """frame_correlation is the correlation across pixels between every decoded
+    frame and the frame presented lag timepoints earlier, the hemodynamic delay.
+
+    Returns
+    -------
+    correlation : numpy.ndarray, (n_timepoints - abs(lag),)
+        per presented timepoint, NaN for constant frames as with np.corrcoef
+    """
+    decoded_index, presented_index = _lag_pairs(decoded.shape[0], lag)
+    return np.sum(_normalised(_frames(decoded, mask)[decoded_index])
+                  * _normalised(_frames(presented, mask)[presented_index]), axis=1)
+
+
+def masked_rmse(decoded, presented, mask=None, lag=0):
+    """masked_rmse is the root mean squared difference of the pixels in mask
+    between every decoded frame and the frame presented lag timepoints earlier.
+
+    Returns
+    -------
+    rmse : numpy.ndarray, (n_timepoints - abs(lag),)
+    """
+    decoded_index, presented_index = _lag_pairs(decoded.shape[0], lag)
+    return np.sqrt(np.mean((_frames(decoded, mask)[decoded_index]
+                            - _frames(presented, mask)[presented_index])**2, axis=1))
+
+
+def decoding_metrics(decoded, presented, mask=None, lags=np.arange(-8, 9), lag=None):
+    """decoding_metrics computes all reconstruction quality measures at once.
+
+    Both sets of frames are normalised once, and a single product of the two
+    (n_timepoints, n_pixels) arrays gives the correlation of every decoded with
+    every presented frame. Per-timepoint correlations at every lag are diagonals
+    of that matrix, and identification compares each diagonal element with its row.
+
+    Parameters
+    ----------
+    decoded : numpy.ndarray
+        (n_timepoints, ...) decoded frames
+    presented : numpy.ndarray
+        (n_timepoints, ...) presented frames, of the same shape
+    mask : numpy.ndarray, bool
+        pixels to compare, of the shape of a frame
+    lags : array_like
+        hemodynamic delays in timepoints to scan, decoded frame t+lag is
+        compared with presented frame t
+    lag : int
+        delay at which correlation, identification and rmse are reported,
+        None takes the lag with the highest mean correlation
+
+    Returns
+    -------
+    metrics : dict
+        lags : the scanned lags
+        lag_correlation : mean frame correlation at every lag
+        lag : the lag of the measures below
+        correlation : frame correlation per presented timepoint
+        identification : per presented timepoint, the fraction of the other
+            (non-constant) presented frames that correlate less with its decoded
+            frame than it does itself, ties counting half. 0.5 is chance.
+        rmse : masked rmse per presented timepoint
+    """
+    decoded_frames = _frames(decoded, mask)
+    presented_frames = _frames(presented, mask)
+    n_timepoints = decoded_frames.shape[0]
+
+    # correlation[i, j] of decoded frame i and presented frame j
+    correlation = _normalised(decoded_frames).dot(_normalised(presented_frames).T)
+
+    lags = np.asarray(lags)
+    with np.errstate(invalid='ignore'):
+        lag_correlation = np.array([np.nanmean(np.diagonal(correlation, offset=-l)) if abs(l) < n_timepoints else np.nan
+                                    for l in lags])
+    if lag is None:
+        lag = int(lags[np.nanargmax(lag_correlation)])
+
+    decoded_index, presented_index = _lag_pairs(n_timepoints, lag)
+    matched = correlation[decoded_index, presented_index]
+
+    # identification among the presented frames that have a defined correlation
+    rows = correlation[decoded_index]
+    valid = ~np.isnan(rows)
+    n_others = np.sum(valid, axis=1) - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        identification = (np.sum(rows < matched[:, np.newaxis], axis=1)
+                          + 0.5 * (np.sum(rows == matched[:, np.newaxis], axis=1) - 1)) / n_others
+    identification[np.isnan(matched)] = np.nan
+
+    rmse = np.sqrt(np.mean((decoded_frames[decoded_index] - presented_frames[presented_index])**2, axis=1))
+
+    return dict(lags=lags,
+                lag_correlation=lag_correlation,
+                lag=lag,
+                correlation=matched,
+                identification=identification,
+                rmse=rmse)
@@ -1,6 +1,9 @@
 import numpy as np
 import scipy as sp
-from scipy.sparse.linalg import arpack
+from scipy import sparse
+from scipy.linalg import solve_triangular
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 ############################################################################################################################################
 #   Defining the function to fit residual covariance and model covariance following van Bergen et al. 2015
@@ -11,25 +14,108 @@ from scipy.sparse.linalg import arpack
 #   between the model and the data.
 #   WWT: that is W.dot(W.T) where W is the n_voxel * n_features matrix obtained in previous model fitting procedure
 #   D: voxels by voxels distance matrix in some chosen matrix. Must be a distance so all positive values and zeroes on the diagonal.
+#   D can be a scipy.sparse matrix (see voxel_distance_matrix), in which case only its non-zero entries enter omega.
+#   The fit uses the analytic gradient of the squared distance, which exploits that sparsity.
 #   infile: load a vector of rho, sigma and tau parameters (which define omega) from a previous saved omega calculation
+#   x0: warm start from the parameter vector (alpha, rho, sigma, taus) of a previous fit, for instance of the previous fold.
+#   if x0_voxels and voxels (indices of the voxels of x0 and of this fit) are given, taus are mapped between the voxel sets,
+#   and voxels that are new get the square root of their observed variance as initial tau.
+#   a warm start skips the multi-start search and only runs the refinement, for at most warm_start_maxiter iterations.
+#   return_parameters: also return the fitted parameter vector, to warm start a next fit.
+#   W: the n_voxel * n_features W matrix itself. Without D, the fit then uses that omega is diagonal plus low rank: an evaluation of
+#   the distance costs a single product of the observed covariance with tau instead of forming omega, and omega is inverted by woodbury.
+#   WWT may then be None.
+#   check_inputs: check that D and the observed covariance are suitable, with a cholesky factorisation each.
 #   returns
-#   
+#   estimated_tau_matrix, estimated_rho, estimated_sigma, estimated_alpha, model_omega, model_omega_inv, logdet (, x)
 ############################################################################################################################################
 
 
-def fit_model_omega(observed_residual_covariance, WWT, D=None, infile=None, outfile=None, verbose=0):
-    if D!=None:
-        if not isPSD(D, tol = 1e-3):
+def fit_model_omega(observed_residual_covariance, WWT, D=None, infile=None, outfile=None, verbose=0,
+                    x0=None, x0_voxels=None, voxels=None, warm_start_maxiter=1000, return_parameters=False,
+                    W=None, check_inputs=True):
+    if not check_inputs:
+        pass
+    elif D is not None:
+        if sparse.issparse(D):
+            # a thresholded or k-nearest-neighbour distance matrix is not PSD, only check it is a distance
+            D = sparse.csr_matrix(D)
+            if D.shape != observed_residual_covariance.shape or (D.data < 0).any() or D.diagonal().any() or abs(D - D.T).max() > 1e-8:
+                print("Please check the distance matrix provided. It appears to not be suitable.")
+                return None
+        elif not isPSD(D, tol = 1e-3):
             print("Please check the distance matrix provided. It appears to not be suitable.")
             return None
     
-    if not isPSD(observed_residual_covariance, tol = 1e-3):
+    if check_inputs and not isPSD(observed_residual_covariance, tol = 1e-3):
         print("Please check the residual covaricne matrix provided. It appears to not be a suitable covariance matrix.")
         return None
     
+    if WWT is None and W is None:
+        print("Please provide WWT or W.")
+        return None
+    if WWT is None and D is not None:
+        WWT = W.dot(W.T)
+
+    if x0 is not None and x0_voxels is not None and voxels is not None:
+        x0 = map_omega_parameters(x0, x0_voxels, voxels, observed_residual_covariance)
+    x = _fit_omega_parameters(observed_residual_covariance, WWT, D, x0=x0, infile=infile, verbose=verbose,
+                              warm_start_maxiter=warm_start_maxiter, W=W)
+
+    #extract model covariance parameters and build omega
+    estimated_tau_matrix=np.outer(x[3:],x[3:])
+    estimated_alpha=x[0]
+    estimated_rho=x[1]
+    estimated_sigma=x[2]
+    
+    if D is None and W is not None:
+        # diagonal plus low rank, positive semi-definite by construction
+        diagonal, U = likelihood_omega_factors(x, W)
+        model_omega = U.dot(U.T)
+        model_omega[np.diag_indices_from(model_omega)] += diagonal
+        model_omega_inv, logdet = woodbury_inverse(diagonal, U)
+    else:
+        model_omega=_model_omega(x, WWT, D)
+        # the cholesky factor checks omega and gives its inverse and determinant
+        try:
+            factor = sp.linalg.cho_factor(model_omega, lower=True)
+        except np.linalg.LinAlgError:
+            print("The fit model omega appears to not be a suitable covariance matrix.")
+            return None
+        model_omega_inv = sp.linalg.cho_solve(factor, np.eye(model_omega.shape[0]))
+        logdet = (1.0, 2 * np.sum(np.log(np.diag(factor[0]))))
+
+    if outfile is not None:
+        np.save(outfile,x)
+
+    if verbose > 0:
+        #print some details about omega for inspection and save
+        print("max tau: "+str(np.max(x[3:]))+" min tau: "+str(np.min(x[3:])))
+        print("sigma: "+str(estimated_sigma)+" rho: "+str(estimated_rho)+" alpha: "+str(estimated_alpha))
+        #How good is the result?
+        print("summed squared distance: "+str(np.sum(np.square(observed_residual_covariance-model_omega))))
+        #Some sanity checks. 
+        #Notice that determinants of data covariance and model covariance are extremely small, need to take log to make them manageable
+        #print(np.linalg.slogdet(all_residual_covariance_css))
+        #print(np.linalg.slogdet(model_omega))
+    
+    #The first test-optimization of parameters was done with a very rough 0.01 precision (distance ~7*10^5)
+    #0.001 precision increased computational time and reduced distance (now ~6*10^5)
+    #on server: ~3.9*10^5
+
+    if return_parameters:
+        return estimated_tau_matrix, estimated_rho, estimated_sigma, estimated_alpha, model_omega, model_omega_inv, logdet, x
+    return estimated_tau_matrix, estimated_rho, estimated_sigma, estimated_alpha, model_omega, model_omega_inv, logdet
+
+
+def _fit_omega_parameters(observed_residual_covariance, WWT, D=None, x0=None, infile=None, verbose=0, warm_start_maxiter=1000, W=None):
+    """the fit of fit_model_omega, returns the parameter vector (alpha, rho, sigma, taus) without building omega."""
+    warm_start = x0 is not None
+    if warm_start:
+        x0 = np.asarray(x0, dtype=np.float64).reshape((-1, 1))
    # or if possible load the result of the previous minimization
-    if infile != None:
-        x0=np.load(infile)
+    elif infile != None:
+        x0=np.load(infile).reshape((-1, 1))
         initial_guesses = 1
     else:   # initial guesses around Van Bergen values
         initial_guesses = 2
@@ -44,99 +130,519 @@ def fit_model_omega(observed_residual_covariance, WWT, D=None, infile=None, outf
     
     #suitable boundaries determined experimenally    
     bnds = [(-500,500) for xs in x0[:,0]]
-    if D==None:
+    if D is None:
         bnds[0]=(0,0)
         
     bnds[1]=(0,1)
     bnds[2]=(0,500)
     
-    def f(x, residual_covariance, WWT, Distance):
-        alpha=x[0]
-        rho=x[1]
-        sigma=x[2]
-        #tried to use the all_residual_covariance as tau_matrix: optimization fails (maybe use it as initial values for search. tried & failed)
-        #tried to use stimulus_covariance as WWT: search was interrupted as it becomes several order of magnitudes slower.
-        tau_matrix = np.outer(x[3:],x[3:])
-        
-        unique_variance = np.eye(tau_matrix.shape[0]) * (1-rho) * tau_matrix
-        shared_variance = tau_matrix * rho
-        
-        
-        if Distance==None:
-            omega = shared_variance + unique_variance + (sigma**2) * WWT
-        else:
-            distance_variance = alpha * Distance * tau_matrix
-            omega = distance_variance + shared_variance + unique_variance + (sigma**2) * WWT
-        
-        return np.sum(np.square(residual_covariance - omega))
+    #tried to use the all_residual_covariance as tau_matrix: optimization fails (maybe use it as initial values for search. tried & failed)
+    #tried to use stimulus_covariance as WWT: search was interrupted as it becomes several order of magnitudes slower.
+    if D is None and W is not None:
+        f = _low_rank_omega_distance_and_gradient
+        arguments = (observed_residual_covariance, W, _low_rank_distance_terms(observed_residual_covariance, W))
+    else:
+        f = _omega_distance_and_gradient
+        arguments = (observed_residual_covariance, WWT, D)
     
     #minimize distance between model covariance and observed covariance
     #This routine allows computation starting from multiple different initial conditions, in an attempt to avoid local minima
-    best_fun=0
-    for k in range(x0.shape[1]):
-        result=sp.optimize.minimize(f, 
-                                    x0[:,k], 
-                                    args=(observed_residual_covariance, WWT,D), 
-                                    method='L-BFGS-B', 
-                                    bounds=bnds,
-                                    tol=1e-02,
-                                    options={'disp':True})
-        if k==0:
-            best_fun=result.fun
-            best_result=result
-        if result.fun <= best_fun:
-            best_fun=result.fun
-            best_result=result
+    #a warm start is already close, and goes straight to the refinement
+    if warm_start:
+        best_result={'x': x0[:,0]}
+        refine_options={'disp':verbose > 0,'maxiter': warm_start_maxiter, 'maxfun': 15000000, 'factr': 10}
+    else:
+        best_fun=0
+        for k in range(x0.shape[1]):
+            result=sp.optimize.minimize(f, 
+                                        x0[:,k], 
+                                        args=arguments, 
+                                        method='L-BFGS-B', 
+                                        bounds=bnds,
+                                        jac=True,
+                                        tol=1e-02,
+                                        options={'disp':True})
+            if k==0:
+                best_fun=result.fun
+                best_result=result
+            if result.fun <= best_fun:
+                best_fun=result.fun
+                best_result=result
+        refine_options={'disp':True,'maxfun': 15000000, 'factr': 10}
             
     better_result=sp.optimize.minimize(f, 
                                        best_result['x'], 
-                                       args=(observed_residual_covariance, WWT,D), 
+                                       args=arguments, 
                                        method='L-BFGS-B', 
                                        bounds=bnds, 
+                                       jac=True,
                                        tol=1e-06, 
-                                       options={'disp':True,'maxfun': 15000000, 'factr': 10})
-    
-    #extract model covariance parameters and build omega
-    x=better_result.x
-    estimated_tau_matrix=np.outer(x[3:],x[3:])
-    estimated_alpha=x[0]
-    estimated_rho=x[1]
-    estimated_sigma=x[2]
+                                       options=refine_options)
     
-    if D==None:
-        model_omega=estimated_rho*estimated_tau_matrix+(1-estimated_rho)*np.multiply(np.identity(estimated_tau_matrix.shape[0]),estimated_tau_matrix)+(estimated_sigma**2)*WWT
+    return better_result.x
+
+
+def _model_omega(x, WWT, Distance=None):
+    """model omega for a fit_model_omega parameter vector x. a sparse Distance only adds its non-zero entries."""
+    alpha, rho, sigma, tau = x[0], x[1], x[2], x[3:]
+
+    omega = rho * np.outer(tau, tau) + (sigma**2) * WWT
+    omega[np.diag_indices_from(omega)] += (1-rho) * tau**2
+    if sparse.issparse(Distance):
+        distance = Distance.tocoo()
+        omega[distance.row, distance.col] += alpha * distance.data * tau[distance.row] * tau[distance.col]
+    elif Distance is not None:
+        omega += alpha * Distance * np.outer(tau, tau)
+    return omega
+
+
+def _omega_distance_and_gradient(x, residual_covariance, WWT, Distance=None):
+    """summed squared distance between residual_covariance and the model omega, and its gradient with respect to x."""
+    alpha, rho, sigma, tau = x[0], x[1], x[2], x[3:]
+
+    E = residual_covariance - _model_omega(x, WWT, Distance)
+    E_tau = E.dot(tau)
+    E_diagonal = np.diag(E)
+
+    gradient = np.zeros(x.shape)
+    gradient[1] = -2 * (tau.dot(E_tau) - np.sum(E_diagonal * tau**2))
+    gradient[2] = -4 * sigma * np.sum(E * WWT)
+    gradient[3:] = -4 * (rho * E_tau + (1-rho) * E_diagonal * tau)
+
+    if Distance is not None:
+        # (Distance * E).dot(tau), on the non-zero entries only for a sparse Distance
+        if sparse.issparse(Distance):
+            distance = Distance.tocoo()
+            weighted = distance.data * E[distance.row, distance.col]
+            DE_tau = np.bincount(distance.row, weights=weighted * tau[distance.col], minlength=tau.shape[0])
+        else:
+            DE_tau = (Distance * E).dot(tau)
+        gradient[0] = -2 * tau.dot(DE_tau)
+        gradient[3:] -= 4 * alpha * DE_tau
+
+    return np.sum(np.square(E)), gradient
+
+
+def _low_rank_distance_terms(residual_covariance, W):
+    """the terms of the summed squared distance that do not change during the fit, see _low_rank_omega_distance_and_gradient."""
+    gram = W.T.dot(W)
+    return dict(covariance_norm=np.sum(np.square(residual_covariance)),
+                covariance_diagonal=np.diag(residual_covariance).copy(),
+                covariance_W=np.sum(W * residual_covariance.dot(W)),
+                W_rows=np.sum(W**2, axis=1),
+                gram_norm=np.sum(np.square(gram)))
+
+
+def _low_rank_omega_distance_and_gradient(x, residual_covariance, W, terms):
+    """_omega_distance_and_gradient without a distance term, for WWT = W.dot(W.T), without forming the model omega.
+
+    The model is diag(d) + U U.T with d = (1-rho) tau**2 and U = [sqrt(rho) tau, sigma W], so that
+    |C - omega|^2 = |C|^2 - 2 <C, omega> + |U.T U|^2 + 2 sum_i d_i |u_i|^2 + |d|^2, where |U.T U|^2 only
+    needs the (n_pixels,n_pixels) W.T W and <C, omega> needs C tau and the constant <C, W W.T>. Apart
+    from C tau, every evaluation is O(n_voxels n_pixels)."""
+    rho, sigma, tau = x[1], x[2], x[3:]
+    d = (1-rho) * tau**2
+
+    C_tau = residual_covariance.dot(tau)
+    tau_tau = tau.dot(tau)
+    WT_tau = W.T.dot(tau)
+    WT_tau_norm = WT_tau.dot(WT_tau)
+    U_rows = rho * tau**2 + sigma**2 * terms['W_rows']
+
+    covariance_model = rho * tau.dot(C_tau) + sigma**2 * terms['covariance_W'] + terms['covariance_diagonal'].dot(d)
+    model_norm = (rho**2 * tau_tau**2 + 2 * rho * sigma**2 * WT_tau_norm + sigma**4 * terms['gram_norm']
+                  + 2 * d.dot(U_rows) + d.dot(d))
+    distance = terms['covariance_norm'] - 2 * covariance_model + model_norm
+
+    # E tau, diag(E) and <E, W W.T> of E = C - omega
+    E_tau = C_tau - rho * tau_tau * tau - sigma**2 * W.dot(WT_tau) - d * tau
+    E_diagonal = terms['covariance_diagonal'] - U_rows - d
+    E_WWT = terms['covariance_W'] - rho * WT_tau_norm - sigma**2 * terms['gram_norm'] - d.dot(terms['W_rows'])
+
+    gradient = np.zeros(x.shape)
+    gradient[1] = -2 * (tau.dot(E_tau) - np.sum(E_diagonal * tau**2))
+    gradient[2] = -4 * sigma * E_WWT
+    gradient[3:] = -4 * (rho * E_tau + (1-rho) * E_diagonal * tau)
+    return distance, gradient
+
+
+############################################################################################################################################
+#   Sparse voxel distance matrix for the distance term of fit_model_omega, from voxel coordinates.
+#   Only distances up to max_distance, and/or to the n_neighbours nearest voxels of every voxel, are kept.
+#   Takes as argument
+#   coordinates: (n_voxels,n_dimensions) voxel coordinates, e.g. in mm
+#   returns
+#   (n_voxels,n_voxels) symmetric scipy.sparse csr matrix, with zero diagonal
+############################################################################################################################################
+
+def voxel_distance_matrix(coordinates, max_distance=None, n_neighbours=None):
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(coordinates)
+    n_voxels = coordinates.shape[0]
+    if n_neighbours is not None:
+        # the nearest neighbour of every voxel is itself
+        distances, neighbours = tree.query(coordinates, k=n_neighbours + 1,
+                                           distance_upper_bound=np.inf if max_distance is None else max_distance)
+        distances, neighbours = distances[:, 1:], neighbours[:, 1:]
+        valid = np.isfinite(distances)
+        rows = np.repeat(np.arange(n_voxels), n_neighbours)[valid.ravel()]
+        D = sparse.coo_matrix((distances[valid], (rows, neighbours[valid])), shape=(n_voxels, n_voxels)).tocsr()
+        # symmetric: keep the pair if either voxel is among the neighbours of the other
+        D = D.maximum(D.T)
+    elif max_distance is not None:
+        D = tree.sparse_distance_matrix(tree, max_distance, output_type='coo_matrix').tocsr()
     else:
-        model_omega=estimated_alpha*D*estimated_tau_matrix + estimated_rho*estimated_tau_matrix+(1-estimated_rho)*np.multiply(np.identity(estimated_tau_matrix.shape[0]),estimated_tau_matrix)+(estimated_sigma**2)*WWT
-    
-    model_omega_inv = np.linalg.inv(model_omega)
-    logdet = np.linalg.slogdet(model_omega)
-    
-    if not isPSD(model_omega, tol = 1e-3):
-        print("The fit model omega appears to not be a suitable covariance matrix.")
-        return None
+        raise ValueError('specify max_distance and/or n_neighbours')
 
-    if outfile != None:
-        np.save(outfile,x)
+    D.setdiag(0)
+    D.eliminate_zeros()
+    return D
 
-    if verbose > 0:
-        #print some details about omega for inspection and save
-        print("max tau: "+str(np.max(x[3:]))+" min tau: "+str(np.min(x[3:])))
-        print("sigma: "+str(estimated_sigma)+" rho: "+str(estimated_rho)+" alpha: "+str(estimated_alpha))
-        #How good is the result?
-        print("summed squared distance: "+str(np.sum(np.square(observed_residual_covariance-model_omega))))
-        #Some sanity checks. 
-        #Notice that determinants of data covariance and model covariance are extremely small, need to take log to make them manageable
-        #print(np.linalg.slogdet(all_residual_covariance_css))
-        #print(np.linalg.slogdet(model_omega))
-    
-    #The first test-optimization of parameters was done with a very rough 0.01 precision (distance ~7*10^5)
-    #0.001 precision increased computational time and reduced distance (now ~6*10^5)
-    #on server: ~3.9*10^5
 
-    return estimated_tau_matrix, estimated_rho, estimated_sigma, estimated_alpha, model_omega, model_omega_inv, logdet
+def map_omega_parameters(x, from_voxels, to_voxels, observed_residual_covariance=None):
+    """map a fit_model_omega parameter vector (alpha, rho, sigma, taus of from_voxels) to the voxels to_voxels.
+    taus of voxels that are not in from_voxels are set to the square root of their observed variance, or 0.5.
+    """
+    mapped = np.zeros(len(to_voxels) + 3)
+    mapped[:3] = x[:3]
+    if observed_residual_covariance is not None:
+        mapped[3:] = np.sqrt(np.diag(observed_residual_covariance))
+    else:
+        mapped[3:] = 0.5
+    _, from_index, to_index = np.intersect1d(from_voxels, to_voxels, return_indices=True)
+    mapped[3 + to_index] = x[3 + from_index]
+    return mapped
 
 #function for some sanity checks within the omega estimation procedure
 
 def isPSD(A, tol = 1e-8):
-    vals = np.linalg.eigvalsh(A) # return the ends of spectrum of A
-    return np.all(vals > -tol)
\ No newline at end of file
+    # A + tol*I has a cholesky factor when no eigenvalue of A is below -tol, several times cheaper than the eigenvalues
+    try:
+        np.linalg.cholesky(A + tol * np.eye(A.shape[0]))
+    except np.linalg.LinAlgError:
+        return False
+    return True
+
+
+############################################################################################################################################
+#   Omega models of the form diag(diagonal) + U.dot(U.T), where U has far fewer columns than there are voxels.
+#   The van Bergen model is of this form: the unique variance is diagonal, the shared variance is the rank-one tau*tau.T
+#   and the feature-space variance is sigma**2 * W.dot(W.T), with W having only n_pixels columns.
+#   Inverse and log-determinant then follow from the Woodbury identity and the matrix determinant lemma,
+#   at O(n_voxels**2 * k) instead of O(n_voxels**3).
+#   Takes as argument
+#   diagonal: (n_voxels,) diagonal part of omega. Must be positive.
+#   U: (n_voxels,k) low-rank factor of omega.
+#   returns
+#   omega_inv and logdet in the same format as np.linalg.slogdet, as used by the decoders.
+############################################################################################################################################
+
+def woodbury_inverse(diagonal, U):
+    if np.any(diagonal <= 0):
+        # woodbury needs an invertible diagonal, fall back to the dense computation
+        omega = np.diag(diagonal) + U.dot(U.T)
+        return np.linalg.inv(omega), np.linalg.slogdet(omega)
+
+    Dinv_U = U / diagonal[:, np.newaxis]
+    core_chol = np.linalg.cholesky(np.eye(U.shape[1]) + U.T.dot(Dinv_U))
+    # A.T.dot(A) = D^-1 U (I + U.T D^-1 U)^-1 U.T D^-1
+    A = solve_triangular(core_chol, Dinv_U.T, lower=True)
+
+    omega_inv = -A.T.dot(A)
+    omega_inv[np.diag_indices_from(omega_inv)] += 1.0 / diagonal
+    logdet = (1.0, np.sum(np.log(diagonal)) + 2 * np.sum(np.log(np.diag(core_chol))))
+
+    return omega_inv, logdet
+
+
+def woodbury_solve(diagonal, U, X):
+    """omega^-1 X for omega = diag(diagonal) + U U.T, without forming omega or its inverse."""
+    Dinv_X = X / diagonal.reshape((-1,) + (1,) * (X.ndim - 1))
+    Dinv_U = U / diagonal[:, np.newaxis]
+    core = np.eye(U.shape[1]) + U.T.dot(Dinv_U)
+    return Dinv_X - Dinv_U.dot(np.linalg.solve(core, U.T.dot(Dinv_X)))
+
+
+############################################################################################################################################
+#   Fit the van Bergen omega by maximising the Gaussian likelihood of the residual timecourses, instead of
+#   the summed squared distance to their covariance as in fit_model_omega.
+#   omega = diag((1-rho)*tau**2) + U.dot(U.T) with U = [sqrt(rho)*tau, sigma*W], so the negative log-likelihood
+#   and its analytic gradient follow from woodbury and the determinant lemma, in O(n_voxels*n_timepoints*n_pixels),
+#   without ever forming an (n_voxels,n_voxels) matrix. This scales to many more voxels than fit_model_omega.
+#   Takes as argument
+#   residuals: (n_voxels,n_timepoints) residual timecourses, e.g. all_residuals_css from setup_data_from_h5
+#   W: (n_voxels,n_pixels) W matrix
+#   x0: initial (alpha, rho, sigma, taus) as in fit_model_omega, e.g. of a previous fold. alpha is not fit and ignored.
+#   dense: if False, model_omega is returned as its (diagonal, U) factors and model_omega_inv as None,
+#   for use with woodbury_solve. Otherwise they are formed, at O(n_voxels**2*n_pixels).
+#   returns
+#   estimated_tau, estimated_rho, estimated_sigma, model_omega, model_omega_inv, logdet (, x)
+############################################################################################################################################
+
+def fit_model_omega_likelihood(residuals, W, x0=None, dense=True, verbose=0, maxiter=15000, return_parameters=False):
+    residuals = residuals - residuals.mean(axis=1)[:, np.newaxis]
+
+    if x0 is None:
+        x0 = np.zeros(residuals.shape[0]+3)
+        x0[1] = 0.2 # rho
+        x0[2] = 7.5 # sigma
+        x0[3:] = residuals.std(axis=1)
+    x0 = np.array(x0, dtype=np.float64)
+    x0[0] = 0.0
+    x0[1] = np.clip(x0[1], 1e-6, 1 - 1e-6)
+    x0[3:] = np.clip(np.abs(x0[3:]), 1e-6, None)
+
+    # no distance term; rho away from 0 and 1 and tau from 0 keep the diagonal and U well defined
+    bnds = [(0,0), (1e-6, 1 - 1e-6), (0,500)] + [(1e-6, None)] * residuals.shape[0]
+
+    result = sp.optimize.minimize(_negative_loglikelihood_and_gradient,
+                                  x0,
+                                  args=(residuals, W),
+                                  method='L-BFGS-B',
+                                  jac=True,
+                                  bounds=bnds,
+                                  options={'disp': verbose > 0, 'maxiter': maxiter})
+    x = result.x
+    estimated_rho, estimated_sigma, estimated_tau = x[1], x[2], x[3:]
+
+    diagonal, U = likelihood_omega_factors(x, W)
+    if dense:
+        model_omega = U.dot(U.T)
+        model_omega[np.diag_indices_from(model_omega)] += diagonal
+        model_omega_inv, logdet = woodbury_inverse(diagonal, U)
+    else:
+        model_omega = (diagonal, U)
+        model_omega_inv = None
+        core_chol = np.linalg.cholesky(np.eye(U.shape[1]) + U.T.dot(U / diagonal[:, np.newaxis]))
+        logdet = (1.0, np.sum(np.log(diagonal)) + 2 * np.sum(np.log(np.diag(core_chol))))
+
+    if verbose > 0:
+        print("max tau: "+str(np.max(estimated_tau))+" min tau: "+str(np.min(estimated_tau)))
+        print("sigma: "+str(estimated_sigma)+" rho: "+str(estimated_rho))
+        print("negative log-likelihood per timepoint: "+str(result.fun))
+
+    if return_parameters:
+        return estimated_tau, estimated_rho, estimated_sigma, model_omega, model_omega_inv, logdet, x
+    return estimated_tau, estimated_rho, estimated_sigma, model_omega, model_omega_inv, logdet
+
+
+def likelihood_omega_factors(x, W):
+    """diagonal and U of the omega of a fit_model_omega parameter vector x (without distance term)."""
+    rho, sigma, tau = x[1], x[2], x[3:]
+    diagonal = (1-rho) * tau**2
+    U = np.hstack([np.sqrt(rho) * tau[:, np.newaxis], sigma * W])
+    return diagonal, U
+
+
+def _negative_loglikelihood_and_gradient(x, residuals, W):
+    """negative log-likelihood of the (mean-centered) residuals per timepoint, up to a constant, and its gradient."""
+    rho, sigma, tau = x[1], x[2], x[3:]
+
+    diagonal, U = likelihood_omega_factors(x, W)
+    nll, G_diagonal, G_U = _woodbury_negative_loglikelihood(residuals, diagonal, U)
+
+    gradient = np.zeros(x.shape)
+    gradient[1] = -0.5 * np.sum(G_diagonal * tau**2) + np.sum(G_U[:, 0] * tau) / (2 * np.sqrt(rho))
+    gradient[2] = np.sum(G_U[:, 1:] * W)
+    gradient[3:] = G_diagonal * (1-rho) * tau + G_U[:, 0] * np.sqrt(rho)
+
+    return nll, gradient
+
+
+def _woodbury_negative_loglikelihood(residuals, diagonal, U):
+    """negative log-likelihood per timepoint of residuals under omega = diag(diagonal) + U U.T, and its
+    gradients with respect to diagonal and U, by woodbury."""
+    n_timepoints = residuals.shape[1]
+
+    Dinv_U = U / diagonal[:, np.newaxis]
+    core_chol = np.linalg.cholesky(np.eye(U.shape[1]) + U.T.dot(Dinv_U))
+
+    def core_solve(B):
+        return solve_triangular(core_chol, solve_triangular(core_chol, B, lower=True), lower=True, trans='T')
+
+    # Y = omega^-1 residuals, Z = omega^-1 U, by woodbury
+    Dinv_R = residuals / diagonal[:, np.newaxis]
+    Y = Dinv_R - Dinv_U.dot(core_solve(U.T.dot(Dinv_R)))
+    Z = core_solve(Dinv_U.T).T
+
+    logdet = np.sum(np.log(diagonal)) + 2 * np.sum(np.log(np.diag(core_chol)))
+    nll = 0.5 * (logdet + np.sum(residuals * Y) / n_timepoints)
+
+    # with G = omega^-1 - omega^-1 S omega^-1 / n_timepoints, the gradient with respect to
+    # the diagonal is diag(G)/2 and with respect to U it is G.dot(U)
+    G_diagonal = 1.0 / diagonal - np.sum(Z * Dinv_U, axis=1) - np.sum(Y**2, axis=1) / n_timepoints
+    G_U = Z - Y.dot(residuals.T.dot(Z)) / n_timepoints
+
+    return nll, G_diagonal, G_U
+
+
+############################################################################################################################################
+#   Omega for multiple ROIs decoded jointly.
+#   Each ROI r has its own unique and shared variance (tau_r, rho_r), so that part of omega is block diagonal.
+#   The feature-space term is shared across ROIs: the rows of W are scaled by the sigma of their ROI,
+#   giving sigma_r * sigma_s * W_r.dot(W_s.T) for the block between ROIs r and s.
+#   Each ROI block adds a single rank-one column to U, so the whole omega is diagonal plus rank (n_rois + n_pixels).
+#   Takes as argument
+#   taus: (n_voxels,) tau per voxel
+#   rhos, sigmas: (n_rois,) rho and sigma per ROI
+#   W: (n_voxels,n_pixels) W matrix of all ROIs stacked
+#   roi_labels: (n_voxels,) index of the ROI (0...n_rois-1) each voxel belongs to
+#   returns
+#   diagonal, U, to be used in woodbury_inverse/woodbury_solve
+############################################################################################################################################
+
+def multi_roi_omega_factors(taus, rhos, sigmas, W, roi_labels):
+    n_rois = len(rhos)
+    diagonal = np.zeros(W.shape[0])
+    U = np.zeros((W.shape[0], n_rois + W.shape[1]))
+    for r in range(n_rois):
+        roi_voxels = roi_labels == r
+        diagonal[roi_voxels] = (1 - rhos[r]) * taus[roi_voxels]**2
+        U[roi_voxels, r] = np.sqrt(rhos[r]) * taus[roi_voxels]
+    U[:, n_rois:] = np.abs(np.asarray(sigmas))[roi_labels, np.newaxis] * W
+
+    return diagonal, U
+
+
+def _fit_roi_block(args):
+    omega_fit, data, W, x0, verbose = args
+    if omega_fit == 'likelihood':
+        return fit_model_omega_likelihood(data, W, x0=x0, dense=False, verbose=verbose, return_parameters=True)[-1]
+    if not isPSD(data, tol = 1e-3):
+        return None
+    return _fit_omega_parameters(data, None, x0=x0, verbose=verbose, W=W)
+
+
+def _cross_roi_sigma_distance(sigmas, A, Q):
+    """summed squared distance of the model omega to the observed covariance as a function of the
+    per-ROI sigmas, up to a constant, and its gradient. See _fit_cross_roi_sigmas."""
+    squared = sigmas**2
+    distance = -2 * sigmas.dot(A).dot(sigmas) + squared.dot(Q).dot(squared)
+    gradient = -4 * A.dot(sigmas) + 4 * sigmas * Q.dot(squared)
+    return distance, gradient
+
+
+def _fit_cross_roi_sigmas(observed_residual_covariance, W, blocks, taus, rhos, sigmas):
+    """refits the per-ROI sigmas to the whole observed covariance, including the blocks between ROIs,
+    with the taus and rhos of the per-ROI fits fixed.
+
+    With G_rs = W_r W_s.T and B the block diagonal tau part of omega, the distance is
+    sum_rs |C_rs - B_rs - sigma_r sigma_s G_rs|^2, which is, up to a constant,
+    -2 sigma.T A sigma + (sigma**2).T Q sigma**2 with A_rs = <C_rs - B_rs, G_rs> and
+    Q_rs = |G_rs|^2 = <W_r.T W_r, W_s.T W_s>, so that only (n_pixels,n_pixels) products are formed."""
+    n_rois = len(blocks)
+    A, Q = np.zeros((n_rois, n_rois)), np.zeros((n_rois, n_rois))
+    grams = [W[b].T.dot(W[b]) for b in blocks]
+    for q, b_q in enumerate(blocks):
+        CW_q = observed_residual_covariance[:, b_q].dot(W[b_q])
+        for r, b_r in enumerate(blocks):
+            A[r, q] = np.sum(W[b_r] * CW_q[b_r])
+            Q[r, q] = np.sum(grams[r] * grams[q])
+    for r, b in enumerate(blocks):
+        tau = taus[b]
+        A[r, r] -= rhos[r] * np.sum(np.square(W[b].T.dot(tau))) + (1 - rhos[r]) * np.sum(tau**2 * np.sum(W[b]**2, axis=1))
+
+    # sigma = 0 is stationary, ROIs whose own fit gave 0 start from the optimum of their own block
+    x0 = np.abs(np.asarray(sigmas, dtype=np.float64))
+    x0[x0 == 0] = np.sqrt(np.clip(np.diag(A) / np.diag(Q), 0, None))[x0 == 0]
+    result = sp.optimize.minimize(_cross_roi_sigma_distance, x0, args=(A, Q), method='L-BFGS-B',
+                                  jac=True, bounds=[(0, 500)] * n_rois)
+    return result.x
+
+
+def _cross_roi_sigma_loglikelihood(sigmas, residuals, W, roi_labels, taus, rhos):
+    """negative log-likelihood of the residuals of all ROIs as a function of the per-ROI sigmas, and its gradient."""
+    diagonal, U = multi_roi_omega_factors(taus, rhos, sigmas, W, roi_labels)
+    nll, _, G_U = _woodbury_negative_loglikelihood(residuals, diagonal, U)
+    gradient = np.bincount(roi_labels, weights=np.sum(G_U[:, len(rhos):] * W, axis=1), minlength=len(rhos))
+    return nll, gradient
+
+
+############################################################################################################################################
+#   Fit a block-structured omega for multiple ROIs.
+#   The per-ROI parameters are fitted in parallel on the data of every ROI, with fit_model_omega on the diagonal blocks of the
+#   observed covariance or with fit_model_omega_likelihood on the residual timecourses, so the cost grows with the sum of
+#   squared ROI sizes instead of the square of the total number of voxels. The per-ROI sigmas, which also set the blocks
+#   between ROIs, are then refitted to all ROIs together with the taus and rhos fixed. omega is only formed as its
+#   woodbury factors (see multi_roi_omega_factors) to invert it.
+#   There is no distance term: it would make the blocks of omega full rank.
+#   Takes as argument
+#   observed_residual_covariance: (n_voxels,n_voxels) observed covariance of the residuals of all ROIs stacked
+#   W: (n_voxels,n_pixels) W matrix of all ROIs stacked
+#   roi_labels: (n_voxels,) index of the ROI (0...n_rois-1) each voxel belongs to
+#   n_jobs: number of worker processes, None uses all cores
+#   residuals: (n_voxels,n_timepoints) residual timecourses of all ROIs stacked, needed for omega_fit 'likelihood'
+#   omega_fit: 'covariance' fits as fit_model_omega, 'likelihood' as fit_model_omega_likelihood
+#   x0: warm start from the list of per-ROI parameter vectors of a previous fit, as returned with return_parameters
+#   start_method: multiprocessing start method of the worker processes, None uses the default
+#   return_parameters: also return the per-ROI parameter vectors (alpha, rho, sigma, taus), to warm start a next fit
+#   returns
+#   estimated_taus (per voxel), estimated_rhos, estimated_sigmas (per ROI), model_omega, model_omega_inv, logdet (, parameters)
+############################################################################################################################################
+
+def fit_model_omega_multi_roi(observed_residual_covariance, W, roi_labels, n_jobs=None, verbose=0, residuals=None,
+                              omega_fit='covariance', x0=None, D=None, start_method=None, return_parameters=False):
+    if D is not None:
+        raise ValueError('the distance term is not supported for multiple ROIs, it would make omega full rank')
+    if omega_fit not in ('covariance', 'likelihood'):
+        raise ValueError('unknown omega_fit ' + str(omega_fit))
+    if omega_fit == 'likelihood':
+        if residuals is None:
+            raise ValueError("omega_fit 'likelihood' needs the residuals")
+        residuals = residuals - residuals.mean(axis=1)[:, np.newaxis]
+
+    n_rois = roi_labels.max() + 1
+    blocks = [np.where(roi_labels == r)[0] for r in range(n_rois)]
+    if x0 is None:
+        x0 = [None] * n_rois
+    block_data = [residuals[b] if omega_fit == 'likelihood' else observed_residual_covariance[np.ix_(b, b)] for b in blocks]
+
+    mp_context = None if start_method is None else multiprocessing.get_context(start_method)
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as executor:
+        block_fits = list(executor.map(_fit_roi_block,
+                                       [(omega_fit, data, W[b], block_x0, verbose) for data, b, block_x0 in zip(block_data, blocks, x0)]))
+
+    if any(block_fit is None for block_fit in block_fits):
+        print("The omega fit failed for at least one of the ROIs.")
+        return None
+
+    estimated_taus = np.zeros(W.shape[0])
+    for b, block_fit in zip(blocks, block_fits):
+        # signed, as in the rho*tau_i*tau_j terms each block fit minimised
+        estimated_taus[b] = block_fit[3:]
+    estimated_rhos = np.array([block_fit[1] for block_fit in block_fits])
+    estimated_sigmas = np.array([block_fit[2] for block_fit in block_fits])
+
+    # the sigmas of all ROIs together, which the per-ROI fits cannot see
+    if omega_fit == 'likelihood':
+        # sigma = 0 is stationary, ROIs whose own fit gave 0 start from the optimum of the covariance of their block
+        x0_sigmas = np.abs(estimated_sigmas)
+        for r in np.where(x0_sigmas == 0)[0]:
+            b, tau = blocks[r], estimated_taus[blocks[r]]
+            a = (np.sum(np.square(residuals[b].T.dot(W[b]))) / residuals.shape[1]
+                 - estimated_rhos[r] * np.sum(np.square(W[b].T.dot(tau))) - (1 - estimated_rhos[r]) * np.sum(tau**2 * np.sum(W[b]**2, axis=1)))
+            x0_sigmas[r] = np.sqrt(max(a, 0) / np.sum(np.square(W[b].T.dot(W[b]))))
+        estimated_sigmas = sp.optimize.minimize(_cross_roi_sigma_loglikelihood, x0_sigmas,
+                                                args=(residuals, W, roi_labels, estimated_taus, estimated_rhos),
+                                                method='L-BFGS-B', jac=True, bounds=[(0, 500)] * n_rois).x
+    else:
+        estimated_sigmas = _fit_cross_roi_sigmas(observed_residual_covariance, W, blocks, estimated_taus,
+                                                 estimated_rhos, estimated_sigmas)
+    for r, block_fit in enumerate(block_fits):
+        block_fit[2] = estimated_sigmas[r]
+
+    diagonal, U = multi_roi_omega_factors(estimated_taus, estimated_rhos, estimated_sigmas, W, roi_labels)
+    model_omega = U.dot(U.T)
+    model_omega[np.diag_indices_from(model_omega)] += diagonal
+    model_omega_inv, logdet = woodbury_inverse(diagonal, U)
+
+    if verbose > 0:
+        for r in range(n_rois):
+            print("roi "+str(r)+" sigma: "+str(estimated_sigmas[r])+" rho: "+str(estimated_rhos[r]))
+        if observed_residual_covariance is not None:
+            print("summed squared distance: "+str(np.sum(np.square(observed_residual_covariance-model_omega))))
+
+    if return_parameters:
+        return estimated_taus, estimated_rhos, estimated_sigmas, model_omega, model_omega_inv, logdet, block_fits
+    return estimated_taus, estimated_rhos, estimated_sigmas, model_omega, model_omega_inv, logdet
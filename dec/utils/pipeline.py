@@ -0,0 +1,106 @@
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+class _Raised(object):
+    """wraps an exception raised in the background, to be re-raised by the consumer."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_DONE = object()
+
+
+def fork_safe_start_method():
+    """start method for worker processes created while other threads run, e.g. that of
+    prefetched: a forked child inherits the locks those threads hold, and can deadlock on them."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return 'forkserver'
+    return 'spawn'
+
+
+def prefetched(function, jobs, depth=1, use_processes=False):
+    """prefetched yields function(*job) for every job in jobs, in order,
+    computing the results of the next jobs in the background while the
+    caller works on the current one.
+
+    At most depth results, counting the one being prepared, are held ahead
+    of the one being consumed, so memory stays bounded: the background waits
+    until the caller takes a result. Use it to overlap the I/O and CSS predictions
+    of setup_data_from_h5 for fold k+1 with the omega fit and decoding of
+    fold k.
+
+    Parameters
+    ----------
+    function : callable
+        the preparation stage
+    jobs : iterable
+        argument tuples for function
+    depth : int
+        number of results prepared ahead. 0 runs everything in the
+        caller, without a background thread or process.
+    use_processes : bool
+        prepare in a separate process rather than a thread, for stages that
+        hold the GIL. function, jobs and results then need to be picklable.
+
+    Yields
+    ------
+    result
+        function(*job), for every job in order. Exceptions raised by function
+        are raised here, at the job that raised them.
+    """
+    if depth < 1:
+        for job in jobs:
+            yield function(*job)
+        return
+
+    if use_processes:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            pending = []
+            for job in jobs:
+                pending.append(executor.submit(function, *job))
+                if len(pending) > depth:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+        return
+
+    # a slot is taken before a result is prepared and given back when the consumer takes it,
+    # so that results in the queue and the one being prepared are at most depth together
+    results = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for job in jobs:
+                # wait for a slot, but give up when the consumer is gone
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                results.put(function(*job))
+        except BaseException as exception:
+            results.put(_Raised(exception))
+            return
+        results.put(_DONE)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            result = results.get()
+            if result is _DONE:
+                break
+            if isinstance(result, _Raised):
+                raise result.exception
+            slots.release()
+            yield result
+    finally:
+        # the consumer stopped early or raised, the producer stops at its next job
+        stop.set()
+        producer.join()
@@ -1,23 +1,104 @@
 import numpy as np
 import scipy as sp
-import tables
 import ctypes
-import matplotlib.pyplot as pl
 
-from hrf_estimation.hrf import spmt
-from scipy.signal import savgol_filter, fftconvolve, deconvolve
-from scipy.ndimage.interpolation import rotate
-
-from popeye.spinach import generate_og_receptive_fields
-from popeye.visual_stimulus import VisualStimulus
-
-from .utils import roi_data_from_hdf, create_visual_designmatrix_all, get_figshare_data, create_circular_mask
-from .css import CompressiveSpatialSummationModelFiltered
+# popeye, hrf_estimation, matplotlib and tqdm are imported where they are used,
+# so that importing this module (e.g. in worker processes) stays cheap.
+from .utils import roi_data_from_hdf, roi_data_from_cache, create_visual_designmatrix_all, get_figshare_data, create_circular_mask
 from .fit import *
 from .omega import *
+from .realign import realign_reconstructions, plot_realigned_reconstruction
+from .pipeline import prefetched, fork_safe_start_method
+from .deconvolution import hrf_filter_operator, gcv_regularisation, deconvolution_operator, deconvolve
+from .voxel_selection import select_informative_voxels, voxel_subset
+
+
+def progress(iterable, **kwargs):
+    """progress wraps iterable in a tqdm progress bar, if tqdm is available."""
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return iterable
+    return tqdm(iterable, **kwargs)
+
+
+def crossvalidated_rsq(prf_data):
+    """rsq of each voxel, averaged across folds, on which voxels are selected.
+    only count those voxels here that have positive rsq, by giving the others the sign of their amplitude.
+    prf_data is (n_voxels, n_folds, nr_prf_parameters).
+    """
+    return np.mean(prf_data[:,:,-1], axis=1) * np.sign(np.mean(prf_data[:,:,4], axis=1))
+
+
+def prf_mapping(mapping, prf_cv_fold_data):
+    """mapping_relation and mapping_parameters for the decoders, taken from the pRF parameters.
+    mapping: 'css' (power law and amplitude/baseline, as in the CSS model), 'power_law', 'linear' or None.
+    """
+    if mapping == 'css':
+        return ['power_law','linear'], [prf_cv_fold_data[:, 3],prf_cv_fold_data[:,4:6]]
+    elif mapping == 'power_law':
+        return 'power_law', prf_cv_fold_data[:, 3]
+    elif mapping == 'linear':
+        return 'linear', prf_cv_fold_data[:,4:6]
+    elif mapping is None:
+        return None, []
+    raise ValueError('unknown mapping ' + str(mapping))
+
+
+def decode_fold(W, test_data, logdet, omega_inv, mapping_relation=None, mapping_parameters=[], basis=None, n_jobs=1, start_method=None):
+    """firstpass and MAP decoding of all timepoints of test_data (n_voxels, n_timepoints).
+    basis (n_pixels, n_components), from stimulus_basis, decodes in basis coefficients, see maximize_loglikelihood_basis.
+    n_jobs is the number of processes the MAP decoding of the timepoints is split over, started with
+    start_method, see maximize_loglikelihood_batch. 1, the default, decodes in this process.
+    returns dm_pixel_logl_ratio, the firstpass images, and decoded_image, both (n_pixels, n_timepoints).
+    """
+    # all timepoints at once
+    dm_pixel_logl_ratio = firstpass_decoder_independent_channels_batch(
+                                    W=W,
+                                    bolds=test_data, 
+                                    logdet=logdet,
+                                    omega_inv=omega_inv,                                        
+                                    mapping_relation=mapping_relation,
+                                    mapping_parameters=mapping_parameters
+                                    )
+
+    logl, decoded_image = maximize_loglikelihood_batch(starting_values=dm_pixel_logl_ratio,
+                        W=W,
+                        bolds=test_data,
+                        logdet=logdet,
+                        omega_inv=omega_inv,
+                        mapping_relation=mapping_relation,
+                        mapping_parameters=mapping_parameters,
+                        basis=basis,
+                        n_jobs=n_jobs,
+                        start_method=start_method)
+
+    return dm_pixel_logl_ratio, decoded_image
+
+
+def my_spmt(delay, tr):
+    """hrf of the css model. At module level, so that css models can be sent to worker processes."""
+    from hrf_estimation.hrf import spmt
+    return spmt(np.arange(0, 33, tr))
+
+
+def setup_css_model(design_matrix, screen_distance=225, screen_width=69.0, TR=0.945):
+    """CompressiveSpatialSummationModelFiltered of design_matrix (n_pix, n_pix, n_timepoints),
+    with the hrf and filtering used in the pRF fits."""
+    from popeye.visual_stimulus import VisualStimulus
+    from .css import CompressiveSpatialSummationModelFiltered
 
-from tqdm import tqdm
-
+    # we're going to use these popeye convenience functions 
+    # because they are fast, and because they were used in the fitting procedure
+    stimulus = VisualStimulus(design_matrix, 
+                            screen_distance, 
+                            screen_width, 
+                            1.0, 
+                            TR, 
+                            ctypes.c_int16)
+    css_model = CompressiveSpatialSummationModelFiltered(stimulus, my_spmt)
+    css_model.hrf_delay = 0
+    return css_model
 
 
 def setup_data_from_h5(data_file, 
@@ -30,21 +111,32 @@ def setup_data_from_h5(data_file,
                         cv_fold=1,
                         n_folds=6,
                         use_median=True,
-                        mask_name = 'V1'):
-        
+                        mask_name = 'V1',
+                        plot=True,
+                        use_cache=True):
+    from scipy.stats import shapiro
+    from popeye.spinach import generate_og_receptive_fields
+
     hdf5_file = get_figshare_data(data_file)
 
     ############################################################################################################################################
     #   getting the data
     ############################################################################################################################################
 
+    # the cache memory-maps float64 copies of the data, shared between processes
+    if use_cache:
+        load_roi_data = roi_data_from_cache
+    else:
+        def load_roi_data(*args):
+            return roi_data_from_hdf(*args).astype(np.float64)
+
     # timecourses are single-run psc data, either original or leave-one-out. 
-    timecourse_data_single_run = roi_data_from_hdf(['*psc'],mask_name, hdf5_file,'psc').astype(np.float64)
-    timecourse_data_loo = roi_data_from_hdf(['*loo'],mask_name, hdf5_file,'loo').astype(np.float64)
-    timecourse_data_all_psc = roi_data_from_hdf(['*av'],mask_name, hdf5_file,'all_psc').astype(np.float64)
+    timecourse_data_single_run = load_roi_data(['*psc'],mask_name, hdf5_file,'psc')
+    timecourse_data_loo = load_roi_data(['*loo'],mask_name, hdf5_file,'loo')
+    timecourse_data_all_psc = load_roi_data(['*av'],mask_name, hdf5_file,'all_psc')
     # prfs are per-run, as fit using the loo data
-    all_prf_data = roi_data_from_hdf(['*all'],mask_name, hdf5_file,'all_prf').astype(np.float64)
-    prf_data = roi_data_from_hdf(['*all'],mask_name, hdf5_file,'prf').astype(np.float64).reshape((all_prf_data.shape[0], -1, all_prf_data.shape[-1]))
+    all_prf_data = load_roi_data(['*all'],mask_name, hdf5_file,'all_prf')
+    prf_data = load_roi_data(['*all'],mask_name, hdf5_file,'prf').reshape((all_prf_data.shape[0], -1, all_prf_data.shape[-1]))
 
     dm=create_visual_designmatrix_all(n_pixels=n_pix)
     if use_median:
@@ -57,8 +149,7 @@ def setup_data_from_h5(data_file,
     dm = dm[mask,:]
     
     # voxel mask for crossvalidation
-    # only count those voxels here that have positive rsq
-    rsq_crossv = np.mean(prf_data[:,:,-1], axis=1) * np.sign(np.mean(prf_data[:,:,4], axis=1))
+    rsq_crossv = crossvalidated_rsq(prf_data)
     rsq_mask_crossv = rsq_crossv > rsq_threshold
     
     # determine amount of trs
@@ -90,19 +181,7 @@ def setup_data_from_h5(data_file,
     ############################################################################################################################################
 
     # set up model with hrf etc.
-    def my_spmt(delay, tr):
-        return spmt(np.arange(0, 33, tr))
-
-    # we're going to use these popeye convenience functions 
-    # because they are fast, and because they were used in the fitting procedure
-    stimulus = VisualStimulus(dm_crossv, 
-                            screen_distance, 
-                            screen_width, 
-                            1.0, 
-                            TR, 
-                            ctypes.c_int16)
-    css_model = CompressiveSpatialSummationModelFiltered(stimulus, my_spmt)
-    css_model.hrf_delay = 0
+    css_model = setup_css_model(dm_crossv, screen_distance, screen_width, TR)
 
     ############################################################################################################################################
     #   setting up prf spatial profiles for subsequent covariances, now some per-run stuff was done
@@ -190,16 +269,13 @@ def setup_data_from_h5(data_file,
     
     
     
-    css_prediction=np.zeros((rsq_mask_crossv.sum(),train_data.shape[1]))
-    for g, vox_prf_pars in enumerate(prf_cv_fold_data):
-        css_prediction[g] = css_model.generate_prediction(
-            x=vox_prf_pars[0], y=vox_prf_pars[1], sigma=vox_prf_pars[2], n=vox_prf_pars[3], beta=vox_prf_pars[4], baseline=vox_prf_pars[5])
-        #b=np.max(css_prediction[g,:])
-        #simple_prediction[:,g] *= b/a
+    # all voxels at once
+    css_prediction = css_model.generate_predictions(
+            x=prf_cv_fold_data[:,0], y=prf_cv_fold_data[:,1], sigma=prf_cv_fold_data[:,2], n=prf_cv_fold_data[:,3], beta=prf_cv_fold_data[:,4], baseline=prf_cv_fold_data[:,5])
         
     all_residuals_css = train_data - css_prediction
     all_residuals_simple = train_data - simple_prediction
-    print("Shapiro-Wilk normality test (if second value is large, residuals are normal):", sp.stats.shapiro(all_residuals_css))
+    print("Shapiro-Wilk normality test (if second value is large, residuals are normal):", shapiro(all_residuals_css))
     print("CSS resid: ",np.sum(all_residuals_css))
     print("simple model (no hrf) resid: ",np.sum(all_residuals_simple))
 
@@ -209,157 +285,249 @@ def setup_data_from_h5(data_file,
     
     
     # some quick visualization
+    if plot:
+        plot_best_and_worst_voxels(rsq_crossv[rsq_mask_crossv], css_prediction, train_data, simple_prediction)
+
+    all_residual_covariance_css = np.cov(all_residuals_css) 
+
+    return prf_cv_fold_data, W, all_residuals_css, all_residual_covariance_css, test_data, mask
+
+
+def plot_best_and_worst_voxels(rsq, css_prediction, train_data, simple_prediction):
+    import matplotlib.pyplot as pl
+
     f = pl.figure(figsize=(17,5))
     s = f.add_subplot(211)
-    pl.plot(css_prediction[np.argmax(rsq_crossv[rsq_mask_crossv])], label='CSS prediction')
-    pl.plot(train_data[np.argmax(rsq_crossv[rsq_mask_crossv])], label='data')
-    pl.plot(simple_prediction[np.argmax(rsq_crossv[rsq_mask_crossv])], label='Simple prediction')  
-    #pl.plot(all_residuals_css[np.argmax(rsq_crossv[rsq_mask_crossv])], label='resid')   
+    pl.plot(css_prediction[np.argmax(rsq)], label='CSS prediction')
+    pl.plot(train_data[np.argmax(rsq)], label='data')
+    pl.plot(simple_prediction[np.argmax(rsq)], label='Simple prediction')  
+    #pl.plot(all_residuals_css[np.argmax(rsq)], label='resid')   
     pl.legend()
     s.set_title('best voxel')
     
     s = f.add_subplot(212)
-    pl.plot(css_prediction[np.argmin(rsq_crossv[rsq_mask_crossv])], label='CSS prediction')
-    pl.plot(train_data[np.argmin(rsq_crossv[rsq_mask_crossv])], label='data')
-    pl.plot(simple_prediction[np.argmin(rsq_crossv[rsq_mask_crossv])], label='Simple prediction')   
-    #pl.plot(all_residuals_css[np.argmin(rsq_crossv[rsq_mask_crossv])], label='resid')
+    pl.plot(css_prediction[np.argmin(rsq)], label='CSS prediction')
+    pl.plot(train_data[np.argmin(rsq)], label='data')
+    pl.plot(simple_prediction[np.argmin(rsq)], label='Simple prediction')   
+    #pl.plot(all_residuals_css[np.argmin(rsq)], label='resid')
     pl.legend()
     s.set_title('worst voxel given this threshold')
-    
-    
-    
-    
-    all_residual_covariance_css = np.cov(all_residuals_css) 
 
-    return prf_cv_fold_data, W, all_residuals_css, all_residual_covariance_css, test_data, mask
 
+def setup_multi_roi_data_from_h5(data_file, n_pix, mask_names=['V1', 'V2', 'V3'], **kwargs):
+    """setup_data_from_h5 for several ROIs, stacked along the voxel axis.
+    Additionally returns roi_labels, the index into mask_names of the ROI each voxel belongs to,
+    for use in fit_model_omega_multi_roi. The residual covariance is calculated across all ROIs.
+    """
+    roi_data = [setup_data_from_h5(data_file=data_file, n_pix=n_pix, mask_name=mask_name, **kwargs)
+                for mask_name in mask_names]
+
+    prf_cv_fold_data = np.vstack([rd[0] for rd in roi_data])
+    W = np.vstack([rd[1] for rd in roi_data])
+    all_residuals_css = np.vstack([rd[2] for rd in roi_data])
+    test_data = np.vstack([rd[4] for rd in roi_data])
+    mask = roi_data[0][5]
+    roi_labels = np.concatenate([np.full(rd[1].shape[0], r, dtype=int) for r, rd in enumerate(roi_data)])
+
+    all_residual_covariance_css = np.cov(all_residuals_css)
 
-def decode_cv_prfs(n_pix, rsq_threshold, use_median, n_folds, data_file, extent, screen_distance, screen_width, TR, mask_name, **kwargs):
+    return prf_cv_fold_data, W, all_residuals_css, all_residual_covariance_css, test_data, mask, roi_labels
+
+
+def _setup_fold(mask_name, setup_kwargs):
+    """setup_data_from_h5 of a single ROI, or setup_multi_roi_data_from_h5 of a list of ROIs."""
+    if isinstance(mask_name, (list, tuple)):
+        return setup_multi_roi_data_from_h5(mask_names=mask_name, **setup_kwargs)
+    return setup_data_from_h5(mask_name=mask_name, **setup_kwargs)
+
+
+def _deconvolve_fold(test_data, residuals, hrf, deconvolution):
+    """_deconvolve_fold deconvolves the test data of a fold from hrf and the filter, and the training
+    residuals with the same regularisation, so that omega is estimated on residuals with the
+    temporal structure of the decoded data. The regularisation is deconvolution, or with 'gcv'
+    chosen by gcv_regularisation on the test data.
+
+    Returns
+    -------
+    test_data, residuals, residual_covariance : the deconvolved test data and residuals,
+        and the covariance of the deconvolved residuals
+    """
+    test_operator = hrf_filter_operator(test_data.shape[1], hrf)
+    if deconvolution == 'gcv':
+        regularisation, _ = gcv_regularisation(test_operator, test_data - test_data.mean(axis=1)[:,np.newaxis])
+    else:
+        regularisation = deconvolution
+    test_data = deconvolve(test_data, deconvolution_operator(test_operator, regularisation))
+    # the residuals are the training runs, which have a different length than the test data
+    residuals = deconvolve(residuals, deconvolution_operator(hrf_filter_operator(residuals.shape[1], hrf), regularisation))
+    return test_data, residuals, np.cov(residuals)
+
+
+def decode_cv_prfs(n_pix, rsq_threshold, use_median, n_folds, data_file, extent, screen_distance, screen_width, TR, mask_name, n_jobs=None, plot=False, return_uncertainty=False, mapping='css', warm_start=True, omega_fit='covariance', prefetch=1, deconvolution=None, basis=None, n_basis_components=None, n_selected_voxels=None, **kwargs):
+    """mask_name can be a single ROI, or a list of ROIs to be decoded jointly with a block-structured omega,
+    see fit_model_omega_multi_roi, which supports warm_start and omega_fit as a single ROI does.
+    n_jobs is the number of processes used to fit the per-ROI omega parameters in the latter case,
+    and to decode the timepoints of every fold, None uses all cores.
+    plot shows the data of the best and worst voxels and the realigned reconstructions of every fold.
+    return_uncertainty additionally returns the Laplace-approximation posterior standard deviation
+    of every pixel of the decoded images, as (n_folds, n_timepoints, n_pix, n_pix).
+    mapping is the nonlinear mapping used in decoding, see prf_mapping.
+    warm_start starts the omega fit of every fold after the first from the parameters of the previous fold.
+    The folds share their voxels and have similar residuals, so this only needs a short refinement.
+    omega_fit 'likelihood' fits omega to the residual timecourses with fit_model_omega_likelihood
+    instead of to their covariance, and then returns taus rather than tau matrices in cv_estimated_tau_matrix.
+    prefetch is the number of folds set up in a background thread ahead of the one being decoded,
+    0 sets up every fold when it is needed. Every prefetched fold holds its data in memory.
+    deconvolution decodes test data deconvolved from the hrf and filter of the css model (see deconvolve),
+    with this regularisation, or one chosen per fold by generalised cross-validation with 'gcv'.
+    omega is then fit to the training residuals deconvolved with the same regularisation.
+    basis 'pca' or 'gaussian' decodes in the coefficients of that stimulus_basis, with n_basis_components pca components.
+    n_selected_voxels decodes every fold with only that many voxels, chosen by select_informative_voxels
+    from the fold's W and omega.
+    """
     
     # for key, value in kwargs.iteritems():
     #         key = value
 
 
     # set up results variables
-    cv_rotated_recon, cv_reshrot_recon, cv_reshrot_recon_m, \
+    cv_recon, cv_posterior_sd, \
     cv_omega, cv_estimated_tau_matrix, \
-    cv_estimated_rho, cv_estimated_sigma, cv_estimated_alpha = [], [], [], [], [], [], [], []
-
-    for i in tqdm(range(n_folds)):
+    cv_estimated_rho, cv_estimated_sigma, cv_estimated_alpha = [], [], [], [], [], [], []
+    # voxels are selected on the rsq across folds, so they are the same in every fold
+    omega_parameters = None
+
+    # the data of fold i+1 is set up in the background while fold i is fit and decoded.
+    # setup plots with matplotlib, which has to stay in the main thread
+    if basis is not None and basis != 'gaussian' and uses_power_law(prf_mapping(mapping, np.zeros((1, 7)))[0]):
+        raise ValueError('basis %r can give negative linear predictors, where the power law of mapping %r '
+                         'is not defined; use the gaussian basis' % (basis, mapping))
+
+    setup_jobs = [(mask_name, dict(data_file = data_file, 
+                                   n_pix=n_pix, 
+                                   extent=extent, 
+                                   screen_distance=screen_distance, 
+                                   screen_width=screen_width, 
+                                   rsq_threshold=rsq_threshold,
+                                   TR=TR,
+                                   cv_fold=i,
+                                   n_folds=n_folds,
+                                   use_median=False,
+                                   plot=plot))
+                  for i in range(n_folds)]
+    prefetch = 0 if plot else prefetch
+    fold_data = prefetched(_setup_fold, setup_jobs, depth=prefetch)
+    # the decoding processes are not forked while the prefetch thread may be reading hdf5 files
+    decode_start_method = fork_safe_start_method() if prefetch > 0 else None
+
+    for i in progress(range(n_folds)):
         # get the data
-     
-        
-        (prf_cv_fold_data, W, 
-         all_residuals_css, all_residual_covariance_css, test_data, mask) = setup_data_from_h5(
-                        data_file = data_file, 
-                        n_pix=n_pix, 
-                        extent=extent, 
-                        screen_distance=screen_distance, 
-                        screen_width=screen_width, 
-                        rsq_threshold=rsq_threshold,
-                        TR=TR,
-                        cv_fold=i,
-                        n_folds=n_folds,
-                        use_median=False,
-                        mask_name=mask_name)
-
-        # estimate the covariance structure, which outputs all parameters
-        (estimated_tau_matrix, estimated_rho, 
-         estimated_sigma, estimated_alpha, omega, omega_inv, logdet) = fit_model_omega(observed_residual_covariance=all_residual_covariance_css, 
-                                        WWT=np.dot(W,W.T),
-                                        verbose=0,
-                                 #       infile='../data/omega.npy'
-                                        )
-
-         # set up result array:
-        # set up result array:
-        dm_pixel_logl_ratio = np.zeros((mask.sum(),test_data.shape[1]))
-
-        # and loop across timepoints
-        for t, bold in enumerate(test_data.T):
-            dm_pixel_logl_ratio[:,t] = firstpass_decoder_independent_channels(
-                                        W=W,
-                                        bold=bold, 
-                                        logdet=logdet,
-                                        omega_inv=omega_inv,                                        
-                                        mapping_relation=['power_law','linear'],
-                                        mapping_parameters=[prf_cv_fold_data[:, 3],prf_cv_fold_data[:,4:6]]
-                                        #mapping_relation='power_law',
-                                        #mapping_parameters=prf_cv_fold_data[:, 3]
-                                        )
-            
-            
-        decoded_image = np.zeros((mask.sum(),test_data.shape[1]))  
-        for t, bold in enumerate(tqdm(test_data.T)):
-    
-
-            logl, decoded_image[:,t] = maximize_loglikelihood( starting_value=dm_pixel_logl_ratio[:,t],
-                            W=W,                           
-                            bold=bold,
-                            logdet=logdet,
-                            omega_inv=omega_inv,                            
-                            mapping_relation = ['power_law', 'linear'],
-                            mapping_parameters = [prf_cv_fold_data[:, 3],prf_cv_fold_data[:,4:6]]
-                            #mapping_relation='power_law',
-                            #mapping_parameters=prf_cv_fold_data[:, 3]
-                                                     )    
-
-     
+        if isinstance(mask_name, (list, tuple)):
+            (prf_cv_fold_data, W, 
+             all_residuals_css, all_residual_covariance_css, test_data, mask, roi_labels) = next(fold_data)
+        else:
+            (prf_cv_fold_data, W, 
+             all_residuals_css, all_residual_covariance_css, test_data, mask) = next(fold_data)
+
+        if deconvolution is not None:
+            test_data, all_residuals_css, all_residual_covariance_css = _deconvolve_fold(test_data, all_residuals_css,
+                                                                                         my_spmt(0, TR), deconvolution)
+
+        if isinstance(mask_name, (list, tuple)):
+            # block-structured omega, the per-ROI parameters are fit in parallel
+            (estimated_tau_matrix, estimated_rho, 
+             estimated_sigma, omega, omega_inv, logdet, omega_parameters) = fit_model_omega_multi_roi(observed_residual_covariance=all_residual_covariance_css,
+                                            W=W,
+                                            roi_labels=roi_labels,
+                                            n_jobs=n_jobs,
+                                            residuals=all_residuals_css,
+                                            omega_fit=omega_fit,
+                                            x0=omega_parameters if warm_start else None,
+                                            start_method=decode_start_method,
+                                            return_parameters=True,
+                                            verbose=0)
+            estimated_alpha = 0.0
+        elif omega_fit == 'likelihood':
+            # likelihood of the residual timecourses, without the voxel by voxel covariance
+            (estimated_tau_matrix, estimated_rho, 
+             estimated_sigma, omega, omega_inv, logdet, omega_parameters) = fit_model_omega_likelihood(residuals=all_residuals_css,
+                                            W=W,
+                                            x0=omega_parameters if warm_start else None,
+                                            return_parameters=True)
+            estimated_alpha = 0.0
+        else:
+            # estimate the covariance structure, which outputs all parameters
+            (estimated_tau_matrix, estimated_rho, 
+             estimated_sigma, estimated_alpha, omega, omega_inv, logdet, omega_parameters) = fit_model_omega(observed_residual_covariance=all_residual_covariance_css, 
+                                            WWT=None,
+                                            W=W,
+                                            verbose=0,
+                                     #       infile='../data/omega.npy'
+                                            x0=omega_parameters if warm_start else None,
+                                            return_parameters=True
+                                            )
+
+        mapping_relation, mapping_parameters = prf_mapping(mapping, prf_cv_fold_data)
+        if n_selected_voxels is not None:
+            selected_voxels, _ = select_informative_voxels(W, omega, n_voxels=n_selected_voxels)
+            W, omega_inv, logdet, mapping_parameters = voxel_subset(selected_voxels, W, omega, mapping_relation, mapping_parameters)
+            test_data = test_data[selected_voxels]
+        fold_basis = None if basis is None else stimulus_basis(W, kind=basis, n_components=n_basis_components, mask=mask)
+        dm_pixel_logl_ratio, decoded_image = decode_fold(W=W,
+                                                         test_data=test_data,
+                                                         logdet=logdet,
+                                                         omega_inv=omega_inv,
+                                                         mapping_relation=mapping_relation,
+                                                         mapping_parameters=mapping_parameters,
+                                                         basis=fold_basis,
+                                                         n_jobs=n_jobs,
+                                                         start_method=decode_start_method)
 
         # fill in the mask
         recon = np.zeros([decoded_image.shape[1]]+list(mask.shape) )
-        for t in range(decoded_image.shape[1]):
-            recon[t,mask] = decoded_image[:,t]
-
-        # rotate reconstructions to bar orientation
-        thetas = [-1, 0, -1, 45, 270, -1,  315,  180, -1,  135,   90, -1,  225, -1]
-        rotated_recon = np.copy(recon).T
-
-        hrf_delay = 0
-        block_delimiters = np.r_[np.arange(2, 462, 34) + hrf_delay, 462]
-        reshrot_recon = np.zeros((8, rotated_recon.shape[0], rotated_recon.shape[1], 38))
-        bar_counter = 0
-        for i in range(len(block_delimiters) - 1):
-            if thetas[i] != -1:
-                rotated_recon[:, :, block_delimiters[i]:block_delimiters[i + 1] + 4] = rotate(rotated_recon[:, :, block_delimiters[i]:block_delimiters[i + 1] + 4],
-                                                                                              axes=(
-                    0, 1),
-                    angle=thetas[i],
-                    reshape=False,
-                    mode='nearest')
-                reshrot_recon[bar_counter] = rotated_recon[:, :,
-                                                           block_delimiters[i]:block_delimiters[i + 1] + 4]
-                bar_counter += 1
-
-        reshrot_recon_m = np.median(reshrot_recon, axis=0)
-        rotated_recon_m = np.median(rotated_recon, axis=0)
-        pl.figure(figsize=(24,7))
-        pl.imshow(rotated_recon_m);
-        pl.figure(figsize=(12,6))
-        pl.imshow(np.median(reshrot_recon_m, axis = 0), aspect = 0.5);
+        recon[:,mask] = decoded_image.T
+
+        if return_uncertainty:
+            # the whole fold at once
+            posterior_sd = np.zeros(recon.shape)
+            posterior_sd[:,mask] = posterior_standard_deviation(decoded_image,
+                                                                W=W,
+                                                                omega_inv=omega_inv,
+                                                                mapping_relation=mapping_relation,
+                                                                mapping_parameters=mapping_parameters).T
+            cv_posterior_sd.append(posterior_sd)
+
         ##############################
         #   Save out results
         ##############################
 
-        cv_rotated_recon.append(rotated_recon_m)
-        cv_reshrot_recon.append(reshrot_recon)
-        cv_reshrot_recon_m.append(reshrot_recon_m)
+        cv_recon.append(recon)
         cv_omega.append(omega)
         cv_estimated_tau_matrix.append(estimated_tau_matrix)
         cv_estimated_rho.append(estimated_rho)
         cv_estimated_sigma.append(estimated_sigma)
         cv_estimated_alpha.append(estimated_alpha)
 
+    # rotate reconstructions of all folds to bar orientation at once.
+    # the transpose keeps the image orientation of the original (recon.T) realignment
+    rotated_recon, reshrot_recon = realign_reconstructions(np.array(cv_recon).transpose(0, 1, 3, 2))
+    rotated_recon = rotated_recon.transpose(0, 2, 3, 1)
+    cv_reshrot_recon = reshrot_recon.transpose(0, 1, 3, 4, 2)
+
+    cv_rotated_recon = np.median(rotated_recon, axis=1)
+    cv_reshrot_recon_m = np.median(cv_reshrot_recon, axis=1)
+    if plot:
+        for rotated_recon_m, reshrot_recon_m in zip(cv_rotated_recon, cv_reshrot_recon_m):
+            plot_realigned_reconstruction(rotated_recon_m, reshrot_recon_m)
 
-    cv_rotated_recon = np.array(cv_rotated_recon)
-    cv_reshrot_recon = np.array(cv_reshrot_recon)
-    cv_reshrot_recon_m = np.array(cv_reshrot_recon_m)
     cv_omega = np.array(cv_omega)
     cv_estimated_tau_matrix = np.array(cv_estimated_tau_matrix)
     cv_estimated_rho = np.array(cv_estimated_rho)
     cv_estimated_sigma = np.array(cv_estimated_sigma)
     cv_estimated_alpha = np.array(cv_estimated_alpha)
 
+    if return_uncertainty:
+        return cv_rotated_recon, cv_reshrot_recon, cv_reshrot_recon_m, cv_omega, cv_estimated_tau_matrix, cv_estimated_rho, cv_estimated_sigma, cv_estimated_alpha, np.array(cv_posterior_sd)
     return cv_rotated_recon, cv_reshrot_recon, cv_reshrot_recon_m, cv_omega, cv_estimated_tau_matrix, cv_estimated_rho, cv_estimated_sigma, cv_estimated_alpha
 
 
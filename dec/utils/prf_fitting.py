@@ -0,0 +1,162 @@
+import numpy as np
+import scipy as sp
+from concurrent.futures import ProcessPoolExecutor
+
+# popeye is needed for the CSS model passed in, see setup_data_from_h5 for how to set one up.
+
+# columns of the fitted parameters, as in the prf arrays of the hdf5 file
+PRF_PARAMETERS = ['x', 'y', 'sigma', 'n', 'beta', 'baseline', 'rsq']
+
+
+def css_lookup_table(css_model, x_grid, y_grid, sigma_grid, n_grid, chunk_size=1024):
+    """css_lookup_table predicts the timecourses of all combinations of the
+    grids, with beta 1 and baseline 0, on the coarse stimulus of css_model,
+    with CompressiveSpatialSummationModelFiltered.generate_ballpark_predictions.
+
+    Returns
+    -------
+    grid_parameters : numpy.ndarray, (n_grid_points, 4)
+        x, y, sigma and n of every grid point
+    predictions : numpy.ndarray, (n_grid_points, n_timepoints)
+    """
+    grid_parameters = np.array(np.meshgrid(x_grid, y_grid, sigma_grid, n_grid, indexing='ij')).reshape((4, -1)).T
+    predictions = np.vstack([css_model.generate_ballpark_predictions(*grid_parameters[start:start + chunk_size].T)
+                             for start in range(0, grid_parameters.shape[0], chunk_size)])
+    return grid_parameters, predictions
+
+
+def _centered_unit(timecourses):
+    centered = timecourses - timecourses.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt((centered**2).sum(axis=1))
+    norm[norm == 0] = np.inf
+    return centered / norm[:, np.newaxis]
+
+
+def grid_fit(data, grid_parameters, predictions, chunk_size=4096):
+    """grid_fit finds the best grid point of every voxel: the correlations of all
+    voxels with all lookup table timecourses are one matrix product (per chunk
+    of chunk_size voxels). beta and baseline follow from linear regression on
+    the best timecourse. Only positive correlations are considered.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        (n_voxels, n_timepoints) timecourses
+    grid_parameters, predictions :
+        as returned by css_lookup_table
+
+    Returns
+    -------
+    parameters : numpy.ndarray, (n_voxels, 7)
+        x, y, sigma, n, beta, baseline and rsq of every voxel, see PRF_PARAMETERS
+    """
+    prediction_mean = predictions.mean(axis=1)
+    prediction_units = _centered_unit(predictions)
+    # prediction norm after centering, for the regression slopes
+    prediction_norm = np.sqrt(((predictions - prediction_mean[:, np.newaxis])**2).sum(axis=1))
+
+    parameters = np.zeros((data.shape[0], len(PRF_PARAMETERS)))
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        data_chunk = data[chunk]
+        data_norm = np.sqrt(((data_chunk - data_chunk.mean(axis=1)[:, np.newaxis])**2).sum(axis=1))
+
+        correlation = _centered_unit(data_chunk).dot(prediction_units.T)
+        best = np.argmax(correlation, axis=1)
+        best_correlation = correlation[np.arange(best.shape[0]), best]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = np.where(prediction_norm[best] > 0, best_correlation * data_norm / prediction_norm[best], 0)
+        parameters[chunk, :4] = grid_parameters[best]
+        parameters[chunk, 4] = beta
+        parameters[chunk, 5] = data_chunk.mean(axis=1) - beta * prediction_mean[best]
+        parameters[chunk, 6] = np.clip(best_correlation, 0, None)**2
+
+    return parameters
+
+
+def _refine_chunk(args):
+    css_model, data, start_parameters, lower, upper = args
+    parameters = np.array(start_parameters)
+    for v in range(data.shape[0]):
+        def residuals(p):
+            return css_model.generate_prediction(*p) - data[v]
+        result = sp.optimize.least_squares(residuals,
+                                           np.clip(start_parameters[v, :6], lower, upper),
+                                           bounds=(lower, upper),
+                                           method='trf')
+        sse = np.sum(result.fun**2)
+        sst = np.sum((data[v] - data[v].mean())**2)
+        rsq = 1 - sse / sst if sst > 0 else 0.0
+        # keep the grid fit where the refinement did not improve it
+        if rsq > parameters[v, 6]:
+            parameters[v, :6] = result.x
+            parameters[v, 6] = rsq
+    return parameters
+
+
+def refine_fit(css_model, data, start_parameters, bounds=None, n_jobs=None, chunk_size=64):
+    """refine_fit refines the grid fit of every voxel with a bounded least squares
+    fit of the full-resolution CSS model, in parallel processes over chunks of
+    chunk_size voxels. A refinement that does not improve the rsq is discarded.
+
+    Parameters
+    ----------
+    css_model : CompressiveSpatialSummationModelFiltered
+    data : numpy.ndarray
+        (n_voxels, n_timepoints) timecourses
+    start_parameters : numpy.ndarray
+        (n_voxels, 7) as returned by grid_fit
+    bounds : list
+        (lower, upper) bounds of x, y, sigma, n, beta and baseline. By default
+        sigma and n are kept positive and the others are free.
+    n_jobs : int
+        number of worker processes, None uses all cores, 1 runs in this process
+
+    Returns
+    -------
+    parameters : numpy.ndarray, (n_voxels, 7)
+    """
+    if bounds is None:
+        bounds = [(-np.inf, np.inf), (-np.inf, np.inf), (1e-3, np.inf), (1e-3, np.inf), (-np.inf, np.inf), (-np.inf, np.inf)]
+    lower, upper = np.array(bounds, dtype=np.float64).T
+
+    jobs = [(css_model, data[start:start + chunk_size], start_parameters[start:start + chunk_size], lower, upper)
+            for start in range(0, data.shape[0], chunk_size)]
+    if n_jobs == 1:
+        chunks = list(map(_refine_chunk, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunks = list(executor.map(_refine_chunk, jobs))
+    return np.vstack(chunks)
+
+
+def fit_css_prfs(css_model, data, x_grid, y_grid, sigma_grid, n_grid, bounds=None, refine=True, n_jobs=None, chunk_size=64):
+    """fit_css_prfs fits CSS pRFs to the timecourses of all voxels, with a
+    grid search on a lookup table of coarse-stimulus predictions (css_lookup_table,
+    grid_fit) that is refined per voxel on the full stimulus (refine_fit).
+
+    Parameters
+    ----------
+    css_model : CompressiveSpatialSummationModelFiltered
+        model of the stimulus and hrf, as set up in setup_data_from_h5
+    data : numpy.ndarray
+        (n_voxels, n_timepoints) timecourses, e.g. the median over runs
+    x_grid, y_grid, sigma_grid, n_grid : array_like
+        values of the grid search, in degrees (x, y, sigma)
+    bounds, n_jobs, chunk_size :
+        of refine_fit, chunk_size is the number of voxels per task of its processes
+    refine : bool
+        refine the grid fit, otherwise only the grid fit is returned
+
+    Returns
+    -------
+    parameters : numpy.ndarray, (n_voxels, 7)
+        x, y, sigma, n, beta, baseline and rsq of every voxel, in the column
+        order of the prf arrays of the hdf5 file (see PRF_PARAMETERS)
+    """
+    grid_parameters, predictions = css_lookup_table(css_model, x_grid, y_grid, sigma_grid, n_grid)
+    parameters = grid_fit(data, grid_parameters, predictions)
+    if refine:
+        parameters = refine_fit(css_model, data, parameters, bounds=bounds, n_jobs=n_jobs, chunk_size=chunk_size)
+    return parameters
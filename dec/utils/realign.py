@@ -0,0 +1,152 @@
+from functools import lru_cache
+
+import numpy as np
+
+# bar orientations of the blocks in the pRF mapping experiment, -1 is a blank block.
+# these are the thetas used in create_visual_designmatrix_all
+BAR_THETAS = [-1, 0, -1, 45, 270, -1,  315,  180, -1,  135,   90, -1,  225, -1]
+
+
+@lru_cache(maxsize=None)
+def rotation_index_map(n_pix, theta):
+    """rotation_index_map precomputes the bilinear resampling of a rotation of an
+    (n_pix, n_pix) image by theta degrees, around the image center.
+
+    It reproduces scipy.ndimage.rotate(image, theta, axes=(0, 1), reshape=False,
+    mode='nearest', order=1), as a gather of 4 neighbouring source pixels per
+    output pixel. Results are cached per (n_pix, theta).
+
+    Parameters
+    ----------
+    n_pix : int
+        number of pixels on a side of the image
+    theta : float
+        rotation angle in degrees
+
+    Returns
+    -------
+    indices : numpy.ndarray, int, (4, n_pix**2)
+        indices into the raveled source image for every raveled output pixel
+    weights : numpy.ndarray, float, (4, n_pix**2)
+        interpolation weights for the source pixels in indices
+    """
+    angle = np.deg2rad(theta)
+    rotation_matrix = np.array([[np.cos(angle), np.sin(angle)],
+                                [-np.sin(angle), np.cos(angle)]])
+
+    center = (n_pix - 1) / 2.0
+    output_coords = np.indices((n_pix, n_pix)).reshape((2, -1)).astype(np.float64)
+    # 'nearest' mode is equivalent to clipping the source coordinates to the image
+    input_coords = np.clip(rotation_matrix.dot(output_coords - center) + center, 0, n_pix - 1)
+
+    floor_coords = np.minimum(np.floor(input_coords).astype(int), max(n_pix - 2, 0))
+    fractions = input_coords - floor_coords
+
+    indices = np.zeros((4, n_pix**2), dtype=int)
+    weights = np.zeros((4, n_pix**2))
+    for k, (dx, dy) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+        indices[k] = np.minimum(floor_coords[0] + dx, n_pix - 1) * n_pix + np.minimum(floor_coords[1] + dy, n_pix - 1)
+        weights[k] = (fractions[0] if dx else 1 - fractions[0]) * (fractions[1] if dy else 1 - fractions[1])
+
+    indices.setflags(write=False)
+    weights.setflags(write=False)
+    return indices, weights
+
+
+def bar_block_windows(nr_timepoints=462, thetas=BAR_THETAS, block_duration=34, iti_duration=2, hrf_delay=0, window_padding=4):
+    """bar_block_windows returns the timepoints of every bar pass in the design,
+    and the block each timepoint belongs to.
+
+    Returns
+    -------
+    windows : numpy.ndarray, int, (n_bars, block_duration + window_padding)
+        timepoints of each bar block, padded with window_padding timepoints
+        at the end to allow for the hemodynamic lag
+    bar_thetas : list
+        orientation of each bar block
+    block_thetas : numpy.ndarray, (nr_timepoints,)
+        orientation of the block each timepoint belongs to, -1 outside of bar blocks
+    """
+    block_delimiters = np.r_[np.arange(iti_duration, nr_timepoints, block_duration) + hrf_delay, nr_timepoints]
+
+    windows, bar_thetas = [], []
+    block_thetas = -np.ones(nr_timepoints)
+    for i in range(len(block_delimiters) - 1):
+        if thetas[i] != -1:
+            windows.append(np.arange(block_delimiters[i], block_delimiters[i + 1] + window_padding))
+            bar_thetas.append(thetas[i])
+            block_thetas[block_delimiters[i]:block_delimiters[i + 1]] = thetas[i]
+
+    return np.array(windows), bar_thetas, block_thetas
+
+
+def realign_reconstructions(recon, thetas=BAR_THETAS, hrf_delay=0, window_padding=4):
+    """realign_reconstructions rotates reconstructed frames back to a common bar orientation.
+
+    Frames are resampled per orientation: the frames of all folds and blocks
+    with the same theta are rotated together, with the index map computed once
+    per (n_pix, theta). Unlike the in-place rotation this replaces, frames in
+    the padding between consecutive bar blocks are rotated only once, by the
+    orientation of the block they fall in.
+
+    Parameters
+    ----------
+    recon : numpy.ndarray
+        (..., nr_timepoints, n_pix, n_pix) reconstructions, leading axes are
+        for instance folds.
+
+    Returns
+    -------
+    rotated_recon : numpy.ndarray
+        (..., nr_timepoints, n_pix, n_pix), every timepoint rotated by the
+        orientation of its bar block, blank blocks untouched.
+    reshrot_recon : numpy.ndarray
+        (..., n_bars, block_duration + window_padding, n_pix, n_pix), the
+        rotated frames of each bar pass, stacked.
+    """
+    nr_timepoints, n_pix = recon.shape[-3], recon.shape[-1]
+    frames = recon.reshape(recon.shape[:-2] + (n_pix**2,))
+
+    windows, bar_thetas, block_thetas = bar_block_windows(nr_timepoints=nr_timepoints,
+                                                          thetas=thetas,
+                                                          hrf_delay=hrf_delay,
+                                                          window_padding=window_padding)
+    bar_thetas = np.array(bar_thetas)
+
+    # every timepoint with the rotation of its own block
+    rotated_recon = np.array(frames, dtype=np.result_type(frames, np.float64))
+    for theta in np.unique(block_thetas):
+        if theta != -1:
+            timepoints = block_thetas == theta
+            rotated_recon[..., timepoints, :] = _rotate_frames(frames[..., timepoints, :], n_pix, theta)
+
+    # bar windows, which include the padding timepoints of the next block, with the rotation of the bar
+    reshrot_recon = np.zeros(recon.shape[:-3] + windows.shape + (n_pix**2,), dtype=rotated_recon.dtype)
+    for theta in np.unique(bar_thetas):
+        bars = bar_thetas == theta
+        reshrot_recon[..., bars, :, :] = _rotate_frames(frames[..., windows[bars], :], n_pix, theta)
+
+    return (rotated_recon.reshape(recon.shape),
+            reshrot_recon.reshape(reshrot_recon.shape[:-1] + (n_pix, n_pix)))
+
+
+def _rotate_frames(frames, n_pix, theta):
+    """(..., n_pix**2) raveled frames rotated by theta degrees, see rotation_index_map."""
+    indices, weights = rotation_index_map(n_pix, theta)
+    rotated = frames[..., indices[0]] * weights[0]
+    for k in range(1, 4):
+        rotated += frames[..., indices[k]] * weights[k]
+    return rotated
+
+
+def plot_realigned_reconstruction(rotated_recon_m, reshrot_recon_m):
+    """plot_realigned_reconstruction shows the median realigned reconstruction of a fold,
+    as returned by decode_cv_prfs. Kept separate from the decoding so that batch runs
+    don't need matplotlib.
+    """
+    import matplotlib.pyplot as pl
+
+    pl.figure(figsize=(24,7))
+    pl.imshow(rotated_recon_m)
+    pl.figure(figsize=(12,6))
+    pl.imshow(np.median(reshrot_recon_m, axis = 0), aspect = 0.5)
@@ -0,0 +1,151 @@
+import numpy as np
+
+from .fit import (firstpass_decoder_independent_channels_batch, calculate_bold_loglikelihood_batch, maximize_loglikelihood_batch,
+                  _apply_mapping)
+from .kernels import quadratic_forms
+from .metrics import decoding_metrics
+
+
+def bar_design_stimuli(mask, nr_timepoints=462):
+    """bar_design_stimuli is the bar design of the pRF mapping experiment, from
+    create_visual_designmatrix_all, as (n_masked_pixels, nr_timepoints) stimuli
+    for the pixels of mask, the (n_pix, n_pix) mask of setup_data_from_h5."""
+    from .utils import create_visual_designmatrix_all
+
+    visual_dm = create_visual_designmatrix_all(n_pixels=mask.shape[0], nr_timepoints=nr_timepoints)
+    return visual_dm[mask].astype(np.float64)
+
+
+def simulate_bold(stimuli, W, omega_inv, mapping_relation=None, mapping_parameters=[], noise=True, seed=0):
+    """simulate_bold predicts the bold patterns of stimuli (n_pixels, n_stimuli) from the
+    encoding model, with noise drawn from the model omega if noise is set.
+
+    The noise is L^-T z, with omega_inv = L L^T and z standard normal, whose
+    covariance is omega, so that omega itself is not needed.
+
+    Returns
+    -------
+    bolds : numpy.ndarray, (n_voxels, n_stimuli)
+    """
+    bolds = _apply_mapping(W.dot(stimuli), mapping_relation, mapping_parameters)
+    if noise:
+        from scipy.linalg import solve_triangular
+        rng = np.random.RandomState(seed)
+        omega_inv_chol = np.linalg.cholesky(omega_inv)
+        bolds = bolds + solve_triangular(omega_inv_chol, rng.randn(*bolds.shape), lower=True, trans='T')
+    return bolds
+
+
+def pixel_sensitivity(W, omega_inv, mapping_relation=None, mapping_parameters=[]):
+    """pixel_sensitivity is the discriminability d' of every single pixel against
+    the empty screen, the Mahalanobis distance under omega between their predicted
+    bold patterns.
+
+    Returns
+    -------
+    sensitivity : numpy.ndarray, (n_pixels,)
+    """
+    predictors = np.zeros((W.shape[0], W.shape[1] + 1))
+    predictors[:, 1:] = W
+    predictors = _apply_mapping(predictors, mapping_relation, mapping_parameters)
+    return np.sqrt(np.clip(quadratic_forms(omega_inv, predictors[:, 0], predictors[:, 1:]), 0, None))
+
+
+def robustness_report(W, logdet, omega_inv, mapping_relation=None, mapping_parameters=[], mask=None,
+                      n_random=200, density=0.1, n_probe_repeats=5, noise=True, seed=0, chunk_size=4096, n_map=0, n_jobs=1):
+    """robustness_report evaluates a fitted encoding model and omega by decoding
+    simulated bold patterns of known stimuli with the batched firstpass decoder,
+    as a routine check of every new omega fit.
+
+    The stimulus sets are random binary images with a fraction density of pixels on,
+    single-pixel probes (every pixel n_probe_repeats times) and, if mask is given,
+    the bar design of the experiment (see bar_design_stimuli). Every set is
+    simulated with simulate_bold and decoded in a single batch, the probes in
+    batches of chunk_size, so that their memory does not grow with n_pixels**2.
+    Optionally, a random subsample of n_map stimuli of every set is also decoded
+    with the MAP decoder (see maximize_loglikelihood_batch), from the firstpass.
+
+    Parameters
+    ----------
+    W, logdet, omega_inv, mapping_relation, mapping_parameters :
+        as in decode_fold, e.g. from setup_data_from_h5, fit_model_omega and prf_mapping
+    mask : numpy.ndarray, bool
+        (n_pix, n_pix) mask of the pixels in W, to include the bar design
+    chunk_size : int
+        number of single-pixel probes simulated and decoded at a time
+    n_map : int
+        number of stimuli of every set decoded with the MAP decoder, 0 skips it
+    n_jobs : int
+        processes of the MAP decoder, see maximize_loglikelihood_batch
+
+    Returns
+    -------
+    report : dict
+        sensitivity : (n_pixels,) d' of every pixel, see pixel_sensitivity
+        probe_hit_rate : (n_pixels,) fraction of the probes of every pixel whose
+            firstpass image peaks at that pixel
+        probe_localisation_error : (n_pixels,) mean distance in pixels between the
+            firstpass peak and the probed pixel, if mask is given
+        and per stimulus set ('random', 'bar'), a dict with
+            correlation : (n_stimuli,) correlation of the firstpass image with the stimulus
+            identification : (n_stimuli,) identification accuracy among the set, 0.5 is chance
+            logl_ratio : (n_stimuli,) log-likelihood of the firstpass image (thresholded
+                at 0.5) minus that of the true stimulus, 0 if the decoder finds a stimulus as likely as the truth
+            and if n_map > 0
+            map_stimuli : (n_map,) indices of the stimuli decoded with the MAP decoder
+            map_correlation : (n_map,) correlation of their MAP image with the stimulus
+            map_logl_ratio : (n_map,) as logl_ratio, for their MAP image
+    """
+    rng = np.random.RandomState(seed)
+    n_pixels = W.shape[1]
+
+    stimulus_sets = {'random': (rng.rand(n_pixels, n_random) < density).astype(np.float64)}
+    if mask is not None:
+        stimulus_sets['bar'] = bar_design_stimuli(mask)
+
+    report = dict(sensitivity=pixel_sensitivity(W, omega_inv, mapping_relation, mapping_parameters))
+
+    # single pixel probes, generated and decoded in chunks, of which only the peaks are kept
+    all_probed_pixels = np.repeat(np.arange(n_pixels), n_probe_repeats)
+    hits, distances = np.zeros(n_pixels), np.zeros(n_pixels)
+    if mask is not None:
+        coordinates = np.array(np.nonzero(mask)).T
+    for start in range(0, all_probed_pixels.shape[0], chunk_size):
+        probed_pixels = all_probed_pixels[start:start + chunk_size]
+        probes = np.zeros((n_pixels, probed_pixels.shape[0]))
+        probes[probed_pixels, np.arange(probed_pixels.shape[0])] = 1.0
+        bolds = simulate_bold(probes, W, omega_inv, mapping_relation, mapping_parameters, noise=noise, seed=seed + start)
+        firstpass = firstpass_decoder_independent_channels_batch(W, bolds, logdet, omega_inv, mapping_relation, mapping_parameters)
+        peaks = np.argmax(firstpass, axis=0)
+        hits += np.bincount(probed_pixels, weights=peaks == probed_pixels, minlength=n_pixels)
+        if mask is not None:
+            distances += np.bincount(probed_pixels, weights=np.sqrt(((coordinates[peaks] - coordinates[probed_pixels])**2).sum(axis=1)),
+                                     minlength=n_pixels)
+    report['probe_hit_rate'] = hits / n_probe_repeats
+    if mask is not None:
+        report['probe_localisation_error'] = distances / n_probe_repeats
+
+    for name, stimuli in stimulus_sets.items():
+        bolds = simulate_bold(stimuli, W, omega_inv, mapping_relation, mapping_parameters, noise=noise, seed=seed + 1)
+        firstpass = firstpass_decoder_independent_channels_batch(W, bolds, logdet, omega_inv, mapping_relation, mapping_parameters)
+        metrics = decoding_metrics(firstpass.T, stimuli.T, lags=[0], lag=0)
+
+        negative_logl_true = calculate_bold_loglikelihood_batch(stimuli, W, bolds, logdet, omega_inv, mapping_relation, mapping_parameters)
+        negative_logl_decoded = calculate_bold_loglikelihood_batch((firstpass > 0.5).astype(np.float64), W, bolds, logdet, omega_inv,
+                                                                   mapping_relation, mapping_parameters)
+        report[name] = dict(correlation=metrics['correlation'],
+                            identification=metrics['identification'],
+                            logl_ratio=negative_logl_true - negative_logl_decoded)
+
+        if n_map > 0:
+            map_stimuli = np.sort(rng.choice(stimuli.shape[1], min(n_map, stimuli.shape[1]), replace=False))
+            _, map_images = maximize_loglikelihood_batch(firstpass[:, map_stimuli], W, bolds[:, map_stimuli], logdet, omega_inv,
+                                                         mapping_relation, mapping_parameters, n_jobs=n_jobs)
+            map_metrics = decoding_metrics(map_images.T, stimuli[:, map_stimuli].T, lags=[0], lag=0)
+            negative_logl_map = calculate_bold_loglikelihood_batch(map_images, W, bolds[:, map_stimuli], logdet, omega_inv,
+                                                                   mapping_relation, mapping_parameters)
+            report[name].update(map_stimuli=map_stimuli,
+                                map_correlation=map_metrics['correlation'],
+                                map_logl_ratio=negative_logl_true[map_stimuli] - negative_logl_map)
+
+    return report
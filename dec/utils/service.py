@@ -0,0 +1,368 @@
+"""Local decoding service: decodes bold patterns sent over a socket with a decoder bundle.
+
+Requests that arrive within batch_window of each other are decoded together, as
+the columns of one batched firstpass and likelihood, so that concurrent clients
+share the matrix products. Start it with::
+
+    python -m dec.utils.service V1.decoder --port 8765
+
+and decode from the acquisition software with DecoderClient::
+
+    client = DecoderClient(port=8765)
+    image, logl = client.decode(bold)
+
+Every message is a 4-byte big-endian header length, a JSON header and, if the
+header has a shape, the raw array bytes in the header's dtype. Requests are
+{"op": "decode", "shape": [n_voxels], "dtype": "<f8"} followed by the bold pattern,
+or {"op": "stats"}. Decode responses hold the (n_pixels,) firstpass image, its
+log-likelihood and the server-side latency in seconds.
+"""
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+from .bundle import load_decoder
+
+_HEADER_LENGTH = struct.Struct('>I')
+
+# the decoder of a worker process, loaded once by _load_worker
+_worker_decoder = None
+
+
+def _decode_batch(decoder, bolds):
+    """firstpass images (n_pixels, n_requests) of bolds (n_voxels, n_requests) and their log-likelihoods."""
+    images = decoder.firstpass(bolds)
+    return images, decoder.loglikelihood(images, bolds)
+
+
+def _load_worker(path):
+    global _worker_decoder
+    _worker_decoder = load_decoder(path)
+
+
+def _worker_decode_batch(bolds):
+    return _decode_batch(_worker_decoder, bolds)
+
+
+def _encode_message(header, array=None):
+    header = dict(header)
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header['shape'], header['dtype'] = list(array.shape), array.dtype.str
+    header = json.dumps(header).encode()
+    message = _HEADER_LENGTH.pack(len(header)) + header
+    if array is not None:
+        message += array.tobytes()
+    return message
+
+
+def _payload_size(header):
+    if 'shape' not in header:
+        return 0
+    return int(np.prod(header['shape'])) * np.dtype(header['dtype']).itemsize
+
+
+def _decode_payload(header, payload):
+    return np.frombuffer(payload, dtype=header['dtype']).reshape(header['shape'])
+
+
+class DecoderService(object):
+    """DecoderService serves decode requests with a DecoderBundle, see the module docstring.
+
+    Parameters
+    ----------
+    decoder : DecoderBundle
+        from load_decoder
+    batch_window : float
+        seconds to wait for more requests after the first of a batch
+    max_batch : int
+        maximum number of requests decoded together
+    n_workers : int
+        number of batches decoded at the same time
+    use_processes : bool
+        decode in worker processes, which load the bundle from decoder.path and
+        so share its memory-mapped pages, rather than in threads of this process
+    latency_window : int
+        number of recent requests the latency statistics are computed over
+    """
+
+    def __init__(self, decoder, batch_window=0.002, max_batch=64, n_workers=2, use_processes=False, latency_window=10000):
+        super(DecoderService, self).__init__()
+        self.decoder = decoder
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.n_workers = n_workers
+        self.use_processes = use_processes
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.batch_sizes = collections.deque(maxlen=latency_window)
+        self.n_requests = 0
+
+    def stats(self):
+        """latency percentiles in milliseconds and batch sizes of the recent requests."""
+        stats = dict(n_requests=self.n_requests)
+        if len(self.latencies) > 0:
+            latencies = 1e3 * np.array(self.latencies)
+            for percentile in [50, 90, 99]:
+                stats['latency_p%i_ms' % percentile] = float(np.percentile(latencies, percentile))
+            stats['latency_max_ms'] = float(latencies.max())
+            stats['mean_batch_size'] = float(np.mean(self.batch_sizes))
+        return stats
+
+    async def _batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._requests.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._requests.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # wait for a free worker, so that requests keep coalescing while all are busy
+            await self._free_workers.acquire()
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            bolds = np.array([bold for bold, future in batch]).T
+            images, logls = await loop.run_in_executor(self._executor, self._decode, bolds)
+            for i, (bold, future) in enumerate(batch):
+                if not future.cancelled():
+                    future.set_result((images[:, i], float(logls[i]), len(batch)))
+        except Exception as exception:
+            for bold, future in batch:
+                if not future.done():
+                    future.set_exception(exception)
+        finally:
+            self._free_workers.release()
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        connection = asyncio.current_task()
+        self._connections[connection] = writer
+        try:
+            while True:
+                try:
+                    length = _HEADER_LENGTH.unpack(await reader.readexactly(_HEADER_LENGTH.size))[0]
+                except asyncio.IncompleteReadError:
+                    break
+                header = json.loads(await reader.readexactly(length))
+                payload = await reader.readexactly(_payload_size(header))
+                start = time.perf_counter()
+
+                if header.get('op') == 'stats':
+                    writer.write(_encode_message(self.stats()))
+                elif header.get('op') == 'decode':
+                    bold = _decode_payload(header, payload).astype(np.float64)
+                    if bold.shape != (self.decoder.W.shape[0],):
+                        writer.write(_encode_message(dict(id=header.get('id'), error='expected %i voxels, got shape %s'
+                                                          % (self.decoder.W.shape[0], bold.shape))))
+                    else:
+                        future = loop.create_future()
+                        await self._requests.put((bold, future))
+                        try:
+                            image, logl, batch_size = await future
+                        except Exception as exception:
+                            writer.write(_encode_message(dict(id=header.get('id'), error=repr(exception))))
+                        else:
+                            latency = time.perf_counter() - start
+                            self.latencies.append(latency)
+                            self.batch_sizes.append(batch_size)
+                            self.n_requests += 1
+                            writer.write(_encode_message(dict(id=header.get('id'), logl=logl, latency=latency,
+                                                              batch_size=batch_size), image))
+                else:
+                    writer.write(_encode_message(dict(id=header.get('id'), error='unknown op %r' % header.get('op'))))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self._connections[connection]
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, ready=None):
+        """serve requests on host:port until cancelled. ready, a threading.Event, is set
+        once the server listens, with the bound (host, port) in self.address."""
+        self._requests = asyncio.Queue()
+        self._connections = {}
+        self._free_workers = asyncio.Semaphore(self.n_workers)
+        if self.use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_load_worker,
+                                                 initargs=(self.decoder.path,))
+            self._decode = _worker_decode_batch
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+            self._decode = lambda bolds: _decode_batch(self.decoder, bolds)
+
+        server = await asyncio.start_server(self._handle, host, port)
+        self.address = server.sockets[0].getsockname()[:2]
+        batches = asyncio.ensure_future(self._batches())
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # closing the connections ends their handlers, at the next read
+            for writer in list(self._connections.values()):
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            batches.cancel()
+            self._executor.shutdown(wait=False)
+
+
+def start_background_service(decoder, host='127.0.0.1', port=0, **kwargs):
+    """start_background_service runs a DecoderService in a daemon thread of this process,
+    e.g. to try clients against it. port 0 picks a free port.
+
+    Returns
+    -------
+    service : DecoderService
+        service.address is the (host, port) to connect to
+    stop : callable
+        stops the service
+    """
+    service = DecoderService(decoder, **kwargs)
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(service.serve(host, port, ready=ready))
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            ready.set()
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+    if task.done() and not task.cancelled() and task.exception() is not None:
+        raise task.exception()
+
+    def stop():
+        loop.call_soon_threadsafe(task.cancel)
+        thread.join()
+
+    return service, stop
+
+
+class DecoderClient(object):
+    """DecoderClient is a blocking client of a DecoderService, for one thread.
+    Concurrent clients, each with their own connection, are batched by the service."""
+
+    def __init__(self, host='127.0.0.1', port=8765, timeout=10.0):
+        super(DecoderClient, self).__init__()
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._next_id = 0
+
+    def _receive(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('decoder service closed the connection')
+            data.extend(chunk)
+        return bytes(data)
+
+    def _request(self, header, array=None):
+        self.socket.sendall(_encode_message(header, array))
+        header = json.loads(self._receive(_HEADER_LENGTH.unpack(self._receive(_HEADER_LENGTH.size))[0]))
+        if 'error' in header:
+            raise ValueError(header['error'])
+        payload = self._receive(_payload_size(header))
+        return header, (_decode_payload(header, payload) if 'shape' in header else None)
+
+    def decode(self, bold):
+        """firstpass image (n_pixels,) of bold (n_voxels,) and its log-likelihood."""
+        self._next_id += 1
+        header, image = self._request(dict(op='decode', id=self._next_id), np.asarray(bold, dtype=np.float64))
+        return image, header['logl']
+
+    def stats(self):
+        """the latency statistics of the service, see DecoderService.stats."""
+        return self._request(dict(op='stats'))[0]
+
+    def close(self):
+        self.socket.close()
+
+
+def benchmark(address, bolds, n_clients=4):
+    """benchmark decodes the columns of bolds (n_voxels, n_timepoints) with n_clients
+    concurrent DecoderClients, as the scanner side would, each sending every
+    n_clients-th timepoint.
+
+    Returns
+    -------
+    images : numpy.ndarray, (n_pixels, n_timepoints)
+    stats : dict
+        client-side latency percentiles in milliseconds and throughput
+    """
+    images = [None] * bolds.shape[1]
+    latencies = [None] * bolds.shape[1]
+
+    def run(first):
+        client = DecoderClient(*address)
+        try:
+            for t in range(first, bolds.shape[1], n_clients):
+                start = time.perf_counter()
+                images[t] = client.decode(bolds[:, t])[0]
+                latencies[t] = time.perf_counter() - start
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(first,)) for first in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies = 1e3 * np.array(latencies)
+    stats = dict(('latency_p%i_ms' % percentile, float(np.percentile(latencies, percentile))) for percentile in [50, 90, 99])
+    stats['requests_per_second'] = bolds.shape[1] / duration
+    return np.array(images).T, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='serve a decoder bundle on a local socket')
+    parser.add_argument('bundle', help='decoder bundle directory, see save_decoder')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--batch-window', type=float, default=0.002, help='seconds to coalesce requests')
+    parser.add_argument('--max-batch', type=int, default=64, help='maximum requests per batch')
+    parser.add_argument('--workers', type=int, default=2, help='number of batches decoded at the same time')
+    parser.add_argument('--processes', action='store_true', help='decode in worker processes rather than threads')
+    args = parser.parse_args(argv)
+
+    decoder = load_decoder(args.bundle)
+    if decoder is None:
+        return 1
+    service = DecoderService(decoder, batch_window=args.batch_window, max_batch=args.max_batch,
+                             n_workers=args.workers, use_processes=args.processes)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print(json.dumps(service.stats()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
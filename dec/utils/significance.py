@@ -0,0 +1,239 @@
+import numpy as np
+
+from .fit import firstpass_decoder_independent_channels_batch
+from .metrics import _frames, _normalised, _lag_pairs
+
+# null distributions of reconstruction quality without decoding again. Reconstructions
+# are decoded per timepoint, so shuffling the timepoints of the test data shuffles the
+# decoded frames: the null of pairing_null reads every permutation from the matrix of
+# correlations of all decoded with all presented frames, computed once as in
+# decoding_metrics. Permutations are index arrays into that matrix. Only nulls that
+# change the decoded frames themselves (voxel_shift_null) decode again, with the
+# batched firstpass. Frames are as in metrics: (n_timepoints, ...) arrays, with a mask.
+
+
+def permutation_p_value(observed, null, alternative='greater'):
+    """permutation_p_value is the fraction of the null at least as extreme as observed,
+    counting observed itself, so that it is never 0.
+
+    Parameters
+    ----------
+    observed : float
+    null : numpy.ndarray
+        (n_permutations,) null statistics, NaNs are ignored
+    alternative : str
+        'greater' or 'less'
+
+    Returns
+    -------
+    p_value : float
+    """
+    null = np.asarray(null)
+    null = null[~np.isnan(null)]
+    if alternative == 'greater':
+        extreme = np.sum(null >= observed)
+    elif alternative == 'less':
+        extreme = np.sum(null <= observed)
+    else:
+        raise ValueError('unknown alternative ' + str(alternative))
+    return (1.0 + extreme) / (1.0 + null.shape[0])
+
+
+def _row_ranks(correlation):
+    """identification score of every element of correlation among the non-NaN
+    elements of its row, as in decoding_metrics: the fraction of the others that
+    are smaller, ties counting half. NaN where the correlation is NaN."""
+    valid = ~np.isnan(correlation)
+    filled = np.where(valid, correlation, np.inf)
+    sorted_rows = np.sort(filled, axis=1)
+    ranks = np.zeros(correlation.shape)
+    for i in range(correlation.shape[0]):
+        below = np.searchsorted(sorted_rows[i], filled[i], side='left')
+        not_above = np.searchsorted(sorted_rows[i], filled[i], side='right')
+        ranks[i] = below + 0.5 * (not_above - below - 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ranks = ranks / (valid.sum(axis=1) - 1)[:, np.newaxis]
+    ranks[~valid] = np.nan
+    return ranks
+
+
+def _null_indices(kind, n_timepoints, n_permutations, min_shift, rng):
+    """(n_permutations, n_timepoints) decoded frame of every timepoint under the null."""
+    timepoints = np.arange(n_timepoints)
+    if kind == 'circular':
+        shifts = np.arange(min_shift, n_timepoints - min_shift + 1)
+        if shifts.shape[0] == 0:
+            raise ValueError('min_shift leaves no circular shifts')
+        if n_permutations is None or n_permutations >= shifts.shape[0]:
+            # every shift once, the exact null
+            selected = shifts
+        else:
+            selected = rng.choice(shifts, n_permutations, replace=False)
+        return (timepoints[np.newaxis, :] + selected[:, np.newaxis]) % n_timepoints
+    elif kind == 'permutation':
+        if n_timepoints < 2:
+            raise ValueError('a permutation null needs at least 2 timepoints')
+        permutations = np.argsort(rng.rand(n_permutations, n_timepoints), axis=1)
+        # the identity is the observed pairing, not a null sample
+        identity = np.all(permutations == timepoints, axis=1)
+        while identity.any():
+            permutations[identity] = np.argsort(rng.rand(identity.sum(), n_timepoints), axis=1)
+            identity = np.all(permutations == timepoints, axis=1)
+        return permutations
+    raise ValueError('unknown null ' + str(kind))
+
+
+def pairing_null(decoded, presented, mask=None, lag=0, kind='circular', n_permutations=1000, min_shift=1,
+                 seed=0, chunk_size=1024):
+    """pairing_null tests whether decoded frames match the frames presented lag
+    timepoints earlier better than they match other presented frames.
+
+    The null pairs decoded and presented frames by circularly shifting the decoded
+    timecourse ('circular', which keeps its autocorrelation) or by permuting its
+    timepoints ('permutation'). As decoding is independent per timepoint, this is
+    the null of decoding shifted or permuted test data, and all of it is read from
+    one correlation matrix.
+
+    Parameters
+    ----------
+    decoded, presented, mask, lag :
+        as in decoding_metrics
+    kind : str
+        'circular' or 'permutation'
+    n_permutations : int
+        number of null samples. For 'circular', None or more than the number of
+        shifts uses every shift once.
+    min_shift : int
+        smallest circular shift, in timepoints, in either direction
+    chunk_size : int
+        null samples evaluated at a time
+
+    Returns
+    -------
+    result : dict
+        correlation, identification : the observed mean frame correlation and identification
+        null_correlation, null_identification : (n_permutations,) their null distributions
+        p_correlation, p_identification : permutation p-values, see permutation_p_value
+    """
+    decoded_frames = _normalised(_frames(decoded, mask))
+    presented_frames = _normalised(_frames(presented, mask))
+    n_timepoints = decoded_frames.shape[0]
+
+    # correlation[i, j] of decoded frame i and presented frame j, and the identification score of each
+    correlation = decoded_frames.dot(presented_frames.T)
+    ranks = _row_ranks(correlation)
+
+    decoded_index, presented_index = _lag_pairs(n_timepoints, lag)
+    with np.errstate(invalid='ignore'):
+        observed_correlation = np.nanmean(correlation[decoded_index, presented_index])
+        observed_identification = np.nanmean(ranks[decoded_index, presented_index])
+
+    rng = np.random.RandomState(seed)
+    null_decoded = _null_indices(kind, n_timepoints, n_permutations, min_shift, rng)
+    null_correlation = np.zeros(null_decoded.shape[0])
+    null_identification = np.zeros(null_decoded.shape[0])
+    for start in range(0, null_decoded.shape[0], chunk_size):
+        # the decoded frame paired with presented frame t under every null sample
+        paired = null_decoded[start:start + chunk_size][:, decoded_index]
+        with np.errstate(invalid='ignore'):
+            null_correlation[start:start + chunk_size] = np.nanmean(correlation[paired, presented_index], axis=1)
+            null_identification[start:start + chunk_size] = np.nanmean(ranks[paired, presented_index], axis=1)
+
+    return dict(correlation=observed_correlation,
+                identification=observed_identification,
+                null_correlation=null_correlation,
+                null_identification=null_identification,
+                p_correlation=permutation_p_value(observed_correlation, null_correlation),
+                p_identification=permutation_p_value(observed_identification, null_identification))
+
+
+def voxel_shift_null(W, bolds, logdet, omega_inv, presented, mapping_relation=None, mapping_parameters=[], mask=None,
+                     lag=0, n_permutations=1000, min_shift=1, seed=0, chunk_size=16):
+    """voxel_shift_null tests whether the firstpass reconstructions of the test data
+    depend on the voxels' pattern across voxels, by circularly shifting the
+    timecourse of every voxel by its own random shift, which keeps the timecourses
+    but breaks their alignment.
+
+    The shifted data of chunk_size null samples are gathered with index arrays into
+    one (n_voxels, chunk_size*n_timepoints) array and decoded with a single batched
+    firstpass, see firstpass_decoder_independent_channels_batch.
+
+    Parameters
+    ----------
+    W, bolds, logdet, omega_inv, mapping_relation, mapping_parameters :
+        as in decode_fold, with bolds the (n_voxels, n_timepoints) test data
+    presented : numpy.ndarray
+        (n_timepoints, ...) presented frames, selected with mask to the pixels of W
+    lag, min_shift, seed :
+        as in pairing_null
+
+    Returns
+    -------
+    result : dict
+        correlation : observed mean frame correlation of the firstpass reconstruction
+        null_correlation : (n_permutations,)
+        p_correlation : permutation p-value
+    """
+    n_voxels, n_timepoints = bolds.shape
+    presented_frames = _normalised(_frames(presented, mask))
+    decoded_index, presented_index = _lag_pairs(n_timepoints, lag)
+
+    def mean_correlation(firstpass):
+        # firstpass (n_pixels, n_samples*n_timepoints)
+        frames = _normalised(firstpass.T).reshape((-1, n_timepoints, firstpass.shape[0]))
+        with np.errstate(invalid='ignore'):
+            return np.nanmean(np.sum(frames[:, decoded_index] * presented_frames[presented_index], axis=-1), axis=1)
+
+    def decode(data):
+        return firstpass_decoder_independent_channels_batch(W, data, logdet, omega_inv, mapping_relation, mapping_parameters)
+
+    observed = mean_correlation(decode(bolds))[0]
+
+    rng = np.random.RandomState(seed)
+    timepoints = np.arange(n_timepoints)
+    null_correlation = np.zeros(n_permutations)
+    for start in range(0, n_permutations, chunk_size):
+        n_samples = min(chunk_size, n_permutations - start)
+        shifts = rng.randint(min_shift, n_timepoints - min_shift + 1, size=(n_samples, n_voxels))
+        # (n_voxels, n_samples, n_timepoints) timepoint of every voxel in every sample
+        index = (timepoints[np.newaxis, np.newaxis, :] + shifts.T[:, :, np.newaxis]) % n_timepoints
+        shifted = bolds[np.arange(n_voxels)[:, np.newaxis, np.newaxis], index].reshape((n_voxels, -1))
+        null_correlation[start:start + n_samples] = mean_correlation(decode(shifted))
+
+    return dict(correlation=observed,
+                null_correlation=null_correlation,
+                p_correlation=permutation_p_value(observed, null_correlation))
+
+
+def fold_bootstrap(values, n_bootstrap=10000, null_value=0.0, ci=95, seed=0):
+    """fold_bootstrap resamples the folds of per-fold, per-timepoint values (e.g. the
+    frame correlations of every fold from decoding_metrics) with replacement, for a
+    confidence interval of their mean. The resampled folds are index arrays, and
+    every bootstrap sample is a mean of the per-fold means.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        (n_folds, n_timepoints), NaNs are ignored
+    null_value : float
+        value of the mean under the null
+    ci : float
+        width of the percentile confidence interval, in percent
+
+    Returns
+    -------
+    result : dict
+        mean : mean over folds of the per-fold means
+        ci : (2,) confidence interval
+        bootstrap : (n_bootstrap,) bootstrap distribution of the mean
+        p_value : fraction of the bootstrap distribution at or below null_value, see permutation_p_value
+    """
+    with np.errstate(invalid='ignore'):
+        fold_means = np.nanmean(np.asarray(values, dtype=np.float64), axis=1)
+    rng = np.random.RandomState(seed)
+    folds = rng.randint(0, fold_means.shape[0], size=(n_bootstrap, fold_means.shape[0]))
+    bootstrap = np.nanmean(fold_means[folds], axis=1)
+    return dict(mean=np.nanmean(fold_means),
+                ci=np.nanpercentile(bootstrap, [50 - ci / 2.0, 50 + ci / 2.0]),
+                bootstrap=bootstrap,
+                p_value=permutation_p_value(null_value, bootstrap, alternative='less'))
@@ -0,0 +1,205 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .utils import roi_data_from_cache, get_figshare_data
+from .omega import fit_model_omega
+from .prf import setup_data_from_h5, crossvalidated_rsq, prf_mapping, decode_fold
+from .realign import realign_reconstructions
+
+# the stages of decode_cv_prfs, and the sweep parameters their output depends on.
+# each stage uses the output of the one before it, whose parameters are a subset of its own.
+# 'setup' runs at the lowest rsq_threshold of the sweep; since voxels are selected on an rsq that is
+# the same for all folds and everything else is computed per voxel, 'voxels' just slices out the
+# voxels of a higher rsq_threshold (including their rows and columns of the residual covariance).
+STAGE_PARAMETERS = {
+    'setup': ('n_pix', 'cv_fold'),
+    'voxels': ('n_pix', 'cv_fold', 'rsq_threshold'),
+    'omega': ('n_pix', 'cv_fold', 'rsq_threshold'),
+    'decode': ('n_pix', 'cv_fold', 'rsq_threshold', 'mapping'),
+}
+
+
+def _fit_omega_job(args):
+    all_residual_covariance_css, W, x0, x0_voxels, voxels = args
+    return fit_model_omega(observed_residual_covariance=all_residual_covariance_css, WWT=None, W=W, verbose=0,
+                           x0=x0, x0_voxels=x0_voxels, voxels=voxels, return_parameters=True)
+
+
+def _decode_job(args):
+    # the sweep runs its decodings in parallel, each in a single process
+    return decode_fold(*args, n_jobs=1)
+
+
+class DecodingSweep(object):
+    """DecodingSweep runs decode_cv_prfs over a grid of n_pix, rsq_threshold and mapping
+    settings, memoising the output of every pipeline stage (see STAGE_PARAMETERS)
+    by the parameters it depends on. Stages are only recomputed for parameters
+    they depend on, also across calls of run, and the expensive omega fits and
+    decodings of different sweep points run in parallel processes. Omega fits of
+    higher rsq thresholds are warm started from that of the lowest threshold.
+
+    The remaining arguments are those of decode_cv_prfs, and are fixed for the sweep.
+    """
+
+    def __init__(self, data_file, mask_name='V1', n_folds=6, extent=[-5, 5], screen_distance=225, screen_width=69.0, TR=0.945, n_jobs=None):
+        super(DecodingSweep, self).__init__()
+        self.data_file = data_file
+        self.mask_name = mask_name
+        self.n_folds = n_folds
+        self.extent = extent
+        self.screen_distance = screen_distance
+        self.screen_width = screen_width
+        self.TR = TR
+        self.n_jobs = n_jobs
+
+        self.cache = {}
+        self.rsq_crossv = None
+
+    def _key(self, stage, point):
+        return (stage,) + tuple(point[p] for p in STAGE_PARAMETERS[stage])
+
+    def _map(self, function, jobs):
+        if self.n_jobs == 1:
+            return list(map(function, jobs))
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            return list(executor.map(function, jobs))
+
+    def voxel_rsq(self):
+        """crossvalidated rsq of all voxels in the ROI, as used for voxel selection."""
+        if self.rsq_crossv is None:
+            hdf5_file = get_figshare_data(self.data_file)
+            all_prf_data = roi_data_from_cache(['*all'], self.mask_name, hdf5_file, 'all_prf')
+            prf_data = roi_data_from_cache(['*all'], self.mask_name, hdf5_file, 'prf').reshape((all_prf_data.shape[0], -1, all_prf_data.shape[-1]))
+            self.rsq_crossv = crossvalidated_rsq(prf_data)
+        return self.rsq_crossv
+
+    def voxel_indices(self, rsq_threshold):
+        """indices into the voxels of the ROI of the voxels selected at rsq_threshold."""
+        return np.where(self.voxel_rsq() > rsq_threshold)[0]
+
+    def setup(self, point):
+        """setup_data_from_h5 output at a threshold at most point['rsq_threshold'], and that threshold."""
+        key = self._key('setup', point)
+        if key not in self.cache or self.cache[key][0] > point['rsq_threshold']:
+            self.cache[key] = (point['rsq_threshold'],
+                               setup_data_from_h5(data_file=self.data_file,
+                                                  n_pix=point['n_pix'],
+                                                  extent=self.extent,
+                                                  screen_distance=self.screen_distance,
+                                                  screen_width=self.screen_width,
+                                                  rsq_threshold=point['rsq_threshold'],
+                                                  TR=self.TR,
+                                                  cv_fold=point['cv_fold'],
+                                                  n_folds=self.n_folds,
+                                                  use_median=False,
+                                                  mask_name=self.mask_name,
+                                                  plot=False))
+        return self.cache[key]
+
+    def voxels(self, point):
+        """setup_data_from_h5 output for the voxels selected at point['rsq_threshold']."""
+        key = self._key('voxels', point)
+        if key not in self.cache:
+            setup_threshold, (prf_cv_fold_data, W, all_residuals_css, all_residual_covariance_css, test_data, mask) = self.setup(point)
+            rsq = self.voxel_rsq()
+            subset = rsq[rsq > setup_threshold] > point['rsq_threshold']
+            self.cache[key] = (prf_cv_fold_data[subset],
+                               W[subset],
+                               all_residuals_css[subset],
+                               all_residual_covariance_css[np.ix_(subset, subset)],
+                               test_data[subset],
+                               mask)
+        return self.cache[key]
+
+    def run(self, n_pix=[21], rsq_threshold=[0.5], mapping=['css']):
+        """run decodes every combination of the n_pix, rsq_threshold and mapping lists.
+
+        Returns
+        -------
+        results : list
+            one (settings, result) tuple per sweep point, with settings a dict of its
+            n_pix, rsq_threshold and mapping, and result a dict with
+            cv_recon (n_folds, n_timepoints, n_pix, n_pix) reconstructions,
+            cv_rotated_recon and cv_reshrot_recon_m as returned by decode_cv_prfs,
+            and per fold the omega parameters cv_estimated_rho and cv_estimated_sigma.
+            result is None for sweep points where the omega fit of a fold failed.
+        """
+        settings = [dict(n_pix=n, rsq_threshold=r, mapping=m) for n, r, m in itertools.product(n_pix, rsq_threshold, mapping)]
+        points = [dict(setting, cv_fold=i) for setting in settings for i in range(self.n_folds)]
+
+        # set up the data for the lowest threshold first, the others slice it
+        for point in sorted(points, key=lambda point: point['rsq_threshold']):
+            self.voxels(point)
+
+        # omega fits and decodings that have not been done yet, in parallel.
+        # the omega fits of the lowest threshold of every (n_pix, cv_fold) go first,
+        # those of higher thresholds are warm started from them.
+        omega_points = list({self._key('omega', point): point for point in points
+                             if self._key('omega', point) not in self.cache}.values())
+        lowest_threshold = {}
+        for point in points:
+            setup_key = self._key('setup', point)
+            lowest_threshold[setup_key] = min(lowest_threshold.get(setup_key, np.inf), point['rsq_threshold'])
+        cold_points = [point for point in omega_points if point['rsq_threshold'] == lowest_threshold[self._key('setup', point)]]
+        warm_points = [point for point in omega_points if point['rsq_threshold'] != lowest_threshold[self._key('setup', point)]]
+
+        omega_fits = self._map(_fit_omega_job, [(self.voxels(point)[3], self.voxels(point)[1], None, None, None)
+                                                for point in cold_points])
+        for point, omega_fit in zip(cold_points, omega_fits):
+            self.cache[self._key('omega', point)] = omega_fit
+
+        warm_jobs = []
+        for point in warm_points:
+            start_point = dict(point, rsq_threshold=lowest_threshold[self._key('setup', point)])
+            start_fit = self.cache[self._key('omega', start_point)]
+            if start_fit is None:
+                # the fit to start from failed, fit this threshold from scratch
+                warm_jobs.append((self.voxels(point)[3], self.voxels(point)[1], None, None, None))
+            else:
+                warm_jobs.append((self.voxels(point)[3], self.voxels(point)[1],
+                                  start_fit[7],
+                                  self.voxel_indices(start_point['rsq_threshold']),
+                                  self.voxel_indices(point['rsq_threshold'])))
+        omega_fits = self._map(_fit_omega_job, warm_jobs)
+        for point, omega_fit in zip(warm_points, omega_fits):
+            self.cache[self._key('omega', point)] = omega_fit
+
+        # points whose omega fit failed are not decoded
+        decode_points = list({self._key('decode', point): point for point in points
+                              if self._key('decode', point) not in self.cache
+                              and self.cache[self._key('omega', point)] is not None}.values())
+        decode_jobs = []
+        for point in decode_points:
+            prf_cv_fold_data, W, _, _, test_data, _ = self.voxels(point)
+            omega_inv, logdet = self.cache[self._key('omega', point)][5:7]
+            mapping_relation, mapping_parameters = prf_mapping(point['mapping'], prf_cv_fold_data)
+            decode_jobs.append((W, test_data, logdet, omega_inv, mapping_relation, mapping_parameters))
+        decodings = self._map(_decode_job, decode_jobs)
+        for point, decoding in zip(decode_points, decodings):
+            self.cache[self._key('decode', point)] = decoding
+
+        # collect the folds of every sweep point
+        results = []
+        for setting in settings:
+            fold_points = [dict(setting, cv_fold=i) for i in range(self.n_folds)]
+            if any(self.cache[self._key('omega', point)] is None for point in fold_points):
+                print("The omega fit failed for at least one fold of %s." % setting)
+                results.append((setting, None))
+                continue
+            mask =  self.voxels(fold_points[0])[5]
+            cv_recon = np.zeros((self.n_folds, self.voxels(fold_points[0])[4].shape[1]) + mask.shape)
+            for i, point in enumerate(fold_points):
+                cv_recon[i][:, mask] = self.cache[self._key('decode', point)][1].T
+
+            rotated_recon, reshrot_recon = realign_reconstructions(cv_recon.transpose(0, 1, 3, 2))
+            omega_fits = [self.cache[self._key('omega', point)] for point in fold_points]
+            results.append((setting,
+                            dict(cv_recon=cv_recon,
+                                 cv_rotated_recon=np.median(rotated_recon.transpose(0, 2, 3, 1), axis=1),
+                                 cv_reshrot_recon_m=np.median(reshrot_recon.transpose(0, 1, 3, 4, 2), axis=1),
+                                 cv_estimated_rho=np.array([omega_fit[1] for omega_fit in omega_fits]),
+                                 cv_estimated_sigma=np.array([omega_fit[2] for omega_fit in omega_fits]))))
+
+        return results
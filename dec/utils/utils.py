@@ -1,8 +1,9 @@
 from __future__ import division
 from math import *
 import numpy as np
-import urllib.request
 import os
+import re
+import hashlib
 
 
 class PRFModelTrial(object):
@@ -113,7 +114,7 @@ def roi_data_from_hdf(data_types_wildcards, roi_name_wildcard, hdf5_file, folder
     try:
         folder_alias_run_group = h5file.get_node(
             where='/', name=folder_alias, classname='Group')
-    except NoSuchNodeError:
+    except tables.NoSuchNodeError:
         # import actual data
         print('No group ' + folder_alias + ' in this file')
         # return None
@@ -153,8 +154,7 @@ def roi_data_from_hdf(data_types_wildcards, roi_name_wildcard, hdf5_file, folder
 #                  ' from group /' + folder_alias + '/' + roi_name)
             data_arrays.append([])
             for dan in selected_data_array_names:
-                data_arrays[-1].append(
-                    eval('roi_node.__getattr__("' + dan + '").read()'))
+                data_arrays[-1].append(roi_node._f_get_child(dan).read())
 
             # stack across timepoints or other values per voxel
             data_arrays[-1] = np.hstack(data_arrays[-1])
@@ -166,6 +166,73 @@ def roi_data_from_hdf(data_types_wildcards, roi_name_wildcard, hdf5_file, folder
     return all_roi_data_np
 
 
+def roi_data_cache_file(data_types_wildcards, roi_name_wildcard, hdf5_file, folder_alias, cache_dir=None, dtype=np.float64):
+    """roi_data_cache_file returns the .npy file in which roi_data_from_cache
+    stores the data for this combination of arguments, including the dtype. By
+    default, this is in a directory next to hdf5_file, named after it with a
+    _cache suffix.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.splitext(hdf5_file)[0] + '_cache'
+    key = '_'.join([folder_alias, roi_name_wildcard] + list(data_types_wildcards) + [np.dtype(dtype).str])
+    # wildcards are not welcome in file names, the hash keeps e.g. '*psc' and '_psc' apart
+    file_name = re.sub(r'[^\w.-]', '_', key) + '_' + hashlib.md5(key.encode()).hexdigest()[:8] + '.npy'
+    return os.path.join(cache_dir, file_name)
+
+
+def roi_data_from_cache(data_types_wildcards, roi_name_wildcard, hdf5_file, folder_alias, cache_dir=None, dtype=np.float64):
+    """roi_data_from_cache returns the same data as roi_data_from_hdf, as a
+    read-only memory-mapped array of dtype.
+
+    The first call converts the data into a contiguous .npy file (see
+    roi_data_cache_file), which is rebuilt when hdf5_file is newer. Later calls,
+    also from other processes, memory-map that file without copying, so that
+    processes reading the same data share its pages.
+
+    Parameters are those of roi_data_from_hdf, plus
+    ----------
+    cache_dir : str
+        directory of the cache files, None puts them next to hdf5_file.
+    dtype : numpy dtype
+        dtype the data are stored and returned as.
+
+    Returns
+    -------
+    output_data : numpy.memmap
+        voxels by values array, as in roi_data_from_hdf.
+    """
+    cache_file = roi_data_cache_file(data_types_wildcards, roi_name_wildcard, hdf5_file, folder_alias, cache_dir, dtype)
+
+    if not os.path.isfile(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(hdf5_file):
+        roi_data = roi_data_from_hdf(data_types_wildcards, roi_name_wildcard, hdf5_file, folder_alias)
+        # write to a temporary file first, so that other processes never see a partial cache
+        temp_file = cache_file + '.%d.tmp' % os.getpid()
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            cache = np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=roi_data.shape)
+            cache[:] = roi_data
+            cache.flush()
+            del cache
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+            print('could not write cache file %s (%s), returning data in memory' % (cache_file, e))
+            return roi_data.astype(dtype)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+def cache_roi_data(hdf5_file, mask_names, cache_dir=None, dtype=np.float64):
+    """cache_roi_data does the one-time conversion of the data that setup_data_from_h5
+    uses, for every mask in mask_names, into roi_data_from_cache files.
+    """
+    for mask_name in mask_names:
+        for data_types_wildcards, folder_alias in [(['*psc'], 'psc'), (['*loo'], 'loo'), (['*av'], 'all_psc'),
+                                                   (['*all'], 'all_prf'), (['*all'], 'prf')]:
+            roi_data_from_cache(data_types_wildcards, mask_name, hdf5_file, folder_alias, cache_dir, dtype)
+
+
 def get_figshare_data(localpath = 'data/V1.h5', remotepath='https://ndownloader.figshare.com/files/9183091'):
     '''New location of the data is https://ndownloader.figshare.com/articles/5400205/versions/1
     '''
@@ -178,6 +245,7 @@ def get_figshare_data(localpath = 'data/V1.h5', remotepath='https://ndownloader.
             os.makedirs(os.path.split(localpath)[0])
         except OSError:
             pass
+        import urllib.request
         urllib.request.urlretrieve(remotepath, localpath)
     return localpath
 
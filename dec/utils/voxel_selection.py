@@ -0,0 +1,130 @@
+import numpy as np
+from scipy.linalg import solve_triangular, cho_factor, cho_solve
+
+
+def select_informative_voxels(W, omega, n_voxels=None, min_gain=1e-3, prior_precision=1.0, candidates=None):
+    """select_informative_voxels greedily selects the voxels that tell most about the
+    stimulus, given those already selected.
+
+    The information of a voxel set S is the log determinant of the posterior precision
+    of the pixels, H(S) = prior_precision I + W_S.T omega_SS^-1 W_S. Adding voxel v
+    adds its loadings w_v conditioned on the noise of S: with
+    w~_v = w_v - W_S.T omega_SS^-1 omega_Sv and s~_v = omega_vv - omega_vS omega_SS^-1 omega_Sv,
+    the gain in log determinant is log(1 + w~_v.T H(S)^-1 w~_v / s~_v). Voxels whose
+    receptive fields overlap those selected, or whose noise they share, gain little.
+
+    Nothing is refactorised: every step extends the Cholesky factors of omega_SS and of
+    the k by k Woodbury matrix prior_precision I + Z Z.T (with Z = L^-1 W_S), and updates
+    w~, s~ and the Woodbury projections of all candidates with rank-one updates, in
+    O(n_voxels (n_pixels + k)) per step for all candidates together.
+
+    Parameters
+    ----------
+    W : numpy.ndarray
+        (n_voxels, n_pixels) W matrix of all voxels
+    omega : numpy.ndarray
+        (n_voxels, n_voxels) model omega of all voxels, e.g. from fit_model_omega
+    n_voxels : int
+        number of voxels to select, None selects until the gain drops below min_gain
+    min_gain : float
+        smallest gain in log determinant of a selected voxel
+    prior_precision : float
+        precision of the pixels before any voxel is seen
+    candidates : numpy.ndarray
+        indices of the voxels to select from, by default all
+
+    Returns
+    -------
+    selected : numpy.ndarray
+        indices of the selected voxels, in the order they were selected
+    gains : numpy.ndarray
+        gain in log determinant of every selected voxel, cumulatively the information of the selection
+    """
+    n_all, n_pixels = W.shape
+    if n_voxels is None:
+        n_voxels = n_all
+    available = np.zeros(n_all, dtype=bool)
+    available[np.arange(n_all) if candidates is None else candidates] = True
+
+    residual_W = np.array(W, dtype=np.float64)                  # w~ of every voxel
+    residual_variance = np.array(np.diag(omega), dtype=np.float64)  # s~ of every voxel
+    residual_norm = (residual_W**2).sum(axis=1)                 # |w~|^2
+    C = np.zeros((0, n_all))                                    # L^-1 omega_S,: , L = chol(omega_SS)
+    Q = np.zeros((0, n_all))                                    # R^-1 Z w~ , R = chol(prior_precision I + Z Z.T)
+    Z = np.zeros((0, n_pixels))
+    R = np.zeros((0, 0))
+
+    selected, gains = [], []
+    while len(selected) < n_voxels and available.any():
+        # w~.T H^-1 w~ with the Woodbury form of H^-1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            score = (residual_norm - (Q**2).sum(axis=0)) / prior_precision / residual_variance
+            gain = np.log1p(np.clip(score, 0, None))
+        gain[~available | ~(residual_variance > 1e-12 * np.diag(omega))] = -np.inf
+        best = int(np.argmax(gain))
+        if not gain[best] >= min_gain:
+            break
+        selected.append(best)
+        gains.append(gain[best])
+        available[best] = False
+
+        # extend the cholesky factor of omega_SS, the new row of L^-1 omega_S,:
+        scale = np.sqrt(residual_variance[best])
+        c = (omega[best] - C[:, best].dot(C)) / scale
+        z = residual_W[best] / scale
+
+        # extend the cholesky factor of the woodbury matrix with the new row of Z
+        Zz = Z.dot(z)
+        r = solve_triangular(R, Zz, lower=True) if R.shape[0] > 0 else np.zeros(0)
+        d = np.sqrt(prior_precision + z.dot(z) - r.dot(r))
+
+        # rank-one updates of every candidate, w~ <- w~ - c z
+        y = residual_W.dot(z)
+        Q_top = Q - np.outer(r, c)
+        Q_new = (y - c * z.dot(z) - r.dot(Q_top)) / d
+        residual_norm += -2 * c * y + c**2 * z.dot(z)
+        residual_W -= np.outer(c, z)
+        residual_variance -= c**2
+
+        C = np.vstack([C, c])
+        Z = np.vstack([Z, z])
+        Q = np.vstack([Q_top, Q_new])
+        R_new = np.zeros((R.shape[0] + 1, R.shape[0] + 1))
+        R_new[:-1, :-1] = R
+        R_new[-1, :-1] = r
+        R_new[-1, -1] = d
+        R = R_new
+
+    return np.array(selected, dtype=int), np.array(gains)
+
+
+def posterior_information(W, omega, voxels, prior_precision=1.0):
+    """posterior_information is the log determinant of the posterior precision of the
+    pixels given voxels, the quantity select_informative_voxels increases, computed
+    directly, relative to the prior."""
+    W_S = W[voxels]
+    omega_SS = omega[np.ix_(voxels, voxels)]
+    H = prior_precision * np.eye(W.shape[1]) + W_S.T.dot(cho_solve(cho_factor(omega_SS, lower=True), W_S))
+    return np.linalg.slogdet(H)[1] - W.shape[1] * np.log(prior_precision)
+
+
+def voxel_subset(voxels, W, omega, mapping_relation=None, mapping_parameters=[]):
+    """voxel_subset restricts a decoder to voxels, as from select_informative_voxels.
+
+    Returns
+    -------
+    W, omega_inv, logdet, mapping_parameters :
+        of the voxels, as taken by decode_fold. The test data of the voxels is test_data[voxels].
+    """
+    omega_SS = omega[np.ix_(voxels, voxels)]
+    factor = cho_factor(omega_SS, lower=True)
+    omega_inv = cho_solve(factor, np.eye(len(voxels)))
+    logdet = (1.0, 2 * np.sum(np.log(np.diag(factor[0]))))
+
+    if mapping_relation is None:
+        subset_parameters = []
+    elif type(mapping_relation) == list:
+        subset_parameters = [np.asarray(parameters)[voxels] for parameters in mapping_parameters]
+    else:
+        subset_parameters = np.asarray(mapping_parameters)[voxels]
+    return W[voxels], omega_inv, logdet, subset_parameters
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def problem():
+    """a small random encoding model: W, omega_inv and logdet of a random omega,
+    css-like mapping parameters, and noisy bold patterns of random binary stimuli."""
+    rng = np.random.RandomState(0)
+    n_voxels, n_pixels, n_timepoints = 60, 40, 8
+    W = rng.rand(n_voxels, n_pixels) * 0.1
+    A = rng.randn(n_voxels, n_voxels)
+    omega = A.dot(A.T) / n_voxels + np.eye(n_voxels)
+    stimuli = (rng.rand(n_pixels, n_timepoints) < 0.2).astype(np.float64)
+    mapping_relation = ['power_law', 'linear']
+    mapping_parameters = [np.full(n_voxels, 0.7), np.c_[rng.rand(n_voxels) + 0.5, rng.randn(n_voxels) * 0.1]]
+    return dict(W=W,
+                omega=omega,
+                omega_inv=np.linalg.inv(omega),
+                logdet=np.linalg.slogdet(omega),
+                stimuli=stimuli,
+                bolds=W.dot(stimuli) + 0.3 * rng.randn(n_voxels, n_timepoints),
+                mapping_relation=mapping_relation,
+                mapping_parameters=mapping_parameters)
@@ -0,0 +1,41 @@
+import numpy as np
+
+from dec.utils import fit
+from dec.utils.fit import maximize_loglikelihood, maximize_loglikelihood_anytime
+
+
+def _arguments(problem):
+    return (problem['W'], problem['bolds'][:, 0], problem['logdet'], problem['omega_inv'],
+            problem['mapping_relation'], problem['mapping_parameters'])
+
+
+def test_ample_budget_matches_maximize_loglikelihood(problem):
+    starting_value = np.full(problem['W'].shape[1], 0.3)
+    logl, decoded, converged = maximize_loglikelihood_anytime(starting_value, *_arguments(problem), time_budget=60.0)
+    expected_logl, expected = maximize_loglikelihood(starting_value, *_arguments(problem), analytic_gradient=True, disp=False)
+    assert converged
+    np.testing.assert_allclose(logl, expected_logl, rtol=1e-8)
+    np.testing.assert_allclose(decoded, expected, atol=1e-6)
+
+
+def test_exhausted_budget_returns_the_best_evaluated(problem, monkeypatch):
+    # a clock that advances a second at every reading, so that the budget runs out after a few evaluations
+    clock = iter(np.arange(1000.0))
+    monkeypatch.setattr(fit.time, 'perf_counter', lambda: next(clock))
+    evaluated = []
+
+    def recorded(stimulus, *args):
+        result = calculate(stimulus, *args)
+        evaluated.append((result[0], np.array(stimulus)))
+        return result
+    calculate = fit.calculate_bold_loglikelihood
+    monkeypatch.setattr(fit, 'calculate_bold_loglikelihood', recorded)
+
+    starting_value = np.full(problem['W'].shape[1], 0.3)
+    logl, decoded, converged = maximize_loglikelihood_anytime(starting_value, *_arguments(problem), time_budget=4.5)
+    assert not converged
+    assert 1 < len(evaluated) < 10
+    best_fun, best_stimulus = min(evaluated, key=lambda evaluation: evaluation[0])
+    assert logl == -best_fun
+    np.testing.assert_array_equal(decoded, best_stimulus)
+    assert logl > -evaluated[0][0]
@@ -0,0 +1,32 @@
+import json
+import os
+
+from dec.utils import batch
+
+
+def _cost(job):
+    if job['data_file'] == 'missing.h5':
+        raise IOError('cannot read ' + job['data_file'])
+    return float(job['n_pix'])
+
+
+def _run(job, output_dir):
+    # runs in a spawned worker, which imports this module again
+    with open(os.path.join(output_dir, job['name'] + '.npz'), 'w') as f:
+        f.write('done')
+    return job['name'], 0.0
+
+
+def test_a_job_that_cannot_be_prepared_fails_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'job_cost', _cost)
+    monkeypatch.setattr(batch, 'run_job', _run)
+    jobs = [dict(batch.JOB_DEFAULTS, data_file=data_file, mask_name='V1', name=name)
+            for name, data_file in [('first', 'a.h5'), ('unreadable', 'missing.h5'), ('last', 'b.h5')]]
+
+    report = batch.run_batch(jobs, str(tmp_path), n_workers=1, blas_threads=1)
+    assert sorted(report['run_times']) == ['first', 'last']
+    assert list(report['failures']) == ['unreadable']
+    assert 'missing.h5' in report['failures']['unreadable']
+    with open(str(tmp_path / 'batch_report.json')) as f:
+        assert json.load(f)['failures'] == report['failures']
+    assert (tmp_path / 'first.npz').exists() and (tmp_path / 'last.npz').exists()
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+import pytest
+
+from dec.utils import utils
+
+
+@pytest.fixture
+def hdf5_file(tmp_path, monkeypatch):
+    """a data file whose roi data come from a stub of roi_data_from_hdf."""
+    data = np.arange(12, dtype=np.float64).reshape((3, 4)) / 7.0
+    monkeypatch.setattr(utils, 'roi_data_from_hdf', lambda *args: data)
+    hdf5_file = tmp_path / 'V1.h5'
+    hdf5_file.write_bytes(b'')
+    return str(hdf5_file), data
+
+
+def test_cache_is_per_dtype(hdf5_file):
+    hdf5_file, data = hdf5_file
+    single = utils.roi_data_from_cache(['*all'], 'V1', hdf5_file, 'prf', dtype=np.float32)
+    double = utils.roi_data_from_cache(['*all'], 'V1', hdf5_file, 'prf')
+    assert single.dtype == np.float32 and double.dtype == np.float64
+    np.testing.assert_array_equal(double, data)
+    # and both are read back from their own cache
+    assert utils.roi_data_from_cache(['*all'], 'V1', hdf5_file, 'prf', dtype=np.float32).dtype == np.float32
+
+
+def test_failed_cache_write_leaves_no_temporary_file(hdf5_file, monkeypatch):
+    hdf5_file, data = hdf5_file
+
+    def failing_replace(source, destination):
+        raise OSError('disk full')
+    monkeypatch.setattr(utils.os, 'replace', failing_replace)
+
+    roi_data = utils.roi_data_from_cache(['*all'], 'V1', hdf5_file, 'prf')
+    np.testing.assert_array_equal(roi_data, data)
+    cache_dir = os.path.splitext(hdf5_file)[0] + '_cache'
+    assert os.listdir(cache_dir) == []
@@ -0,0 +1,66 @@
+import numpy as np
+
+from dec.utils.deconvolution import hrf_filter_operator, deconvolution_operator, gcv_regularisation, deconvolve
+from dec.utils.prf import _deconvolve_fold
+
+
+def gamma_hrf(tr=1.0):
+    t = np.arange(0, 20, tr)
+    hrf = t**5 * np.exp(-t)
+    return hrf / hrf.sum()
+
+
+def test_deconvolution_operator_is_the_tikhonov_inverse():
+    rng = np.random.RandomState(0)
+    A = rng.randn(30, 30)
+    regularisation = 1e-2
+    M = deconvolution_operator(A, regularisation)
+    s_max = np.linalg.svd(A, compute_uv=False)[0]
+    np.testing.assert_allclose(M, np.linalg.solve(A.T.dot(A) + regularisation * s_max**2 * np.eye(30), A.T), atol=1e-10)
+    # without regularisation the invertible A is inverted
+    np.testing.assert_allclose(deconvolution_operator(A, 0.0).dot(A), np.eye(30), atol=1e-8)
+    # the regularisation is relative to the scale of A
+    np.testing.assert_allclose(deconvolution_operator(10 * A, regularisation), M / 10, atol=1e-10)
+
+
+def test_deconvolution_recovers_responses_from_the_hrf_filter_operator():
+    A = hrf_filter_operator(120, gamma_hrf(), sg_filter_window_length=61)
+    response = np.zeros((2, 120))
+    response[0, 20:30] = 1.0
+    response[1, 60:90] = np.sin(np.linspace(0, 3 * np.pi, 30))
+    recovered = deconvolve(response.dot(A.T), deconvolution_operator(A, 1e-6), demean=False)
+    # the components removed by the filter are shrunk to zero rather than recovered
+    np.testing.assert_allclose(recovered.dot(A.T), response.dot(A.T), atol=1e-3)
+    assert all(np.corrcoef(r, s)[0, 1] > 0.99 for r, s in zip(recovered, response))
+
+
+def test_gcv_regularisation_matches_the_explicit_gcv_score():
+    rng = np.random.RandomState(1)
+    A = hrf_filter_operator(60, gamma_hrf(), sg_filter_window_length=31)
+    data = rng.randn(5, 60).dot(A.T) + 0.05 * rng.randn(5, 60)
+    regularisations = np.logspace(-6, 0, 7)
+    regularisation, scores = gcv_regularisation(A, data, regularisations)
+
+    for candidate, score in zip(regularisations, scores):
+        influence = A.dot(deconvolution_operator(A, candidate))
+        residuals = data - data.dot(influence.T)
+        explicit = 60 * np.sum(residuals**2) / np.trace(np.eye(60) - influence)**2
+        np.testing.assert_allclose(score, explicit, rtol=1e-8)
+    assert regularisation == regularisations[np.argmin(scores)]
+    # noise makes the smallest regularisation overfit, and the largest one discards the signal
+    assert regularisations[0] < regularisation < regularisations[-1]
+
+
+def test_deconvolve_fold_deconvolves_the_training_residuals_with_the_test_regularisation():
+    rng = np.random.RandomState(2)
+    hrf = gamma_hrf()
+    test_data, residuals = rng.randn(4, 50), rng.randn(4, 90)
+    deconvolved_test, deconvolved_residuals, covariance = _deconvolve_fold(test_data, residuals, hrf, 1e-3)
+
+    np.testing.assert_allclose(deconvolved_test, deconvolve(test_data, deconvolution_operator(hrf_filter_operator(50, hrf), 1e-3)))
+    np.testing.assert_allclose(deconvolved_residuals, deconvolve(residuals, deconvolution_operator(hrf_filter_operator(90, hrf), 1e-3)))
+    np.testing.assert_allclose(covariance, np.cov(deconvolved_residuals))
+
+    regularisation, _ = gcv_regularisation(hrf_filter_operator(50, hrf), test_data - test_data.mean(axis=1)[:, np.newaxis])
+    _, gcv_residuals, _ = _deconvolve_fold(test_data, residuals, hrf, 'gcv')
+    np.testing.assert_allclose(gcv_residuals, deconvolve(residuals, deconvolution_operator(hrf_filter_operator(90, hrf), regularisation)))
@@ -0,0 +1,23 @@
+import warnings
+
+import numpy as np
+
+from dec.utils.export import frame_limits, colour_frame, colour_lut
+
+
+def test_colour_frame_of_an_empty_range():
+    lut = colour_lut('gray')
+    frame = np.full((4, 4), 3.0)
+    frame[0, 0], frame[1, 1] = np.nan, 4.0
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        rgb = colour_frame(frame, frame_limits(np.full((2, 4, 4), 3.0)), lut, scale=2)
+    assert rgb.shape == (8, 8, 3)
+    assert rgb[0, 0, 0] == 0 and rgb[2, 2, 0] == 255 and rgb[4, 4, 0] == 0
+
+
+def test_frame_limits_subsample():
+    frames = np.random.RandomState(0).randn(100, 40, 40)
+    subsampled = frame_limits(frames, percentile=1, n_samples=10000)
+    exact = frame_limits(frames, percentile=1, n_samples=None)
+    np.testing.assert_allclose(subsampled, exact, atol=0.05)
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds for a cold import of the package, which only sets up the lazy exports
+COLD_IMPORT_BUDGET = 0.5
+
+HEAVY_MODULES = ['tables', 'matplotlib', 'popeye', 'numba', 'scipy', 'hrf_estimation']
+
+
+def _cold_import(statement):
+    """runs statement in a fresh interpreter, returns its run time and the heavy modules it imported."""
+    code = ('import sys, time, json\n'
+            'start = time.perf_counter()\n'
+            + statement + '\n'
+            'elapsed = time.perf_counter() - start\n'
+            'print(json.dumps(dict(elapsed=elapsed, modules=[m for m in %r if m in sys.modules])))' % HEAVY_MODULES)
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=REPOSITORY_ROOT))
+
+
+def test_cold_import_of_dec_utils():
+    result = _cold_import('import dec.utils')
+    assert result['elapsed'] < COLD_IMPORT_BUDGET
+    assert result['modules'] == []
+
+
+def test_cold_import_of_dec():
+    result = _cold_import('import dec')
+    assert result['elapsed'] < COLD_IMPORT_BUDGET
+    assert result['modules'] == []
+
+
+def test_lazy_export_loads_only_its_module():
+    result = _cold_import('from dec.utils import decoding_metrics')
+    assert result['modules'] == []
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from dec.utils import kernels
+from dec.utils.fit import (calculate_bold_loglikelihood, firstpass_decoder_independent_channels,
+                           firstpass_decoder_independent_channels_batch, mapping)
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+use_numba_values = [False, pytest.param(True, marks=pytest.mark.skipif(not kernels.HAVE_NUMBA, reason='numba is not installed'))]
+
+
+def _mapped(linear_predictor, problem):
+    for relation, parameters in zip(problem['mapping_relation'], problem['mapping_parameters']):
+        linear_predictor = mapping(linear_predictor, mapping_relation=relation, parameters=parameters)
+    return linear_predictor
+
+
+@pytest.mark.parametrize('use_numba', use_numba_values)
+def test_quadratic_forms(problem, use_numba):
+    bold = problem['bolds'][:, 0]
+    resid = bold[:, np.newaxis] - problem['W']
+    expected = np.einsum('ij,ik,kj->j', resid, problem['omega_inv'], resid)
+    forms = kernels.quadratic_forms(problem['omega_inv'], bold, problem['W'], use_numba=use_numba, chunk_size=7)
+    np.testing.assert_allclose(forms, expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize('use_numba', use_numba_values)
+def test_quadratic_form_and_gradient(problem, use_numba):
+    resid = problem['bolds'][:, 0]
+    form, omega_inv_resid = kernels.quadratic_form_and_gradient(problem['omega_inv'], resid, use_numba=use_numba)
+    np.testing.assert_allclose(form, resid.dot(problem['omega_inv']).dot(resid), rtol=1e-10)
+    np.testing.assert_allclose(omega_inv_resid, problem['omega_inv'].dot(resid), rtol=1e-10)
+
+
+@pytest.mark.parametrize('use_numba', use_numba_values)
+def test_loglikelihood(problem, use_numba, monkeypatch):
+    monkeypatch.setattr(kernels, 'USE_NUMBA', use_numba)
+    stimulus = problem['stimuli'][:, 0] * 0.8 + 0.1
+    bold = problem['bolds'][:, 0]
+    args = (problem['W'], bold, problem['logdet'], problem['omega_inv'], problem['mapping_relation'], problem['mapping_parameters'])
+
+    resid = bold - _mapped(problem['W'].dot(stimulus), problem)
+    expected = 0.5 * (problem['logdet'][1] + bold.shape[0] * np.log(2 * np.pi) + resid.dot(problem['omega_inv']).dot(resid))
+    value = calculate_bold_loglikelihood(stimulus, *args)
+    value_with_gradient, gradient = calculate_bold_loglikelihood(stimulus, *args, return_gradient=True)
+    np.testing.assert_allclose(value, expected, rtol=1e-10)
+    np.testing.assert_allclose(value_with_gradient, expected, rtol=1e-10)
+
+    step = 1e-6
+    finite_differences = np.array([(calculate_bold_loglikelihood(stimulus + step * e, *args)
+                                    - calculate_bold_loglikelihood(stimulus - step * e, *args)) / (2 * step)
+                                   for e in np.eye(stimulus.shape[0])])
+    np.testing.assert_allclose(gradient, finite_differences, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('use_numba', use_numba_values)
+def test_firstpass(problem, use_numba, monkeypatch):
+    monkeypatch.setattr(kernels, 'USE_NUMBA', use_numba)
+    args = (problem['logdet'], problem['omega_inv'], problem['mapping_relation'], problem['mapping_parameters'])
+    batch = firstpass_decoder_independent_channels_batch(problem['W'], problem['bolds'], *args)
+    for t in range(problem['bolds'].shape[1]):
+        single = firstpass_decoder_independent_channels(problem['W'], problem['bolds'][:, t], *args)
+        np.testing.assert_allclose(batch[:, t], single, rtol=1e-8, atol=1e-10)
+
+
+def test_numba_absent(problem, monkeypatch, capsys):
+    monkeypatch.setattr(kernels, 'HAVE_NUMBA', False)
+    bold = problem['bolds'][:, 0]
+    forms = kernels.quadratic_forms(problem['omega_inv'], bold, problem['W'], use_numba=True)
+    assert 'numba is not installed' in capsys.readouterr().out
+    np.testing.assert_allclose(forms, kernels.quadratic_forms(problem['omega_inv'], bold, problem['W'], use_numba=False))
+
+
+def test_numba_not_imported_with_fit():
+    code = 'import sys, dec.utils.fit, dec.utils.prf; print("numba" in sys.modules)'
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=REPOSITORY_ROOT)
+    assert output.strip() == b'False'
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from dec.utils.loo import run_views, loo_medians, loo_css_residuals
+
+
+class StubCSSModel(object):
+    """stands in for the CSS model of n_folds-1 concatenated runs: a distinct
+    timecourse for every parameter set."""
+
+    def __init__(self, n_timepoints):
+        self.t = np.arange(n_timepoints)
+
+    def generate_predictions(self, x, y, sigma, n, beta, baseline):
+        return (beta[:, np.newaxis] * np.cos(0.1 * x[:, np.newaxis] * self.t + y[:, np.newaxis])
+                + sigma[:, np.newaxis] * n[:, np.newaxis] + baseline[:, np.newaxis])
+
+
+@pytest.mark.parametrize('n_folds', [2, 3, 4, 6, 7])
+def test_loo_medians_match_the_median_of_the_other_runs(n_folds):
+    rng = np.random.RandomState(n_folds)
+    # few distinct values, so that runs tie, also with the left out run
+    runs = rng.randint(0, 3, size=(5, n_folds, 11)).astype(np.float64)
+    runs[0] = 1.0
+
+    medians = loo_medians(runs)
+    for k in range(n_folds):
+        np.testing.assert_array_equal(medians[:, k], np.median(np.delete(runs, k, axis=1), axis=1))
+
+
+def test_loo_medians_of_continuous_data():
+    runs = run_views(np.random.RandomState(0).randn(8, 6 * 13), 6)
+    medians = loo_medians(runs)
+    for k in range(6):
+        np.testing.assert_allclose(medians[:, k], np.median(np.delete(runs, k, axis=1), axis=1))
+
+
+def test_loo_css_residuals_match_the_np_delete_layout():
+    rng = np.random.RandomState(1)
+    n_voxels, n_folds, nr_TRs = 4, 5, 7
+    runs = run_views(rng.randn(n_voxels, n_folds * nr_TRs), n_folds)
+    prf_data = rng.rand(n_voxels, n_folds, 8)
+    model = StubCSSModel((n_folds - 1) * nr_TRs)
+
+    residuals = loo_css_residuals(model, runs, prf_data)
+    assert residuals.shape == (n_folds, n_voxels, (n_folds - 1) * nr_TRs)
+    for k in range(n_folds):
+        train_data = np.delete(runs, k, axis=1).reshape((n_voxels, -1))
+        prediction = model.generate_predictions(*prf_data[:, k, :6].T)
+        np.testing.assert_allclose(residuals[k], train_data - prediction)
+
+    out = np.full(residuals.shape, np.nan)
+    assert loo_css_residuals(model, runs, prf_data, out=out) is out
+    np.testing.assert_array_equal(out, residuals)
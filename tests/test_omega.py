@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from dec.utils.omega import (fit_model_omega, fit_model_omega_multi_roi, multi_roi_omega_factors, isPSD, _fit_cross_roi_sigmas, _model_omega,
+                             _omega_distance_and_gradient, _low_rank_omega_distance_and_gradient, _low_rank_distance_terms)
+
+
+@pytest.fixture
+def rois():
+    """three ROIs with their own tau and rho, and sigmas that also set the blocks between them."""
+    rng = np.random.RandomState(1)
+    roi_labels = np.repeat(np.arange(3), [30, 25, 20])
+    W = rng.randn(roi_labels.shape[0], 6)
+    taus = rng.rand(roi_labels.shape[0]) + 0.5
+    rhos, sigmas = np.array([0.2, 0.4, 0.1]), np.array([0.5, 1.2, 0.8])
+    diagonal, U = multi_roi_omega_factors(taus, rhos, sigmas, W, roi_labels)
+    omega = U.dot(U.T) + np.diag(diagonal)
+    residuals = np.linalg.cholesky(omega).dot(rng.randn(roi_labels.shape[0], 4000))
+    return dict(W=W, roi_labels=roi_labels, taus=taus, rhos=rhos, sigmas=sigmas, omega=omega, residuals=residuals)
+
+
+def test_cross_roi_sigmas(rois):
+    blocks = [np.where(rois['roi_labels'] == r)[0] for r in range(3)]
+    sigmas = _fit_cross_roi_sigmas(rois['omega'], rois['W'], blocks, rois['taus'], rois['rhos'], np.zeros(3))
+    np.testing.assert_allclose(sigmas, rois['sigmas'], rtol=1e-3)
+
+
+def test_likelihood_fit_and_warm_start(rois):
+    fit = fit_model_omega_multi_roi(None, rois['W'], rois['roi_labels'], n_jobs=1, residuals=rois['residuals'],
+                                    omega_fit='likelihood', start_method='forkserver', return_parameters=True)
+    taus, rhos, sigmas, omega, omega_inv, logdet, parameters = fit
+    np.testing.assert_allclose(sigmas, rois['sigmas'], rtol=0.05)
+    np.testing.assert_allclose(omega_inv.dot(omega), np.eye(omega.shape[0]), atol=1e-8)
+    np.testing.assert_allclose(logdet[1], np.linalg.slogdet(omega)[1])
+
+    warm = fit_model_omega_multi_roi(None, rois['W'], rois['roi_labels'], n_jobs=1, residuals=rois['residuals'],
+                                     omega_fit='likelihood', x0=parameters, start_method='forkserver')
+    np.testing.assert_allclose(warm[2], sigmas, rtol=1e-2)
+
+
+def test_distance_term_is_rejected(rois):
+    with pytest.raises(ValueError):
+        fit_model_omega_multi_roi(rois['omega'], rois['W'], rois['roi_labels'], D=np.zeros(rois['omega'].shape))
+
+
+def test_low_rank_distance(rois):
+    W, tau, covariance = rois['W'], rois['taus'], np.cov(rois['residuals'])
+    terms = _low_rank_distance_terms(covariance, W)
+    for x in [np.r_[0, 0.3, 0.7, tau], np.r_[0, 0.9, 2.1, 1.3 * tau]]:
+        distance, gradient = _omega_distance_and_gradient(x, covariance, W.dot(W.T))
+        low_rank_distance, low_rank_gradient = _low_rank_omega_distance_and_gradient(x, covariance, W, terms)
+        np.testing.assert_allclose(low_rank_distance, distance, rtol=1e-10)
+        np.testing.assert_allclose(low_rank_gradient, gradient, rtol=1e-8, atol=1e-8)
+
+
+def test_isPSD(rois):
+    assert isPSD(rois['omega'])
+    assert not isPSD(rois['omega'] - 2 * np.linalg.eigvalsh(rois['omega'])[0] * np.eye(rois['omega'].shape[0]))
+
+
+def test_covariance_fit_keeps_signed_taus(rois):
+    # shared noise anticorrelated between two halves of every ROI needs taus of both signs
+    signs = np.where(np.arange(rois['roi_labels'].shape[0]) % 2 == 0, 1.0, -1.0)
+    diagonal, U = multi_roi_omega_factors(signs * rois['taus'], np.full(3, 0.6), rois['sigmas'], rois['W'], rois['roi_labels'])
+    covariance = U.dot(U.T) + np.diag(diagonal)
+
+    # started from taus of the right signs, as the random starts of the workers are not seeded
+    x0 = [np.r_[0.0, 0.5, 1.0, 0.5 * signs[rois['roi_labels'] == r]] for r in range(3)]
+    taus, rhos, sigmas, omega, omega_inv, logdet, parameters = fit_model_omega_multi_roi(
+        covariance, rois['W'], rois['roi_labels'], n_jobs=1, x0=x0, start_method='forkserver', return_parameters=True)
+    assert np.any(taus < 0)
+    for r, x in enumerate(parameters):
+        block = np.where(rois['roi_labels'] == r)[0]
+        np.testing.assert_array_equal(taus[block], x[3:])
+        np.testing.assert_allclose(omega[np.ix_(block, block)], _model_omega(x, rois['W'][block].dot(rois['W'][block].T)), rtol=1e-10)
+
+
+def test_fit_model_omega_needs_WWT_or_W(rois, capsys):
+    assert fit_model_omega(rois['omega'], None) is None
+    assert 'WWT or W' in capsys.readouterr().out
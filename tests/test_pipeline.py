@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from dec.utils.pipeline import prefetched
+
+
+class _Tracker(object):
+    """counts the results prepared but not yet consumed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ahead = 0
+        self.max_ahead = 0
+
+    def prepare(self, i):
+        with self.lock:
+            self.ahead += 1
+            self.max_ahead = max(self.max_ahead, self.ahead)
+        time.sleep(0.005)
+        return i
+
+    def consume(self):
+        with self.lock:
+            self.ahead -= 1
+
+
+@pytest.mark.parametrize('depth', [1, 2, 3])
+def test_depth_bounds_results_ahead(depth):
+    tracker = _Tracker()
+    results = []
+    for result in prefetched(tracker.prepare, [(i,) for i in range(10)], depth=depth):
+        tracker.consume()
+        # the consumer is slower than the producer, so the producer runs ahead as far as it may
+        time.sleep(0.03)
+        results.append(result)
+    assert results == list(range(10))
+    assert tracker.max_ahead == depth
+
+
+def test_exception_is_raised_at_its_job():
+    def prepare(i):
+        if i == 2:
+            raise RuntimeError('job 2')
+        return i
+
+    results = []
+    with pytest.raises(RuntimeError, match='job 2'):
+        for result in prefetched(prepare, [(i,) for i in range(5)], depth=2):
+            results.append(result)
+    assert results == [0, 1]
+
+
+def test_early_stop_releases_the_producer():
+    before = threading.active_count()
+    for result in prefetched(lambda i: i, [(i,) for i in range(100)], depth=2):
+        if result == 3:
+            break
+    assert threading.active_count() == before
@@ -0,0 +1,57 @@
+import numpy as np
+
+from dec.utils.prf_fitting import css_lookup_table, grid_fit, refine_fit, fit_css_prfs
+
+
+class StubCSSModel(object):
+    """stands in for CompressiveSpatialSummationModelFiltered: a small stimulus
+    tracing a Lissajous curve over the screen, and a gaussian pRF whose response
+    is raised to the power n."""
+
+    def __init__(self, n_timepoints=200):
+        t = np.linspace(0, 2 * np.pi, n_timepoints, endpoint=False)
+        self.positions = 5 * np.array([np.sin(3 * t), np.sin(4 * t + np.pi / 4)])
+
+    def generate_prediction(self, x, y, sigma, n, beta, baseline):
+        response = np.exp(-((self.positions[0] - x)**2 + (self.positions[1] - y)**2) / (2 * sigma**2))
+        return beta * response**n + baseline
+
+    def generate_ballpark_predictions(self, x, y, sigma, n):
+        return np.array([self.generate_prediction(*point, beta=1.0, baseline=0.0) for point in zip(x, y, sigma, n)])
+
+
+GRIDS = dict(x_grid=np.linspace(-4, 4, 9), y_grid=np.linspace(-4, 4, 9), sigma_grid=[0.5, 1.0, 2.0], n_grid=[0.5, 1.0])
+
+
+def test_grid_fit_recovers_planted_grid_points():
+    model = StubCSSModel()
+    grid_parameters, predictions = css_lookup_table(model, chunk_size=50, **GRIDS)
+    planted = np.array([17, 100, 333, 480])
+    betas, baselines = np.array([2.0, 0.5, 3.0, 1.5]), np.array([1.0, -2.0, 0.0, 10.0])
+    data = betas[:, np.newaxis] * predictions[planted] + baselines[:, np.newaxis]
+
+    parameters = grid_fit(data, grid_parameters, predictions, chunk_size=3)
+    np.testing.assert_array_equal(parameters[:, :4], grid_parameters[planted])
+    np.testing.assert_allclose(parameters[:, 4], betas)
+    np.testing.assert_allclose(parameters[:, 5], baselines, atol=1e-10)
+    np.testing.assert_allclose(parameters[:, 6], 1.0)
+
+
+def test_refine_fit_improves_off_grid_voxels():
+    model = StubCSSModel()
+    rng = np.random.RandomState(0)
+    truth = np.array([[0.7, -1.3, 1.2, 0.8, 2.0, 1.0],
+                      [-2.2, 2.6, 0.8, 0.6, 1.0, 0.0],
+                      [3.1, 0.4, 1.6, 1.0, 0.5, -1.0]])
+    clean = np.array([model.generate_prediction(*p) for p in truth])
+    data = clean + 0.01 * rng.randn(*clean.shape)
+    rsq_truth = 1 - ((data - clean)**2).sum(-1) / ((data - data.mean(-1, keepdims=True))**2).sum(-1)
+
+    grid = fit_css_prfs(model, data, refine=False, **GRIDS)
+    refined = refine_fit(model, data, grid, n_jobs=1, chunk_size=2)
+    assert np.all(refined[:, 6] >= grid[:, 6])
+    # in the stub, sigma and n only enter as the width sigma/sqrt(n)
+    np.testing.assert_allclose(refined[:, [0, 1, 4, 5]], truth[:, [0, 1, 4, 5]], atol=0.05)
+    np.testing.assert_allclose(refined[:, 2] / np.sqrt(refined[:, 3]), truth[:, 2] / np.sqrt(truth[:, 3]), rtol=0.02)
+    assert np.all(refined[:, 6] >= rsq_truth - 1e-6)
+    np.testing.assert_array_equal(fit_css_prfs(model, data, n_jobs=1, chunk_size=1, **GRIDS), refined)
@@ -0,0 +1,20 @@
+import numpy as np
+from scipy import ndimage
+
+from dec.utils.realign import realign_reconstructions, bar_block_windows
+
+
+def test_realign_matches_ndimage_rotate():
+    rng = np.random.RandomState(0)
+    recon = rng.rand(2, 462, 11, 11)
+    rotated_recon, reshrot_recon = realign_reconstructions(recon)
+
+    windows, bar_thetas, block_thetas = bar_block_windows(nr_timepoints=462)
+    for t in [0, 40, 100, 300, 461]:
+        expected = recon[1, t] if block_thetas[t] == -1 else ndimage.rotate(recon[1, t], block_thetas[t], axes=(0, 1),
+                                                                           reshape=False, mode='nearest', order=1)
+        np.testing.assert_allclose(rotated_recon[1, t], expected, atol=1e-10)
+    for bar in range(len(bar_thetas)):
+        t = windows[bar, -1]
+        expected = ndimage.rotate(recon[0, t], bar_thetas[bar], axes=(0, 1), reshape=False, mode='nearest', order=1)
+        np.testing.assert_allclose(reshrot_recon[0, bar, -1], expected, atol=1e-10)
@@ -0,0 +1,19 @@
+import numpy as np
+
+from dec.utils.robustness import robustness_report
+
+
+def test_probe_chunks_and_map_pass(problem):
+    arguments = (problem['W'], problem['logdet'], problem['omega_inv'], problem['mapping_relation'], problem['mapping_parameters'])
+    mask = np.zeros((7, 7), dtype=bool)
+    mask.flat[:problem['W'].shape[1]] = True
+
+    whole = robustness_report(*arguments, mask=mask, noise=False, n_random=20)
+    chunked = robustness_report(*arguments, mask=mask, noise=False, n_random=20, chunk_size=7, n_map=5)
+    np.testing.assert_array_equal(chunked['probe_hit_rate'], whole['probe_hit_rate'])
+    np.testing.assert_array_equal(chunked['probe_localisation_error'], whole['probe_localisation_error'])
+
+    # the MAP images are at least as likely as the thresholded firstpass
+    random = chunked['random']
+    assert random['map_stimuli'].shape == (5,)
+    assert np.all(random['map_logl_ratio'] >= random['logl_ratio'][random['map_stimuli']])
@@ -0,0 +1,72 @@
+import threading
+
+import numpy as np
+import pytest
+
+from dec.utils import save_decoder, load_decoder, DecoderClient, start_background_service
+from dec.utils.fit import firstpass_decoder_independent_channels_batch
+from dec.utils.service import benchmark
+
+
+@pytest.fixture
+def service(problem, tmp_path):
+    """a service of a small saved bundle on a free local port, with a generous batch window."""
+    path = save_decoder(str(tmp_path / 'test.decoder'), problem['W'], problem['omega_inv'], problem['logdet'],
+                        problem['mapping_relation'], problem['mapping_parameters'])
+    service, stop = start_background_service(load_decoder(path), port=0, batch_window=0.05, n_workers=1)
+    yield service
+    stop()
+
+
+def test_firstpass_parity(problem, service):
+    bolds = problem['bolds']
+    images, stats = benchmark(service.address, bolds, n_clients=4)
+    expected = firstpass_decoder_independent_channels_batch(problem['W'], bolds, problem['logdet'], problem['omega_inv'],
+                                                            problem['mapping_relation'], problem['mapping_parameters'])
+    np.testing.assert_allclose(images, expected, rtol=1e-10, atol=1e-12)
+    assert stats['requests_per_second'] > 0
+
+
+def test_shape_error(problem, service):
+    client = DecoderClient(*service.address)
+    try:
+        with pytest.raises(ValueError, match='expected %i voxels' % problem['W'].shape[0]):
+            client.decode(problem['bolds'][:5, 0])
+        # the connection stays usable after an error
+        image, logl = client.decode(problem['bolds'][:, 0])
+        assert image.shape == (problem['W'].shape[1],)
+        assert np.isfinite(logl)
+    finally:
+        client.close()
+
+
+def test_stats_and_coalescing(problem, service):
+    n_clients = 4
+    barrier = threading.Barrier(n_clients)
+
+    def run():
+        client = DecoderClient(*service.address)
+        try:
+            for t in range(problem['bolds'].shape[1]):
+                # all clients send each timepoint together, within the batch window
+                barrier.wait()
+                client.decode(problem['bolds'][:, t])
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=run) for _ in range(n_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    client = DecoderClient(*service.address)
+    try:
+        stats = client.stats()
+    finally:
+        client.close()
+    assert stats['n_requests'] == n_clients * problem['bolds'].shape[1]
+    for percentile in [50, 90, 99]:
+        assert stats['latency_p%i_ms' % percentile] > 0
+    assert stats['latency_p50_ms'] <= stats['latency_p99_ms'] <= stats['latency_max_ms']
+    assert stats['mean_batch_size'] > 1
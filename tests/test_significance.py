@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from dec.utils.significance import (permutation_p_value, pairing_null, voxel_shift_null, fold_bootstrap, _null_indices)
+
+
+def test_permutation_p_value():
+    null = np.arange(9.0)
+    assert permutation_p_value(8.5, null) == 0.1
+    assert permutation_p_value(-1.0, null) == 1.0
+    assert permutation_p_value(-1.0, null, alternative='less') == 0.1
+
+
+@pytest.mark.parametrize('kind', ['circular', 'permutation'])
+def test_null_indices_are_not_the_observed_pairing(kind):
+    rng = np.random.RandomState(0)
+    for n_timepoints in [2, 3, 5, 40]:
+        indices = _null_indices(kind, n_timepoints, 500, 1, rng)
+        assert np.all(np.sort(indices, axis=1) == np.arange(n_timepoints))
+        assert not np.any(np.all(indices == np.arange(n_timepoints), axis=1))
+
+
+def test_circular_null_respects_min_shift():
+    indices = _null_indices('circular', 20, None, 3, np.random.RandomState(0))
+    shifts = indices[:, 0]
+    assert sorted(shifts) == list(range(3, 18))
+
+
+def _uniform(p_values):
+    """p-values of a valid test are uniform on (0, 1] under the null, up to their discreteness."""
+    p_values = np.asarray(p_values)
+    assert abs(np.mean(p_values) - 0.5) < 0.07
+    assert np.mean(p_values <= 0.1) < 0.18
+
+
+@pytest.mark.parametrize('kind', ['circular', 'permutation'])
+def test_pairing_null_without_signal(kind):
+    rng = np.random.RandomState(1)
+    p_values = []
+    for seed in range(200):
+        decoded, presented = rng.randn(30, 4, 4), rng.randn(30, 4, 4)
+        result = pairing_null(decoded, presented, kind=kind, n_permutations=99, seed=seed)
+        p_values.append(result['p_correlation'])
+    _uniform(p_values)
+
+
+def test_pairing_null_with_signal():
+    rng = np.random.RandomState(2)
+    presented = rng.randn(30, 4, 4)
+    result = pairing_null(presented + rng.randn(30, 4, 4), presented, n_permutations=None)
+    assert result['p_correlation'] == 1.0 / 30 and result['p_identification'] < 0.05
+
+
+def test_voxel_shift_null_without_signal(problem):
+    rng = np.random.RandomState(3)
+    W, omega = problem['W'][:, :10], problem['omega']
+    p_values = []
+    for seed in range(60):
+        bolds = rng.randn(W.shape[0], 20)
+        result = voxel_shift_null(W, bolds, problem['logdet'], problem['omega_inv'], rng.randn(20, 10),
+                                  n_permutations=49, seed=seed)
+        p_values.append(result['p_correlation'])
+    _uniform(p_values)
+
+
+def test_fold_bootstrap_resamples_whole_folds():
+    # every fold has its own value and number of missing timepoints, so that only
+    # means over whole folds, not over timepoints, give multiples of 1/3
+    values = np.array([[0.0, 0.0, 0.0, np.nan],
+                       [1.0, 1.0, np.nan, np.nan],
+                       [2.0, 2.0, 2.0, 2.0]])
+    result = fold_bootstrap(values, n_bootstrap=2000)
+    assert result['mean'] == 1.0
+    np.testing.assert_allclose(np.round(3 * result['bootstrap']), 3 * result['bootstrap'], atol=1e-12)
+    assert set(np.round(3 * result['bootstrap']).astype(int)) == set(range(7))
+    assert result['ci'][0] < 1.0 < result['ci'][1]
+    # only resampling fold 0 three times gives a mean of 0, with probability 1/27
+    assert abs(result['p_value'] - 1 / 27.0) < 0.01
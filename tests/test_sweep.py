@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from dec.utils import sweep
+from dec.utils.sweep import DecodingSweep
+
+N_VOXELS, N_TIMEPOINTS = 12, 6
+RSQ = np.linspace(0.05, 0.95, N_VOXELS)
+
+
+class FakePipeline(object):
+    """stands in for setup_data_from_h5, fit_model_omega and decode_fold, and records their calls."""
+
+    def __init__(self, failing_folds=()):
+        self.failing_folds = failing_folds
+        self.setups, self.omega_fits, self.decodings = [], [], []
+
+    def setup_data_from_h5(self, n_pix, rsq_threshold, cv_fold, **kwargs):
+        self.setups.append((n_pix, cv_fold, rsq_threshold))
+        voxels = RSQ > rsq_threshold
+        rng = np.random.RandomState(cv_fold)
+        residuals = rng.randn(N_VOXELS, 40)[voxels]
+        prf_cv_fold_data = np.tile([0.0, 0.0, 1.0, 0.8, 2.0, 0.5, 0.9], (voxels.sum(), 1))
+        W = rng.rand(N_VOXELS, n_pix**2)
+        # the fold is kept in W, for fit_model_omega
+        W[:, 0] = cv_fold
+        return (prf_cv_fold_data, W[voxels], residuals, np.cov(residuals),
+                rng.rand(N_VOXELS, N_TIMEPOINTS)[voxels], np.ones((n_pix, n_pix), dtype=bool))
+
+    def fit_model_omega(self, observed_residual_covariance, W, x0, x0_voxels, voxels, **kwargs):
+        n_voxels = W.shape[0]
+        self.omega_fits.append((n_voxels, x0 is not None))
+        if W[0, 0] in self.failing_folds:
+            return None
+        omega = np.eye(n_voxels)
+        return (np.ones(n_voxels), 0.1, 0.2, 0.0, omega, omega, (1.0, 0.0), np.r_[0.1, 0.2, 0.0, np.ones(n_voxels)])
+
+    def decode_fold(self, W, test_data, logdet, omega_inv, mapping_relation, mapping_parameters, n_jobs):
+        self.decodings.append((W.shape[0], mapping_relation))
+        return None, np.ones((W.shape[1], test_data.shape[1]))
+
+
+@pytest.fixture
+def fake_sweep(monkeypatch):
+    def make(failing_folds=()):
+        pipeline = FakePipeline(failing_folds)
+        monkeypatch.setattr(sweep, 'setup_data_from_h5', pipeline.setup_data_from_h5)
+        monkeypatch.setattr(sweep, 'fit_model_omega', pipeline.fit_model_omega)
+        monkeypatch.setattr(sweep, 'decode_fold', pipeline.decode_fold)
+        monkeypatch.setattr(sweep, 'realign_reconstructions', lambda recon: (recon, recon[:, np.newaxis]))
+        decoding_sweep = DecodingSweep('data.h5', n_folds=2, n_jobs=1)
+        decoding_sweep.rsq_crossv = RSQ
+        return decoding_sweep, pipeline
+    return make
+
+
+def test_sweep_reuses_stages_across_points_and_runs(fake_sweep):
+    decoding_sweep, pipeline = fake_sweep()
+    results = decoding_sweep.run(n_pix=[3], rsq_threshold=[0.5, 0.2], mapping=['css', 'linear'])
+
+    # one setup per fold at the lowest threshold, one omega fit per threshold and fold,
+    # warm started above the lowest threshold, and one decoding per sweep point and fold
+    assert sorted(pipeline.setups) == [(3, 0, 0.2), (3, 1, 0.2)]
+    assert sorted(pipeline.omega_fits) == [((RSQ > 0.5).sum(), True)] * 2 + [((RSQ > 0.2).sum(), False)] * 2
+    assert len(pipeline.decodings) == 8
+    assert [setting for setting, _ in results] == [dict(n_pix=3, rsq_threshold=r, mapping=m)
+                                                  for r in [0.5, 0.2] for m in ['css', 'linear']]
+    for setting, result in results:
+        assert result['cv_recon'].shape == (2, N_TIMEPOINTS, 3, 3)
+        np.testing.assert_array_equal(result['cv_estimated_rho'], [0.1, 0.1])
+
+    # a higher threshold slices the cached setup, and only its own stages run
+    results = decoding_sweep.run(n_pix=[3], rsq_threshold=[0.2, 0.7], mapping=['css'])
+    assert len(pipeline.setups) == 2
+    assert sorted(pipeline.omega_fits[4:]) == [((RSQ > 0.7).sum(), True)] * 2
+    assert len(pipeline.decodings) == 10
+    assert all(result is not None for _, result in results)
+
+
+def test_sweep_marks_points_with_a_failed_omega_fit(fake_sweep):
+    decoding_sweep, pipeline = fake_sweep(failing_folds=(0,))
+    results = decoding_sweep.run(n_pix=[3], rsq_threshold=[0.2, 0.5], mapping=['css'])
+
+    assert [result for _, result in results] == [None, None]
+    # the fit of the higher threshold of the failed fold is not warm started, the other one is
+    assert sorted(pipeline.omega_fits[2:]) == [((RSQ > 0.5).sum(), False), ((RSQ > 0.5).sum(), True)]
+    # only the folds with an omega fit are decoded
+    assert len(pipeline.decodings) == 2